@@ -0,0 +1,66 @@
+"""
+Compare the IVF index with a brute-force scan: recall@10 and queries per second for several nprobe values.
+
+Queries are blends of a few random item vectors, the way blended and personalized requests look
+for items near an arbitrary point. Build the index first with "flask build-ann-index".
+
+Usage (from the backend directory):
+    python benchmarks/ann_recall.py --queries 1000 --nprobe 1 2 4 8 16 32
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+TOP_N = 10
+
+
+def make_queries(vectors, count, seeds_per_query=3, seed=0):
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(vectors), size=(count, seeds_per_query))
+    queries = np.asarray(vectors[picks.ravel()]).reshape(count, seeds_per_query, -1).mean(axis=1)
+    return queries.astype(np.float32)
+
+
+def timed(search, queries):
+    started = time.perf_counter()
+    results = [search(query) for query in queries]
+    return results, len(queries) / (time.perf_counter() - started)
+
+
+def main():
+    from flaskr.services.ann_index import brute_force_search, load_ivf_index
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', type=int, default=1000, help='Number of random queries.')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32], help='nprobe values to test.')
+    args = parser.parse_args()
+
+    index = load_ivf_index()
+    if index is None:
+        sys.exit('No ANN index found, run "flask build-ann-index" first.')
+
+    vectors = np.asarray(index.vectors)
+    queries = make_queries(vectors, args.queries)
+
+    # The index stores vectors grouped by list, so map exact results back to item rows
+    exact, exact_qps = timed(lambda query: index.rows[brute_force_search(vectors, query, TOP_N)[0]], queries)
+
+    print(f"{index.n_lists} lists, {len(index)} vectors of size {vectors.shape[1]} ({index.source}), "
+          f"{args.queries} queries")
+    print(f"{'method':<14} {'recall@10':>10} {'QPS':>10} {'speedup':>8}")
+    print(f"{'brute force':<14} {1.0:>10.3f} {exact_qps:>10.0f} {1.0:>8.1f}")
+    for nprobe in args.nprobe:
+        approximate, qps = timed(lambda query: index.search(query, TOP_N, nprobe=nprobe)[0], queries)
+        recall = np.mean([
+            len(np.intersect1d(found, expected)) / len(expected) for found, expected in zip(approximate, exact)
+        ])
+        print(f"{f'nprobe={nprobe}':<14} {recall:>10.3f} {qps:>10.0f} {qps / exact_qps:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
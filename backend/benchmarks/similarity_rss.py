@@ -0,0 +1,103 @@
+"""
+Measure the memory each worker process pays for the similarity matrix.
+
+Starts N worker processes per loading mode, has each one load the matrix and serve random row
+lookups, then reads its memory from /proc while all workers are still alive so that shared pages
+are accounted for. Linux only.
+
+Usage (from the backend directory):
+    python benchmarks/similarity_rss.py --workers 4 --lookups 2000
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+MODES = ('joblib', 'csr')
+
+
+def read_memory_kb():
+    """
+    Read the RSS, proportional set size and private memory of the current process, in kB.
+    """
+    memory = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                memory[key] = int(value.split()[0])
+    return {
+        'rss': memory['Rss'],
+        'pss': memory['Pss'],
+        'private': memory['Private_Clean'] + memory['Private_Dirty'],
+    }
+
+
+def load(mode):
+    import joblib
+    from scipy.sparse import csr_matrix
+    from flaskr.services.similarity_store import load_similarity_csr, similarity_csr_path, similarity_joblib_path
+
+    if mode == 'joblib':
+        return csr_matrix(joblib.load(similarity_joblib_path, mmap_mode='r'))
+    return load_similarity_csr(similarity_csr_path)
+
+
+def worker(mode, lookups, loaded, measured, results):
+    import numpy as np
+
+    baseline = read_memory_kb()
+    matrix = load(mode)
+
+    # Serve random lookups the way get_similar_indices does
+    rng = np.random.default_rng(os.getpid())
+    for idx in rng.integers(0, matrix.shape[0], size=lookups):
+        row = matrix[idx]
+        if len(row.data):
+            row.indices[np.argmax(row.data)]
+
+    loaded.wait()
+    memory = read_memory_kb()
+    results.put({key: memory[key] - baseline[key] for key in memory})
+    measured.wait()
+
+
+def run(mode, workers, lookups):
+    context = multiprocessing.get_context('spawn')
+    loaded = context.Barrier(workers)
+    measured = context.Barrier(workers)
+    results = context.Queue()
+
+    processes = [
+        context.Process(target=worker, args=(mode, lookups, loaded, measured, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    samples = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    return {key: sum(sample[key] for sample in samples) / len(samples) for key in samples[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4, help='Concurrent worker processes per mode.')
+    parser.add_argument('--lookups', type=int, default=2000, help='Random row lookups per worker.')
+    args = parser.parse_args()
+
+    averages = {mode: run(mode, args.workers, args.lookups) for mode in MODES}
+
+    print(f"{'mode':<8} {'RSS MB':>10} {'PSS MB':>10} {'private MB':>11}   (average per worker, {args.workers} workers)")
+    for mode, memory in averages.items():
+        print(f"{mode:<8} {memory['rss'] / 1024:>10.1f} {memory['pss'] / 1024:>10.1f} {memory['private'] / 1024:>11.1f}")
+
+    saved = (averages['joblib']['private'] - averages['csr']['private']) / 1024
+    print(f"Private memory saved per worker with memory-mapped CSR arrays: {saved:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,9 @@
+import logging
 import os
 from datetime import timedelta
 import random
 from functools import wraps
-import subprocess
 import time
-import redis
 
 from flask import Flask, jsonify, request, current_app
 from flask_bcrypt import Bcrypt
@@ -24,6 +23,7 @@ db = SQLAlchemy()
 
 
 def create_app(test_config=None):
+    started = time.perf_counter()
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
@@ -38,7 +38,20 @@ def create_app(test_config=None):
         OPENAPI_VERSION='3.0.3',
         OPENAPI_URL_PREFIX='/',
         OPENAPI_SWAGGER_UI_PATH='/swagger-ui/',
-        OPENAPI_SWAGGER_UI_URL='https://cdn.jsdelivr.net/npm/swagger-ui-dist/'
+        OPENAPI_SWAGGER_UI_URL='https://cdn.jsdelivr.net/npm/swagger-ui-dist/',
+        # Number of ratings loaded and committed per batch by populate_tables
+        INGEST_BATCH_SIZE=100000,
+        # Load CSVs and ML artifacts at startup instead of on first use, e.g. in the gunicorn master
+        PRELOAD_RESOURCES=os.getenv('PRELOAD_RESOURCES', '').lower() in ('1', 'true', 'yes'),
+        # Record request, SQL, Redis, OMDB and cache metrics and serve them on /metrics
+        METRICS_ENABLED=os.getenv('METRICS_ENABLED', '1').lower() in ('1', 'true', 'yes'),
+        LOG_LEVEL=os.getenv('LOG_LEVEL', 'INFO'),
+        # Profile slow requests and a sampled fraction of all requests, see flaskr.profiling
+        PROFILING_ENABLED=os.getenv('PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes'),
+        PROFILE_SLOW_THRESHOLD=float(os.getenv('PROFILE_SLOW_THRESHOLD', 1.0)),
+        PROFILE_SAMPLE_RATE=float(os.getenv('PROFILE_SAMPLE_RATE', 0.0)),
+        PROFILE_SAMPLE_INTERVAL=float(os.getenv('PROFILE_SAMPLE_INTERVAL', 0.01)),
+        PROFILE_BUFFER_SIZE=int(os.getenv('PROFILE_BUFFER_SIZE', 20)),
     )
 
     if test_config is None:
@@ -48,6 +61,8 @@ def create_app(test_config=None):
         # load the test config if passed in
         app.config.from_mapping(test_config)
 
+    logging.basicConfig(level=app.config['LOG_LEVEL'].upper())
+
     # Initialize the database, bcrypt and JWT
     bcrypt.init_app(app)
     jwt.init_app(app)
@@ -60,18 +75,29 @@ def create_app(test_config=None):
     except OSError:
         pass
 
-    # Start Redis when the Flask app starts
-    start_redis()
-
-    # Set up Redis client
+    # Set up the shared Redis client. Redis is started separately; while it is down, requests are
+    # served without the cache
+    from flaskr.services.redis_pool import REDIS_URL, get_redis_client
+    from redis.exceptions import RedisError
+    redis_client = get_redis_client()
+    # Attach the Redis client to the app context
+    app.redis_client = redis_client
     try:
-        redis_client = redis.StrictRedis(host='localhost', port=6379, db=0, decode_responses=True)
         redis_client.ping()  # Test connection
-        # Attach the Redis client to the app context
-        app.redis_client = redis_client
         print("Connected to Redis")
-    except redis.exceptions.ConnectionError as e:
-        print(f"Redis connection error: {e}")
+    except RedisError as e:
+        print(f"Redis connection error, running without the cache until {REDIS_URL} is reachable: {e}")
+
+    # Keep the in-process caches of all workers coherent through Redis pub/sub
+    from flaskr.services.local_cache import configure_local_caches
+    configure_local_caches(redis_client)
+
+    # Request, SQL and dependency metrics
+    from flaskr.metrics import init_metrics
+    init_metrics(app)
+
+    from flaskr.profiling import init_profiling
+    init_profiling(app)
 
     # Configure CORS
     cors = CORS(app, resources={r"/*": {"origins": "http://localhost:5173"}})
@@ -112,13 +138,60 @@ def create_app(test_config=None):
     from flaskr.models.movie_recommendations import movies_recommendation_blueprint
     api.register_blueprint(movies_recommendation_blueprint)
 
+    from flaskr.routes.movies import movies_blueprint
+    api.register_blueprint(movies_blueprint)
+
     from flaskr.movielense_helper import movielense_helper_blueprint
     api.register_blueprint(movielense_helper_blueprint)
 
+    from flaskr.routes.profiling import profiling_blueprint
+    api.register_blueprint(profiling_blueprint)
+
+    # Register the offline build commands
+    from flaskr.services.neighbor_index import build_neighbor_index_command
+    app.cli.add_command(build_neighbor_index_command)
+
+    from flaskr.services.similarity_store import export_similarity_csr_command
+    app.cli.add_command(export_similarity_csr_command)
+
+    from flaskr.services.movie_index import build_movie_index_command
+    app.cli.add_command(build_movie_index_command)
+
+    from flaskr.services.omdb_warmup import warm_omdb_cache_command
+    app.cli.add_command(warm_omdb_cache_command)
+
+    from flaskr.services.rating_stats import rebuild_rating_stats_command
+    app.cli.add_command(rebuild_rating_stats_command)
+
+    from flaskr.services.genre_index import rebuild_genre_index_command
+    app.cli.add_command(rebuild_genre_index_command)
+
+    from flaskr.services.collaborative_filtering import train_cf_command
+    app.cli.add_command(train_cf_command)
+
+    from flaskr.services.ann_index import build_ann_index_command
+    app.cli.add_command(build_ann_index_command)
+
+    from flaskr.services.similarity_builder import rebuild_similarity_command, update_similarity_command
+    app.cli.add_command(rebuild_similarity_command)
+    app.cli.add_command(update_similarity_command)
+
+    from flaskr.models.genre_model import backfill_recommended_genres_command
+    app.cli.add_command(backfill_recommended_genres_command)
+
     # Generate and store the PIN
     app.config['POPULATE_TABLES_PIN'] = generate_pin()
     print(f"Generated PIN: {app.config['POPULATE_TABLES_PIN']}")
 
+    from flaskr.services.resources import preload_resources, startup_report
+    if app.config['PRELOAD_RESOURCES']:
+        preload_resources()
+
+    # Startup timing report
+    print(f"App created in {time.perf_counter() - started:.2f}s")
+    for name, load_time in startup_report():
+        print(f"  {name}: {f'{load_time:.2f}s' if load_time is not None else 'loaded on first use'}")
+
     return app
 
 
@@ -144,14 +217,3 @@ def pin_required(f):
 def generate_pin():
     return str(random.randint(1000, 9999))
 
-
-def start_redis():
-    """
-    Start the Redis server as a subprocess.
-    """
-    try:
-        subprocess.Popen(['redis-server'])  # Start Redis server as a subprocess
-        time.sleep(1)  # Wait for Redis to start
-        print("Redis server started successfully.")
-    except Exception as e:
-        print(f"Error starting Redis server: {e}")
@@ -115,3 +115,51 @@ class MovielensRating(db.Model):
     movielens_user_id = db.Column(db.Integer, primary_key=True)
     rating = db.Column(db.Float)
     timestamp = db.Column(db.DateTime)
+
+
+class OmdbMovieDetails(db.Model):
+    __tablename__ = 'omdb_movie_details'
+
+    imdb_id = db.Column(db.String, primary_key=True)  # Formatted IMDb ID, e.g. "tt0114709"
+    details = db.Column(db.Text, nullable=False)  # Raw OMDB API response as JSON
+    fetched_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<OmdbMovieDetails {self.imdb_id}>'
+
+
+class MovieRatingStats(db.Model):
+    __tablename__ = 'movie_rating_stats'
+
+    movie_id = db.Column(db.Integer, primary_key=True)
+    rating_count = db.Column(db.Integer, nullable=False, index=True)
+    rating_sum = db.Column(db.Float, nullable=False)
+    rating_mean = db.Column(db.Float, nullable=False)
+    weighted_score = db.Column(db.Float, nullable=False, index=True)  # Bayesian average, see services/rating_stats.py
+
+    def __repr__(self):
+        return f'<MovieRatingStats movie_id={self.movie_id}, rating_count={self.rating_count}>'
+
+
+class MovieGenre(db.Model):
+    __tablename__ = 'movie_genre'
+
+    # Genre first in the primary key so per-genre lookups are index range scans
+    genre_id = db.Column(db.Integer, db.ForeignKey('genre.id'), primary_key=True)
+    movie_id = db.Column(db.Integer, db.ForeignKey('movielens_movies.movie_id'), primary_key=True, index=True)
+    genre = db.relationship('Genre', backref=db.backref('movie_genres', lazy=True))
+
+    def __repr__(self):
+        return f'<MovieGenre genre_id={self.genre_id}, movie_id={self.movie_id}>'
+
+
+class IngestionCheckpoint(db.Model):
+    __tablename__ = 'ingestion_checkpoint'
+
+    source = db.Column(db.String, primary_key=True)  # e.g. "movielens_ratings"
+    rows_done = db.Column(db.Integer, nullable=False, default=0)  # Data rows of the source already committed
+    completed = db.Column(db.Boolean, nullable=False, default=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<IngestionCheckpoint {self.source} rows_done={self.rows_done}, completed={self.completed}>'
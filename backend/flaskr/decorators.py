@@ -1,8 +1,15 @@
 import functools
+import hashlib
 import json
+import time
+import uuid
 from functools import wraps
 from flask import request, jsonify, current_app
-from flask_jwt_extended import jwt_required
+from flask_jwt_extended import get_jwt_identity, jwt_required, verify_jwt_in_request
+from redis.exceptions import LockError, RedisError, ResponseError
+
+from flaskr.services.local_cache import LocalCache, record_redis_lookup
+from flaskr.services.redis_pool import get_redis_client
 
 
 def swagger_doc(description, parameters=None, responses=None):
@@ -23,39 +30,197 @@ def swagger_doc(description, parameters=None, responses=None):
     return decorator
 
 
-def cache_response(timeout=60, persist=False):
+# Prefix of the Redis sets holding the cache keys of every tag
+CACHE_TAG_PREFIX = 'cache_tag:'
+
+# Cache keys dropped per UNLINK when invalidating a tag
+INVALIDATION_BATCH_SIZE = 500
+
+# Fresh responses of this process, in front of Redis
+response_cache = LocalCache('responses')
+
+
+def user_cache_tag(user_id):
+    """
+    Tag of the responses cached per user, see ``vary_on_user`` of :func:`cache_response`.
+    """
+    return f"user:{user_id}"
+
+
+def _request_fingerprint(user_id):
+    """
+    Hash everything a cached response depends on: query arguments, body and the user, if any.
+    """
+    body = request.get_json(silent=True)
+    fingerprint = {
+        'args': sorted(request.args.items(multi=True)),
+        'body': body if body is not None else hashlib.sha1(request.get_data()).hexdigest(),
+        'user': user_id,
+    }
+
+    canonical = json.dumps(fingerprint, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def _serialize_entry(response, fresh_until):
+    return f"{fresh_until}\n{response.status_code}\n{response.mimetype}\n{response.get_data(as_text=True)}"
+
+
+def _deserialize_entry(entry):
+    fresh_until, status, mimetype, body = entry.split('\n', 3)
+    return float(fresh_until), int(status), mimetype, body
+
+
+def invalidate_cache_tags(*tags):
+    """
+    Drop every cached response stored with one of the given tags, e.g. "ratings" after new ratings are loaded.
+
+    Tag sets are scanned and their keys unlinked in batches of ``INVALIDATION_BATCH_SIZE``, so a large
+    tag does not block Redis.
+    """
+    redis_client = get_redis_client()
+    for tag in tags:
+        tag_key = CACHE_TAG_PREFIX + tag
+        try:
+            # Rename first, so that entries cached meanwhile go to a new set and are not dropped unseen
+            pending_key = f"{tag_key}:invalidating:{uuid.uuid4().hex}"
+            try:
+                redis_client.rename(tag_key, pending_key)
+            except ResponseError:
+                # Nothing is cached with this tag
+                continue
+
+            batch = []
+            for key in redis_client.sscan_iter(pending_key, count=INVALIDATION_BATCH_SIZE):
+                batch.append(key)
+                if len(batch) >= INVALIDATION_BATCH_SIZE:
+                    _unlink_cached_responses(redis_client, batch)
+                    batch = []
+            if batch:
+                _unlink_cached_responses(redis_client, batch)
+            redis_client.unlink(pending_key)
+        except RedisError as e:
+            # Called after the data changed; the entries still expire on their own
+            current_app.logger.warning(f"Could not invalidate the {tag!r} cache tag: {e}")
+
+
+def _unlink_cached_responses(redis_client, keys):
+    response_cache.invalidate(keys)
+    redis_client.unlink(*keys)
+
+
+def cache_response(timeout=60, persist=False, tags=(), vary_on_user=False, stale_timeout=None, lock_timeout=30,
+                   lock_wait=5):
     """
     A decorator to cache the response of a Flask view function.
 
+    Responses are keyed on the path, method and a canonical hash of the query arguments and JSON body,
+    and stored as the serialized bytes, so a hit is returned without decoding and re-encoding JSON.
+    Fresh entries are also kept in the in-process ``response_cache``, which answers repeated hits
+    without a Redis round-trip.
+    While Redis is down, responses are computed and cached in this process only.
+    Only one worker recomputes a missing or stale entry at a time; the others wait for it, or keep
+    serving the stale entry meanwhile.
+
     Args:
-         timeout (int): Time in seconds to cache the result.
+        timeout (int): Time in seconds a cached response is fresh.
         persist (bool): If True, cache indefinitely unless explicitly invalidated.
+        tags (tuple): Tags to invalidate the cached responses with, see :func:`invalidate_cache_tags`.
+        vary_on_user (bool): Cache separately for every JWT identity, e.g. when the response excludes the
+            user's watch history. These entries are also tagged with :func:`user_cache_tag`.
+        stale_timeout (int): Time in seconds a response may still be served once it is no longer fresh,
+            while it is recomputed. Defaults to ``timeout``.
+        lock_timeout (int): Time in seconds after which the recompute lock of a crashed worker expires.
+        lock_wait (float): Time in seconds to wait for another worker computing a missing entry.
     """
+    stale_timeout = timeout if stale_timeout is None else stale_timeout
 
     def decorator(f):
         @functools.wraps(f)
         def wrapped(*args, **kwargs):
-            redis_client = current_app.redis_client
-            # Create a unique cache key using the request path, method, and query string
-            cache_key = f"response_cache:{request.path}:{request.method}:{request.query_string.decode('utf-8')}"
-
-            # Check if the response is in the cache
-            cached_response = redis_client.get(cache_key) if redis_client else None
-            if cached_response:
-                print(f"Cache hit for {cache_key}")
-                return jsonify(json.loads(cached_response))  # Convert back to JSON format
-
-            print(f"Cache miss for {cache_key}. Processing request.")
-            response = f(*args, **kwargs)
-
-            # Cache the response
-            if redis_client:
-                if persist:
-                    redis_client.set(cache_key, json.dumps(response.json))
-                else:
-                    redis_client.setex(cache_key, timeout, json.dumps(response.json))  # Cache the JSON response
-
-            return response
+            redis_client = get_redis_client()
+
+            user_id = None
+            if vary_on_user:
+                verify_jwt_in_request(optional=True)
+                user_id = get_jwt_identity()
+            cache_key = f"response_cache:{request.path}:{request.method}:{_request_fingerprint(user_id)}"
+            entry_tags = list(tags) + ([user_cache_tag(user_id)] if user_id is not None else [])
+
+            def cached(entry, state):
+                _, status, mimetype, body = _deserialize_entry(entry) if isinstance(entry, str) else entry
+                response = current_app.response_class(body, status=status, mimetype=mimetype)
+                response.headers['X-Cache'] = state
+                return response
+
+            def remember(entry):
+                fresh_until = entry[0]
+                response_cache.set(cache_key, entry, len(entry[3]), ttl=fresh_until - time.time())
+
+            def compute(lock):
+                try:
+                    response = current_app.make_response(f(*args, **kwargs))
+                    if response.status_code == 200:
+                        fresh_until = float('inf') if persist else time.time() + timeout
+                        entry = _serialize_entry(response, fresh_until)
+                        remember(_deserialize_entry(entry))
+                        pipeline = redis_client.pipeline(transaction=False)
+                        if persist:
+                            pipeline.set(cache_key, entry)
+                        else:
+                            pipeline.setex(cache_key, timeout + stale_timeout, entry)
+                        for tag in entry_tags:
+                            pipeline.sadd(CACHE_TAG_PREFIX + tag, cache_key)
+                            if not persist:
+                                # The set expires with its newest entry instead of growing forever
+                                pipeline.expire(CACHE_TAG_PREFIX + tag, timeout + stale_timeout)
+                        try:
+                            pipeline.execute()
+                        except RedisError:
+                            # Redis is down, the response stays cached in this process only
+                            pass
+                    response.headers['X-Cache'] = 'MISS'
+                    return response
+                finally:
+                    if lock is not None:
+                        try:
+                            lock.release()
+                        except (LockError, RedisError):
+                            # The lock expired while computing and may belong to another worker now
+                            pass
+
+            entry = response_cache.get(cache_key)
+            if entry is not None:
+                return cached(entry, 'HIT')
+
+            lock = None
+            try:
+                entry = redis_client.get(cache_key)
+                if entry and _deserialize_entry(entry)[0] > time.time():
+                    record_redis_lookup(response_cache.name, 1)
+                    remember(_deserialize_entry(entry))
+                    return cached(entry, 'HIT')
+                record_redis_lookup(response_cache.name, 0, 1)
+
+                # Single flight: only the lock holder recomputes the entry
+                lock = redis_client.lock(f"{cache_key}:lock", timeout=lock_timeout)
+                if not lock.acquire(blocking=False):
+                    lock = None
+                    if entry:
+                        return cached(entry, 'STALE')
+
+                    deadline = time.monotonic() + lock_wait
+                    while time.monotonic() < deadline:
+                        time.sleep(0.05)
+                        entry = redis_client.get(cache_key)
+                        if entry:
+                            return cached(entry, 'HIT')
+                    # The other worker is too slow, compute without the lock
+            except RedisError:
+                # Redis is down, compute and keep the response in this process only
+                lock = None
+
+            return compute(lock)
 
         return wrapped
 
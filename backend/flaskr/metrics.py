@@ -0,0 +1,232 @@
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the histogram of SQL queries per request
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+# Type and description of every metric, in exposition order
+METRICS = {
+    'http_requests_total': ('counter', 'Requests by endpoint, method and status.'),
+    'http_request_duration_seconds': ('histogram', 'Request latency by endpoint.'),
+    'http_request_db_queries': ('histogram', 'SQL queries run by a request.'),
+    'http_request_db_seconds': ('histogram', 'Time a request spent in SQL queries.'),
+    'db_query_duration_seconds': ('histogram', 'Latency of every SQL query.'),
+    'omdb_request_duration_seconds': ('histogram', 'Latency of OMDB API calls by outcome.'),
+    'redis_command_duration_seconds': ('histogram', 'Latency of Redis commands and pipelines.'),
+    'redis_commands_total': ('counter', 'Redis calls by outcome; rejected calls were failed fast by the breaker.'),
+    'redis_breaker_open': ('gauge', '1 while the Redis circuit breaker fails calls fast.'),
+    'cache_requests_total': ('counter', 'Cache lookups by cache, layer and result.'),
+    'cache_entries': ('gauge', 'Entries held by the in-process caches.'),
+    'cache_bytes': ('gauge', 'Size of the in-process caches.'),
+}
+
+# Set by init_metrics
+_enabled = False
+_lock = threading.Lock()
+# (name, labels) -> value or Histogram
+_values = {}
+
+
+class Histogram:
+    """
+    Cumulative histogram in the Prometheus sense. Not thread-safe: the owner holds a lock.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # Bucket bounds are inclusive, as "le" means
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts, histogram.sum, histogram.count = list(self.counts), self.sum, self.count
+        return histogram
+
+    def samples(self):
+        """
+        Get the cumulative bucket counts, ``+Inf`` last.
+
+        Returns:
+            list: ``(upper_bound, count)`` pairs.
+        """
+        cumulative, total = [], 0
+        for bound, count in zip(list(self.buckets) + [float('inf')], self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+def metrics_enabled():
+    """
+    Tell whether metrics are recorded, for counters kept outside this module.
+    """
+    return _enabled
+
+
+def increment(name, amount=1, **labels):
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = _values.get(key, 0) + amount
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _values.get(key)
+        if histogram is None:
+            histogram = _values[key] = Histogram(buckets)
+        histogram.observe(value)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    observe('db_query_duration_seconds', elapsed)
+    if has_request_context() and 'metrics_started' in g:
+        g.metrics_db_queries += 1
+        g.metrics_db_seconds += elapsed
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_db_queries = 0
+    g.metrics_db_seconds = 0.0
+
+
+def _after_request(response):
+    if 'metrics_started' not in g:
+        return response
+    # The route pattern, so that path parameters do not create a series per value
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    elapsed = time.perf_counter() - g.metrics_started
+
+    increment('http_requests_total', endpoint=endpoint, method=request.method, status=str(response.status_code))
+    observe('http_request_duration_seconds', elapsed, endpoint=endpoint, method=request.method)
+    observe('http_request_db_queries', g.metrics_db_queries, buckets=QUERY_COUNT_BUCKETS, endpoint=endpoint)
+    observe('http_request_db_seconds', g.metrics_db_seconds, endpoint=endpoint)
+    return response
+
+
+def _collect_dependencies():
+    """
+    Read the counters kept by the Redis client and the in-process caches.
+    """
+    from flaskr.services.local_cache import cache_stats
+    from flaskr.services.redis_pool import get_redis_client
+
+    redis_client = get_redis_client()
+    outcomes, latency = redis_client.metrics.snapshot()
+    samples = {
+        ('redis_command_duration_seconds', ()): latency,
+        ('redis_breaker_open', ()): int(redis_client.breaker.state == 'open'),
+    }
+    for outcome, count in outcomes.items():
+        samples[('redis_commands_total', (('outcome', outcome),))] = count
+
+    for cache, layers in cache_stats().items():
+        for layer, counters in layers.items():
+            for result, counter in (('hit', 'hits'), ('miss', 'misses')):
+                samples[('cache_requests_total', (('cache', cache), ('layer', layer), ('result', result)))] = \
+                    counters[counter]
+        samples[('cache_entries', (('cache', cache),))] = layers['local']['entries']
+        samples[('cache_bytes', (('cache', cache),))] = layers['local']['bytes']
+    return samples
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def render_metrics():
+    """
+    Render every metric of this process in the Prometheus text exposition format.
+
+    Returns:
+        str: The exposition text.
+    """
+    with _lock:
+        samples = {
+            key: value.copy() if isinstance(value, Histogram) else value for key, value in _values.items()
+        }
+    samples.update(_collect_dependencies())
+
+    by_name = {}
+    for (name, labels), value in samples.items():
+        by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name, (metric_type, description) in METRICS.items():
+        if name not in by_name:
+            continue
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in sorted(by_name[name], key=lambda sample: sample[0]):
+            if isinstance(value, Histogram):
+                for bound, count in value.samples():
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', _format_bound(bound))])} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+            else:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+def init_metrics(app):
+    """
+    Record request, SQL and dependency metrics, and serve them on ``/metrics``.
+
+    Does nothing unless ``METRICS_ENABLED`` is set in the app config, so a disabled app pays no
+    per-request or per-query cost. Metrics are kept per process: with several gunicorn workers,
+    every scrape reads the worker that answers it.
+    """
+    global _enabled
+
+    _enabled = app.config['METRICS_ENABLED']
+    if not _enabled:
+        return
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -1,6 +1,13 @@
 from flask import Blueprint, request, jsonify
+import click
 import joblib
-from flaskr.services.data_preparation import prepare_data
+import numpy as np
+import pandas as pd
+from flask.cli import with_appcontext
+from flaskr import db
+from flaskr.database_models import User
+from flaskr.services.data_preparation import age_map_convertor, possible_gender_values_map
+from flaskr.services.resources import LazyResource
 import os
 
 genre_blueprint = Blueprint('genre', __name__)
@@ -10,19 +17,145 @@ base_dir = os.path.abspath(os.path.dirname(__file__))
 # base file path for machine learning models
 base_path = os.path.join(base_dir, '../../../machine_learning/models/')
 
-# Load models and encoders
-model = joblib.load(base_path + 'genre_model_based_number_of_rating.pkl')
-age_encoder = joblib.load(base_path + 'age_ohe.pkl')
-occupation_encoder = joblib.load(base_path + 'occupation_ohe.pkl')
-genre_columns = joblib.load(base_path + 'genre_columns.pkl')
-age_map = joblib.load(base_path + 'age_map.pkl')
+
+class GenreFeatureLayout:
+    """
+    Column layout of the genre model input, computed once from the fitted encoders.
+
+    Every age range and occupation is mapped to its encoded row up front, so encoding a batch is a
+    couple of fancy-indexing assignments instead of two sparse one-hot transforms per user.
+    """
+
+    def __init__(self, age_encoder, occupation_encoder):
+        age_categories = list(age_encoder.categories_[0])
+        occupation_categories = list(occupation_encoder.categories_[0])
+        self.age_rows = age_encoder.transform(np.array(age_categories).reshape(-1, 1)).toarray()
+        self.occupation_rows = occupation_encoder.transform(np.array(occupation_categories).reshape(-1, 1)).toarray()
+        self.age_positions = {category: position for position, category in enumerate(age_categories)}
+        self.occupation_positions = {category: position for position, category in enumerate(occupation_categories)}
+        self.feature_names = ['gender'] + list(age_encoder.get_feature_names_out(['AgeRange'])) + list(
+            occupation_encoder.get_feature_names_out(['Occupation']))
+
+    def encode(self, keys):
+        """
+        Encode ``(gender, age_range, occupation)`` keys into the model input.
+
+        Args:
+            keys (list): Keys built by :func:`genre_feature_key`.
+
+        Returns:
+            pd.DataFrame: One row per key, with the feature names the model was fitted with.
+        """
+        n_age = self.age_rows.shape[1]
+        features = np.zeros((len(keys), len(self.feature_names)))
+        features[:, 0] = [gender for gender, _, _ in keys]
+        features[:, 1:1 + n_age] = self.age_rows[[self.age_positions[age_range] for _, age_range, _ in keys]]
+        features[:, 1 + n_age:] = self.occupation_rows[
+            [self.occupation_positions[occupation] for _, _, occupation in keys]
+        ]
+        return pd.DataFrame(features, columns=self.feature_names)
+
+
+def load_genre_model():
+    # Load models and encoders
+    artifacts = {
+        'model': joblib.load(base_path + 'genre_model_based_number_of_rating.pkl'),
+        'age_encoder': joblib.load(base_path + 'age_ohe.pkl'),
+        'occupation_encoder': joblib.load(base_path + 'occupation_ohe.pkl'),
+        'genre_columns': joblib.load(base_path + 'genre_columns.pkl'),
+        'age_map': joblib.load(base_path + 'age_map.pkl'),
+    }
+    artifacts['layout'] = GenreFeatureLayout(artifacts['age_encoder'], artifacts['occupation_encoder'])
+    # Predictions by feature key; there are only a few hundred possible keys
+    artifacts['predictions'] = {}
+    return artifacts
+
+
+genre_model = LazyResource('genre_model', load_genre_model)
+
+
+def genre_feature_key(gender, age, occupation, artifacts=None):
+    """
+    Reduce a user's details to the discrete values the genre model actually sees.
+
+    Raises:
+        KeyError: If the gender, age range or occupation is unknown to the model.
+    """
+    artifacts = artifacts or genre_model.get()
+    key = (possible_gender_values_map[gender], artifacts['age_map'][age_map_convertor(age)], occupation)
+
+    layout = artifacts['layout']
+    if key[1] not in layout.age_positions or key[2] not in layout.occupation_positions:
+        raise KeyError(f"Unknown age range or occupation: {key[1]!r}, {key[2]!r}")
+    return key
+
+
+def predict_genres_batch(users):
+    """
+    Predict the recommended genres of many users at once.
+
+    Users are reduced to their feature key, and only keys that have not been predicted before are
+    encoded and sent to the model, in a single ``predict`` call.
+
+    Args:
+        users (list): ``(gender, age, occupation)`` tuples.
+
+    Returns:
+        list: The list of predicted genre names of every user.
+    """
+    artifacts = genre_model.get()
+    predictions = artifacts['predictions']
+
+    keys = [genre_feature_key(gender, age, occupation, artifacts) for gender, age, occupation in users]
+    missing = list(dict.fromkeys(key for key in keys if key not in predictions))
+    if missing:
+        flags = artifacts['model'].predict(artifacts['layout'].encode(missing))
+        for key, row in zip(missing, flags):
+            predictions[key] = [genre for genre, flag in zip(artifacts['genre_columns'], row) if flag == 1]
+
+    return [list(predictions[key]) for key in keys]
 
 
 def predict_genre(gender, age, occupation):
+    return predict_genres_batch([(gender, age, occupation)])[0]
+
+
+@click.command('backfill-recommended-genres')
+@click.option('--batch-size', default=1000, show_default=True, help='Users updated per transaction.')
+@click.option('--only-missing', is_flag=True, help='Skip users that already have recommended genres.')
+@with_appcontext
+def backfill_recommended_genres_command(batch_size, only_missing):
+    """Recompute User.recommended_genre for every user with the genre model."""
+    query = db.session.query(User.id, User.gender, User.age, User.occupation).order_by(User.id)
+    if only_missing:
+        query = query.filter((User.recommended_genre.is_(None)) | (User.recommended_genre == ''))
+
+    updated = skipped = no_age = 0
+    last_id = 0
+    while True:
+        users = query.filter(User.id > last_id).limit(batch_size).all()
+        if not users:
+            break
+        last_id = users[-1].id
+
+        valid = []
+        for user in users:
+            if user.age is None:
+                # Without an age the user would land in the youngest band
+                no_age += 1
+                continue
+            try:
+                genre_feature_key(user.gender, user.age, user.occupation or '')
+                valid.append(user)
+            except (KeyError, TypeError):
+                skipped += 1
 
-    input_features = prepare_data(age, occupation, gender, age_encoder, occupation_encoder, age_map)
-    predictions = model.predict(input_features)
-    predicted_genre_labels = [genre for genre, flag in zip(genre_columns, predictions[0]) if flag == 1]
+        genres = predict_genres_batch([(user.gender, user.age, user.occupation or '') for user in valid])
+        db.session.bulk_update_mappings(User, [
+            {'id': user.id, 'recommended_genre': ', '.join(user_genres)} for user, user_genres in zip(valid, genres)
+        ])
+        db.session.commit()
+        updated += len(valid)
 
-    # return jsonify({'predicted_genres': predicted_genre_labels})
-    return predicted_genre_labels
+    click.echo(f'Updated the recommended genres of {updated} users '
+               f'({skipped} skipped with unknown details, {no_age} skipped without an age).')
@@ -1,18 +1,23 @@
 from flask_smorest import Blueprint as ApiBlueprint
 from flaskr import db
-from flaskr.database_models import MovielensMovie, MovielensRating
-from sqlalchemy import func
+from flaskr.database_models import MovieGenre, MovieRatingStats, UserWatchHistory
 from flask import request, jsonify
-from marshmallow import Schema, fields
+from flask_jwt_extended import get_jwt_identity, jwt_required, verify_jwt_in_request
+from marshmallow import Schema, fields, validate
 
 from flaskr.decorators import cache_response
 from flaskr.services.data_preparation import get_movie_details
-from flaskr.services.recommandation_service import get_movie_recommendations
+from flaskr.services.genre_index import get_genre_index
+from flaskr.services.personalization import get_personalized_recommendations
+from flaskr.services.recommandation_service import get_blended_recommendations, get_movie_recommendations
 
 movies_recommendation_blueprint = ApiBlueprint('movies_recommendation', 'movies_recommendation',
                                                url_prefix='/movies_recommendation',
                                                description='Movie recommendation endpoints')
 
+# Upper bound on the recommendations of a single request, per input movie in separate mode
+MAX_RECOMMENDATIONS = 100
+
 
 class MovieRecommendationSchema(Schema):
     movie_input = fields.Raw(
@@ -20,14 +25,35 @@ class MovieRecommendationSchema(Schema):
     )
     top_n = fields.Integer(
         description="The number of top recommendations to return.",
-        default=10,
+        validate=validate.Range(min=1, max=MAX_RECOMMENDATIONS),
+        load_default=10,
+    )
+    genre = fields.String(
+        description="Only recommend movies of this genre.",
+    )
+    mode = fields.String(
+        description="'separate' for one list per input movie, 'blend' for a single list for all of them.",
+        validate=validate.OneOf(['separate', 'blend']),
+        load_default='separate',
+    )
+    weights = fields.List(
+        fields.Float(),
+        description="Blend mode only: one weight per input movie.",
+    )
+    exclude_movie_ids = fields.List(
+        fields.Integer(),
+        description="Blend mode only: movie IDs that must not be recommended.",
     )
 
 RADIS_CACHE_TIMEOUT = 100000
+# Minimum number of ratings for a movie to appear in the genre charts
+MIN_GENRE_RATING_COUNT = 50
+# Upper bound on the personalized recommendations of a single request
+MAX_PERSONALIZED_RESULTS = 100
 
 @movies_recommendation_blueprint.route('/recommend_movies', methods=['POST'])
 @movies_recommendation_blueprint.arguments(MovieRecommendationSchema)
-# @cache_response(timeout=RADIS_CACHE_TIMEOUT, persist=True)
+@cache_response(timeout=RADIS_CACHE_TIMEOUT, tags=('similarity',), vary_on_user=True)
 def recommend_movies(data):
     """
     Recommend movies based on the input movie(s).
@@ -47,8 +73,23 @@ def recommend_movies(data):
                 - description: A movie ID, movie name, or a list of movie IDs/names.
               - top_n:
                 - type: integer
-                - description: The number of top recommendations to return.
+                - description: The number of top recommendations to return, between 1 and 100.
                 - default: 10
+              - genre:
+                - type: string
+                - description: Only recommend movies of this genre.
+              - mode:
+                - type: string
+                - enum: [separate, blend]
+                - description: One list per input movie, or a single blended list. Blended lists exclude
+                    the movies the authenticated user has watched.
+                - default: separate
+              - weights:
+                - type: array
+                - description: Blend mode only, one weight per input movie.
+              - exclude_movie_ids:
+                - type: array
+                - description: Blend mode only, movie IDs that must not be recommended.
     responses:
       -200:
         description: A list of recommended movies.
@@ -88,19 +129,84 @@ def recommend_movies(data):
     """
     # data = request.json
     movie_input = data.get('movie_input')
-    top_n = data.get('top_n', 10)
+    top_n = data['top_n']
+    genre = data.get('genre')
+
+    if genre and genre not in get_genre_index():
+        return jsonify({"message": "Genre not found"}), 404
+
+    if data.get('mode') == 'blend':
+        exclude_movie_ids = list(data.get('exclude_movie_ids') or [])
 
-    recommendations_dict = get_movie_recommendations(movie_input, top_n)
+        # Leave out what the user has already watched, when the request is authenticated
+        verify_jwt_in_request(optional=True)
+        user_id = get_jwt_identity()
+        if user_id is not None:
+            exclude_movie_ids.extend(
+                movie_id for movie_id, in
+                db.session.query(UserWatchHistory.movie_id).filter(UserWatchHistory.user_id == user_id)
+            )
+
+        recommendations_dict = get_blended_recommendations(
+            movie_input, top_n, weights=data.get('weights'), exclude_movie_ids=exclude_movie_ids, genre=genre
+        )
+        if isinstance(recommendations_dict, str):
+            return jsonify({"message": recommendations_dict}), 400
+    else:
+        recommendations_dict = get_movie_recommendations(movie_input, top_n, genre=genre)
     print(f"Recommendations: {recommendations_dict}")
 
     return jsonify(recommendations_dict)
 
 
+@movies_recommendation_blueprint.route('/for_me', methods=['GET'])
+@jwt_required()
+@movies_recommendation_blueprint.doc(security=[{'bearerAuth': []}])
+def recommend_for_me():
+    """
+    Recommend movies for the authenticated user from their ratings and watch history.
+
+    ---
+    security:
+      - bearerAuth: []
+    parameters:
+      - name: top_n
+        in: query
+        required: false
+        schema:
+          type: integer
+          default: 10
+        description: The number of recommendations to return, between 1 and 100.
+      - name: engine
+        in: query
+        required: false
+        schema:
+          type: string
+          enum: [content, collaborative]
+          default: content
+        description: Rank by content similarity or with the collaborative filtering model.
+    responses:
+      200:
+        description: The recommended movies, excluding movies the user has rated or watched.
+      400:
+        description: Unknown engine
+      401:
+        description: Unauthorized access
+    """
+    user_id = get_jwt_identity()
+    top_n = min(max(request.args.get('top_n', 10, type=int), 1), MAX_PERSONALIZED_RESULTS)
+    engine = request.args.get('engine', 'content')
+    if engine not in ('content', 'collaborative'):
+        return jsonify({"message": "engine must be 'content' or 'collaborative'"}), 400
+
+    return jsonify(get_personalized_recommendations(user_id, top_n, engine))
+
+
 @movies_recommendation_blueprint.route('/<genre>/top_rated', methods=['GET'])
-# @cache_response(timeout=RADIS_CACHE_TIMEOUT, persist=True)
+@cache_response(timeout=RADIS_CACHE_TIMEOUT, persist=True, tags=('ratings',))
 def get_top_movies(genre):
     """
-    Get top 10 movies for a given genre by average rating and number of ratings.
+    Get top 10 movies for a given genre by Bayesian-weighted rating and number of ratings.
 
     ---
     parameters:
@@ -116,34 +222,25 @@ def get_top_movies(genre):
       404:
         description: Genre not found.
     """
-    genre = genre.lower()  # Normalize genre input to lowercase
-
-    # Query movies of the specified genre
-    movies_in_genre = MovielensMovie.query.filter(
-        MovielensMovie.genres.ilike(f'%{genre}%')
-    ).all()
-
-    if not movies_in_genre:
+    # Resolve the genre in memory (case-insensitive)
+    genre_id = get_genre_index().genre_id(genre)
+    if genre_id is None:
         return jsonify({"message": "Genre not found"}), 404
 
-    movie_ids = [movie.movie_id for movie in movies_in_genre]
-
-    # Calculate average rating and count of ratings for each movie
-    ratings_agg = (db.session.query(
-        MovielensRating.movie_id,
-        func.avg(MovielensRating.rating).label('avg_rating'),
-        func.count(MovielensRating.rating).label('rating_count')
+    # Read the precomputed aggregates of the movies in the genre with enough ratings
+    ratings_agg = db.session.query(
+        MovieRatingStats.movie_id,
+        MovieRatingStats.rating_mean.label('avg_rating'),
+        MovieRatingStats.rating_count
+    ).join(
+        MovieGenre, MovieGenre.movie_id == MovieRatingStats.movie_id
     ).filter(
-        MovielensRating.movie_id.in_(movie_ids)
-    ).group_by(
-        MovielensRating.movie_id
-    ).having(
-        func.count(MovielensRating.rating) > 50
-    ).all())
+        MovieGenre.genre_id == genre_id,
+        MovieRatingStats.rating_count > MIN_GENRE_RATING_COUNT
+    )
 
-    # Sort by average rating and number of ratings
-    top_rated_movies = sorted(ratings_agg, key=lambda x: x.avg_rating, reverse=True)[:10]
-    most_rated_movies = sorted(ratings_agg, key=lambda x: x.rating_count, reverse=True)[:10]
+    top_rated_movies = ratings_agg.order_by(MovieRatingStats.weighted_score.desc()).limit(10).all()
+    most_rated_movies = ratings_agg.order_by(MovieRatingStats.rating_count.desc()).limit(10).all()
 
     # Retrieve movie details
     top_rated_details = get_movie_details(top_rated_movies)
@@ -156,28 +253,25 @@ def get_top_movies(genre):
 
 
 @movies_recommendation_blueprint.route('/popular', methods=['GET'])
-@cache_response(timeout=RADIS_CACHE_TIMEOUT, persist=True)
+@cache_response(timeout=RADIS_CACHE_TIMEOUT, persist=True, tags=('ratings',))
 def get_popular_movies():
     """
-    Get top 50 movies by average rating and top 50 movies by the number of ratings across all genres.
+    Get top 50 movies by Bayesian-weighted rating and top 50 movies by the number of ratings across all genres.
 
     ---
     responses:
       200:
         description: A list of popular movies.
     """
-    # Calculate average rating and count of ratings for each movie
+    # Read the precomputed aggregates, ordered through their indexes
     ratings_agg = db.session.query(
-        MovielensRating.movie_id,
-        func.avg(MovielensRating.rating).label('avg_rating'),
-        func.count(MovielensRating.rating).label('rating_count')
-    ).group_by(
-        MovielensRating.movie_id
-    ).all()
-
-    # Sort by average rating and number of ratings
-    top_rated_movies = sorted(ratings_agg, key=lambda x: x.avg_rating, reverse=True)[:50]
-    most_rated_movies = sorted(ratings_agg, key=lambda x: x.rating_count, reverse=True)[:50]
+        MovieRatingStats.movie_id,
+        MovieRatingStats.rating_mean.label('avg_rating'),
+        MovieRatingStats.rating_count
+    )
+
+    top_rated_movies = ratings_agg.order_by(MovieRatingStats.weighted_score.desc()).limit(50).all()
+    most_rated_movies = ratings_agg.order_by(MovieRatingStats.rating_count.desc()).limit(50).all()
 
     # Retrieve movie details
     top_rated_details = get_movie_details(top_rated_movies)
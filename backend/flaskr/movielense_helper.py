@@ -1,12 +1,15 @@
 import os
-from datetime import datetime
 
 import pandas as pd
+from flask import current_app, jsonify
 from flask_smorest import Blueprint as ApiBlueprint
-from flaskr import db, pin_required
+from flaskr import pin_required
 from marshmallow import Schema, fields
 
-from flaskr.database_models import MovielensMovie, MovielensRating
+from flaskr.services.ingestion import ingest_movies, ingest_ratings
+from flaskr.services.jobs import job_runner
+from flaskr.services.resources import LazyResource
+from flaskr.services.similarity_builder import update_similarity
 
 movielense_helper_blueprint = ApiBlueprint('movielense_helper', 'movielense_helper', url_prefix='/movielense_helper')
 
@@ -15,73 +18,105 @@ base_dir = os.path.abspath(os.path.dirname(__file__))
 # base file path for machine learning models
 base_path = os.path.join(base_dir, '../../machine_learning/')
 
-# Load data
-links = pd.read_csv(base_path + 'data/raw/ml-25m/links.csv')
-movies_ml_25m = pd.read_csv(base_path + 'data/raw/ml-25m/movies.csv')
+# Load data on first use
+links = LazyResource('movielens_links', lambda: pd.read_csv(base_path + 'data/raw/ml-25m/links.csv'))
+movies_ml_25m = LazyResource('movielens_movies', lambda: pd.read_csv(base_path + 'data/raw/ml-25m/movies.csv'))
 ratings_ml_25m_path = (base_path + 'data/raw/ml-25m/ratings.csv')
 
-# Define the batch size for processing ratings data
-BATCH_SIZE = 100000
-
 
 # Define your schema for headers
 class HeaderSchema(Schema):
     pin = fields.String(required=True)
 
 
+def run_populate_tables(job, movies, ratings, links):
+    """
+    Body of the populate_tables background job.
+    """
+    job.report(phase='movies')
+    ingest_movies(movies.get(), links.get())
+
+    # Give movies added to the catalog their similarity rows, if a versioned matrix is served. A TF-IDF
+    # refit is a full process pool rebuild, left to `flask rebuild-similarity` rather than this web worker
+    job.report(phase='similarity')
+    update_similarity(allow_refit=False, log=current_app.logger.info)
+
+    job.report(phase='ratings')
+    ingest_ratings(ratings, progress=lambda rows_loaded: job.report(rows_processed=rows_loaded))
+
+    job.report(phase='done')
+
+
 @movielense_helper_blueprint.route('/populate_tables', methods=['POST'])
 @movielense_helper_blueprint.arguments(schema=HeaderSchema)
 @pin_required
-def populate_tables(movies=movies_ml_25m, ratings=ratings_ml_25m_path, links=links):
+def populate_tables(data, movies=movies_ml_25m, ratings=ratings_ml_25m_path, links=links):
     """
-    Populate the tables with movie and rating data.
+    Populate the tables with movie and rating data in a background job.
+
+    Submitting while an import is queued or running returns the existing job.
 
     ---
     tags:
       - Movielense Helper
     parameters:
       - pin: "string"
+    responses:
+      202:
+        description: Import job accepted. Poll /movielense_helper/jobs/<job_id> for its status.
+      401:
+        description: Unauthorized. Invalid or missing PIN.
+    """
+    job, created = job_runner.submit('populate_tables', run_populate_tables, movies, ratings, links)
+    message = 'Import started.' if created else 'Import already in progress.'
+
+    return jsonify({'message': message, **job.to_dict()}), 202
+
+
+@movielense_helper_blueprint.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """
+    Get the status of a background job: phase, rows processed and throughput.
+
+    ---
+    tags:
+      - Movielense Helper
     responses:
       200:
-        description: Tables populated successfully.
+        description: The job status.
+      404:
+        description: Job not found.
+    """
+    job = job_runner.get(job_id)
+    if job is None:
+        return jsonify({"message": "Job not found"}), 404
+
+    return jsonify(job.to_dict())
+
+
+@movielense_helper_blueprint.route('/jobs/<job_id>/cancel', methods=['POST'])
+@movielense_helper_blueprint.arguments(schema=HeaderSchema)
+@pin_required
+def cancel_job(data, job_id):
+    """
+    Cancel a background job. The import stops after its current batch and can be resumed later.
+
+    ---
+    tags:
+      - Movielense Helper
+    parameters:
+      - pin: "string"
+    responses:
+      202:
+        description: Cancellation requested.
       401:
         description: Unauthorized. Invalid or missing PIN.
+      404:
+        description: Job not found.
     """
-    # Load CSV data
-    movies_df = movies_ml_25m
-    ratings_path = ratings
-    links_df = links
-
-    # Merge movies with links on movieId
-    movies_with_links_df = movies_df.merge(links_df, on='movieId', how='left')
-
-    # Check if tables are empty before inserting data
-    if MovielensMovie.query.count() == 0:
-        # Prepare movie data
-        movie_data = movies_with_links_df[['movieId', 'title', 'genres', 'tmdbId', 'imdbId']].rename(columns={
-            'movieId': 'movie_id',
-            'title': 'movie_name',
-            'tmdbId': 'tmdb_id',
-            'imdbId': 'imdb_id'
-        })
-
-        # Insert movies into the database
-        db.session.bulk_insert_mappings(MovielensMovie, movie_data.to_dict(orient='records'))
-        db.session.commit()
-
-    if MovielensRating.query.count() == 0:
-        # Process ratings data in chunks
-        for chunk in pd.read_csv(ratings_path, chunksize=BATCH_SIZE):
-            # Convert the timestamp to datetime
-            chunk['timestamp'] = chunk['timestamp'].apply(lambda x: datetime.fromtimestamp(x))
-            # Prepare the chunk of ratings data
-            rating_data_chunk = chunk.rename(columns={
-                'movieId': 'movie_id',
-                'userId': 'movielens_user_id'
-            })
-
-            # Insert the chunk of ratings into the database
-            db.session.bulk_insert_mappings(MovielensRating, rating_data_chunk.to_dict(orient='records'))
-            db.session.commit()
-
-    return {'message': 'Tables populated successfully.'}
\ No newline at end of file
+    job = job_runner.get(job_id)
+    if job is None:
+        return jsonify({"message": "Job not found"}), 404
+
+    job.cancel()
+    return jsonify({'message': 'Cancellation requested.', **job.to_dict()}), 202
@@ -0,0 +1,236 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# SQL statements kept per profile, and their maximum length
+MAX_PROFILE_STATEMENTS = 200
+MAX_STATEMENT_LENGTH = 2000
+# Functions listed in a cProfile report
+PROFILE_REPORT_LINES = 40
+# Distinct stacks kept in a sampled profile, and their maximum depth
+MAX_PROFILE_STACKS = 50
+MAX_STACK_DEPTH = 64
+
+
+class ProfileBuffer:
+    """
+    The last ``size`` profiles of the process, newest first.
+    """
+
+    def __init__(self, size):
+        self._profiles = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def resize(self, size):
+        with self._lock:
+            self._profiles = deque(self._profiles, maxlen=size)
+
+    def add(self, profile):
+        with self._lock:
+            self._profiles.appendleft(profile)
+
+    def list(self):
+        with self._lock:
+            return list(self._profiles)
+
+    def get(self, profile_id):
+        with self._lock:
+            return next((profile for profile in self._profiles if profile['id'] == profile_id), None)
+
+
+class StackSampler:
+    """
+    Sample the stacks of the threads serving requests, from a single background thread.
+
+    The thread only wakes up while requests are tracked, every ``interval`` seconds, and reads the
+    current frame of every tracked thread with ``sys._current_frames()``. Tracked requests do not run
+    any profiling code themselves.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+
+    def track(self, thread_id):
+        self._ensure_thread()
+        with self._lock:
+            self._active[thread_id] = Counter()
+            self._wake.set()
+
+    def untrack(self, thread_id):
+        """
+        Stop sampling a thread.
+
+        Returns:
+            Counter: The number of samples of every stack of ``(code, line)`` pairs, innermost frame first.
+        """
+        with self._lock:
+            return self._active.pop(thread_id, Counter())
+
+    def _ensure_thread(self):
+        # One sampler thread per process, also in forked gunicorn workers
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='profile-sampler', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[_stack(frame)] += 1
+                if not self._active:
+                    self._wake.clear()
+            del frames
+            time.sleep(self.interval)
+
+
+def _stack(frame):
+    # Raw (code, line) pairs, innermost first: formatting is left to the few requests that are kept
+    stack = []
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        stack.append((frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    return tuple(stack)
+
+
+def _format_frame(code, lineno):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{lineno})"
+
+
+def _collapsed_stacks(samples):
+    """
+    Format stack samples like flame graph tools expect: ``outer;...;inner count`` per line.
+    """
+    return '\n'.join(
+        f"{';'.join(_format_frame(code, lineno) for code, lineno in reversed(stack))} {count}"
+        for stack, count in samples.most_common(MAX_PROFILE_STACKS)
+    )
+
+
+def _cprofile_report(profiler):
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_REPORT_LINES)
+    return output.getvalue()
+
+
+profile_buffer = ProfileBuffer(20)
+_sampler = None
+_threshold = 0.0
+_sample_rate = 0.0
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'profile_sql' in g:
+        conn.info.setdefault('profile_query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('profile_query_started')
+    if not started or not has_request_context() or 'profile_sql' not in g:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    g.profile_sql_count += 1
+    g.profile_sql_seconds += elapsed
+    if len(g.profile_sql) < MAX_PROFILE_STATEMENTS:
+        g.profile_sql.append({'statement': statement[:MAX_STATEMENT_LENGTH], 'seconds': round(elapsed, 6)})
+
+
+def _before_request():
+    g.profile_started = time.perf_counter()
+    g.profile_sql = []
+    g.profile_sql_count = 0
+    g.profile_sql_seconds = 0.0
+
+    if _sample_rate and random.random() < _sample_rate:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+    elif _threshold:
+        _sampler.track(threading.get_ident())
+
+
+def _after_request(response):
+    g.profile_status = response.status_code
+    return response
+
+
+def _teardown_request(exc):
+    if 'profile_started' not in g:
+        return
+    duration = time.perf_counter() - g.profile_started
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        trigger, kind, report = 'sampled', 'cprofile', _cprofile_report(profiler)
+    elif _threshold:
+        samples = _sampler.untrack(threading.get_ident())
+        if duration < _threshold:
+            return
+        trigger, kind, report = 'slow', 'stack', _collapsed_stacks(samples)
+    else:
+        return
+
+    profile_buffer.add({
+        'id': uuid.uuid4().hex,
+        'started_at': datetime.utcnow().isoformat(),
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.url_rule.rule if request.url_rule is not None else None,
+        'status': g.get('profile_status', 500),
+        'duration': round(duration, 6),
+        'trigger': trigger,
+        'profiler': kind,
+        'sql_count': g.profile_sql_count,
+        'sql_seconds': round(g.profile_sql_seconds, 6),
+        'sql': g.profile_sql,
+        'report': report,
+    })
+
+
+def init_profiling(app):
+    """
+    Profile slow requests and a sampled fraction of all requests, if ``PROFILING_ENABLED`` is set.
+
+    Requests slower than ``PROFILE_SLOW_THRESHOLD`` seconds keep the stack samples taken every
+    ``PROFILE_SAMPLE_INTERVAL`` seconds while they ran. A ``PROFILE_SAMPLE_RATE`` fraction of requests
+    runs under cProfile instead. Both keep the SQL statements of the request, and the last
+    ``PROFILE_BUFFER_SIZE`` profiles are served by the profiling blueprint.
+    """
+    global _sampler, _threshold, _sample_rate
+
+    profile_buffer.resize(app.config['PROFILE_BUFFER_SIZE'])
+    if not app.config['PROFILING_ENABLED']:
+        return
+
+    _threshold = app.config['PROFILE_SLOW_THRESHOLD']
+    _sample_rate = app.config['PROFILE_SAMPLE_RATE']
+    _sampler = StackSampler(app.config['PROFILE_SAMPLE_INTERVAL'])
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
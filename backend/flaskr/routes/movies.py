@@ -0,0 +1,60 @@
+from flask import jsonify, request
+from flask_smorest import Blueprint as ApiBlueprint
+
+from flaskr.services.title_index import get_title_index
+
+movies_blueprint = ApiBlueprint('movies', 'movies', url_prefix='/movies', description='Movie catalog endpoints')
+
+# Upper bound on the results of a single search
+MAX_SEARCH_RESULTS = 50
+
+
+@movies_blueprint.route('/search', methods=['GET'])
+def search_movies():
+    """
+    Search movies by title, best match first.
+
+    Served from an in-memory title index, so it is fast enough for typeahead. When no title contains
+    the words of the query, typo-tolerant matches are returned instead, with their confidence.
+
+    ---
+    parameters:
+      - name: q
+        in: query
+        required: true
+        schema:
+          type: string
+        description: The title to look for, optionally with a year, e.g. "toy story 1995".
+      - name: limit
+        in: query
+        required: false
+        schema:
+          type: integer
+          default: 10
+        description: The maximum number of results.
+      - name: prefix
+        in: query
+        required: false
+        schema:
+          type: boolean
+          default: true
+        description: Match the last word as a prefix, for typeahead.
+    responses:
+      200:
+        description: The matching movies with their title, year, genres and score.
+      400:
+        description: Missing query
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"message": "The q parameter is required"}), 400
+
+    limit = min(max(request.args.get('limit', 10, type=int), 1), MAX_SEARCH_RESULTS)
+    prefix = request.args.get('prefix', 'true').lower() not in ('0', 'false', 'no')
+
+    title_index = get_title_index()
+    results = title_index.search(query, limit=limit, prefix=prefix)
+    if not results:
+        results = title_index.resolve(query, limit=limit)
+
+    return jsonify({'query': query, 'results': results})
@@ -0,0 +1,67 @@
+from flask import jsonify
+from flask_smorest import Blueprint as ApiBlueprint
+from marshmallow import Schema, fields
+
+from flaskr import pin_required
+from flaskr.profiling import profile_buffer
+
+profiling_blueprint = ApiBlueprint('profiling', 'profiling', url_prefix='/profiling',
+                                   description='Profiles of slow and sampled requests')
+
+# Fields of a profile listed without its SQL log and report
+SUMMARY_FIELDS = ('id', 'started_at', 'method', 'path', 'endpoint', 'status', 'duration', 'trigger', 'profiler',
+                  'sql_count', 'sql_seconds')
+
+
+class PinSchema(Schema):
+    pin = fields.String(required=True)
+
+
+@profiling_blueprint.route('/profiles', methods=['POST'])
+@profiling_blueprint.arguments(schema=PinSchema)
+@pin_required
+def list_profiles(data):
+    """
+    List the profiles kept by the worker answering the request, newest first.
+
+    ---
+    tags:
+      - Profiling
+    parameters:
+      - pin: "string"
+    responses:
+      200:
+        description: The profile summaries, without their SQL log and report.
+      401:
+        description: Unauthorized. Invalid or missing PIN.
+    """
+    return jsonify({
+        'profiles': [{field: profile[field] for field in SUMMARY_FIELDS} for profile in profile_buffer.list()],
+    })
+
+
+@profiling_blueprint.route('/profiles/<profile_id>', methods=['POST'])
+@profiling_blueprint.arguments(schema=PinSchema)
+@pin_required
+def get_profile(data, profile_id):
+    """
+    Get a profile with its SQL statements and its cProfile report or collapsed stack samples.
+
+    ---
+    tags:
+      - Profiling
+    parameters:
+      - pin: "string"
+    responses:
+      200:
+        description: The profile.
+      401:
+        description: Unauthorized. Invalid or missing PIN.
+      404:
+        description: Profile not found, or already dropped from the buffer.
+    """
+    profile = profile_buffer.get(profile_id)
+    if profile is None:
+        return jsonify({"message": "Profile not found"}), 404
+
+    return jsonify(profile)
@@ -10,9 +10,8 @@ from flaskr.schema import UserInfoSchema, UserWatchlistSchema, UserRatingSchema,
     UserReviewSchema
 import logging
 from flaskr.services.data_preparation import get_movie_details
+from flaskr.services.personalization import invalidate_user_recommendations
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 user_info_blueprint = ApiBlueprint('user_info', __name__, url_prefix='/user')
@@ -241,6 +240,7 @@ def manage_ratings():
             db.session.add(rating_entry)
 
         db.session.commit()
+        invalidate_user_recommendations(user_id)
         return jsonify({"message": "Rating added/updated"}), 201
 
     if request.method == 'PUT':
@@ -255,6 +255,7 @@ def manage_ratings():
 
         rating_entry.rating = rating_value
         db.session.commit()
+        invalidate_user_recommendations(user_id)
         return jsonify({"message": "Rating updated"}), 200
 
 
@@ -269,6 +270,7 @@ def delete_rating(movie_id):
 
     db.session.delete(rating_entry)
     db.session.commit()
+    invalidate_user_recommendations(user_id)
     return jsonify({"message": "Rating deleted"}), 200
 
 
@@ -354,6 +356,7 @@ def manage_watch_history():
         watch_history_entry = UserWatchHistory(user_id=user_id, movie_id=movie_id)
         db.session.add(watch_history_entry)
         db.session.commit()
+        invalidate_user_recommendations(user_id)
         return jsonify({"message": "Movie marked as watched"}), 201
 
 
@@ -368,4 +371,5 @@ def delete_from_watch_history(movie_id):
 
     db.session.delete(watch_history_entry)
     db.session.commit()
+    invalidate_user_recommendations(user_id)
     return jsonify({"message": "Movie removed from watch history"}), 200
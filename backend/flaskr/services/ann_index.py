@@ -0,0 +1,317 @@
+import json
+import os
+import time
+from datetime import datetime
+
+import click
+import numpy as np
+from flask.cli import with_appcontext
+
+from flaskr.services.movie_index import MovieIndex
+from flaskr.services.resources import LazyResource
+
+# Construct the absolute path
+base_dir = os.path.abspath(os.path.dirname(__file__))
+# base file path for machine learning models
+base_path = os.path.join(base_dir, '../../../machine_learning/models/')
+ann_index_path = os.path.join(base_path, 'ann_index')
+
+# Number of inverted lists scanned per query unless overridden: higher is slower but more accurate
+ANN_NPROBE = int(os.getenv('ANN_NPROBE', 8))
+# Rows scored against the centroids at once while assigning vectors to lists
+ASSIGN_CHUNK_SIZE = 65536
+
+
+def _assign(vectors, centroids):
+    """
+    Get the index of the best-scoring centroid of every vector, in chunks to bound memory.
+    """
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_CHUNK_SIZE):
+        assignments[start:start + ASSIGN_CHUNK_SIZE] = np.argmax(
+            vectors[start:start + ASSIGN_CHUNK_SIZE] @ centroids.T, axis=1
+        )
+    return assignments
+
+
+def train_centroids(vectors, n_lists, iterations=20, sample_size=100000, seed=0):
+    """
+    Cluster vectors with spherical k-means: centroids are kept unit-length and vectors join the
+    centroid with the highest inner product.
+
+    Args:
+        vectors (np.ndarray): The item vectors.
+        n_lists (int): The number of clusters.
+        iterations (int): The number of k-means iterations.
+        sample_size (int): Train on at most this many randomly sampled vectors.
+        seed (int): The random seed.
+
+    Returns:
+        np.ndarray: The float32 centroids.
+    """
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)],
+                        dtype=np.float32)
+    n_lists = min(n_lists, len(sample))
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+        assignments = _assign(sample, centroids)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=n_lists)
+
+        # Reseed empty clusters on random vectors so that no list ends up unused
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        centroids = sums
+
+    centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file index answering "nearest items to a vector" by scanning a few clusters only.
+
+    Vectors are stored grouped by cluster, so that list ``l`` is the contiguous slice
+    ``vectors[offsets[l]:offsets[l + 1]]``, and ``rows`` maps every stored vector back to its item row.
+    Scores are inner products, i.e. cosine similarities for unit-length vectors.
+    """
+
+    def __init__(self, centroids, offsets, rows, vectors, movie_ids, source=None, nprobe=ANN_NPROBE,
+                 model_fingerprint=None):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+        self.vectors = vectors
+        self.movie_index = MovieIndex(movie_ids)
+        self.source = source
+        self.nprobe = nprobe
+        # Fingerprint of the factor model the 'collaborative' vectors were taken from
+        self.model_fingerprint = model_fingerprint
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def search(self, query, top_n=10, nprobe=None, exclude_rows=None):
+        """
+        Find the items with the highest inner product with a query vector.
+
+        When excluded rows leave fewer than ``top_n`` candidates in the scanned lists, the next lists by
+        centroid score are scanned too, until ``top_n`` candidates remain or every list is scanned.
+
+        Args:
+            query (np.ndarray): The query vector.
+            top_n (int): The number of items to return.
+            nprobe (int): The number of lists to scan, the index default if not given.
+            exclude_rows (np.ndarray): Item rows that must not be returned.
+
+        Returns:
+            tuple: The item rows and their scores, best first.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        probe_order = np.argsort(-(self.centroids @ query), kind='stable')
+
+        row_parts, score_parts = [], []
+        found, scanned = 0, 0
+        while True:
+            for probe in probe_order[scanned:nprobe]:
+                rows = np.asarray(self.rows[self.offsets[probe]:self.offsets[probe + 1]])
+                scores = np.asarray(self.vectors[self.offsets[probe]:self.offsets[probe + 1]]) @ query
+                if exclude_rows is not None and len(exclude_rows):
+                    keep = ~np.isin(rows, exclude_rows)
+                    rows, scores = rows[keep], scores[keep]
+                row_parts.append(rows)
+                score_parts.append(scores)
+                found += len(rows)
+            scanned = nprobe
+            if found >= top_n or nprobe == self.n_lists:
+                break
+            nprobe = min(2 * nprobe, self.n_lists)
+
+        rows, scores = np.concatenate(row_parts), np.concatenate(score_parts)
+        top_n = min(top_n, len(scores))
+        if not top_n:
+            return rows[:0], scores[:0]
+        top = np.argpartition(-scores, top_n - 1)[:top_n]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return rows[top], scores[top]
+
+    def search_movie_ids(self, query, top_n=10, nprobe=None, exclude_movie_ids=None):
+        """
+        Same as :meth:`search`, with movie IDs instead of item rows.
+        """
+        exclude_rows = None
+        if exclude_movie_ids:
+            exclude_rows = self.movie_index.indices_of(exclude_movie_ids)
+            exclude_rows = exclude_rows[exclude_rows >= 0]
+        rows, _ = self.search(query, top_n=top_n, nprobe=nprobe, exclude_rows=exclude_rows)
+        return self.movie_index.movie_ids_of(rows)
+
+
+def brute_force_search(vectors, query, top_n=10):
+    """
+    Exact top-N inner product search over every vector, the baseline of the IVF index.
+    """
+    scores = np.asarray(vectors) @ np.asarray(query, dtype=np.float32)
+    top_n = min(top_n, len(scores))
+    top = np.argpartition(-scores, top_n - 1)[:top_n]
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return top, scores[top]
+
+
+def build_ivf_index(vectors, movie_ids, n_lists=None, iterations=20, source=None, nprobe=ANN_NPROBE,
+                    model_fingerprint=None):
+    """
+    Cluster item vectors and group them into inverted lists.
+
+    Args:
+        vectors (np.ndarray): The item vectors, one row per movie.
+        movie_ids (np.ndarray): The movie ID of every row.
+        n_lists (int): The number of lists, ``4 * sqrt(n)`` by default.
+        iterations (int): The number of k-means iterations.
+        source (str): Where the vectors come from, stored with the index.
+        nprobe (int): The default number of lists scanned per query.
+        model_fingerprint (str): The fingerprint of the factor model the vectors come from, if any.
+
+    Returns:
+        IVFIndex: The in-memory index.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    n_lists = n_lists or max(1, int(4 * np.sqrt(len(vectors))))
+
+    centroids = train_centroids(vectors, n_lists, iterations=iterations)
+    assignments = _assign(vectors, centroids)
+
+    rows = np.argsort(assignments, kind='stable').astype(np.int32)
+    offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignments, minlength=len(centroids)), out=offsets[1:])
+
+    return IVFIndex(centroids, offsets, rows, vectors[rows], movie_ids, source=source, nprobe=nprobe,
+                    model_fingerprint=model_fingerprint)
+
+
+def _replace_file(path, write):
+    # Written next to the target and renamed over it: workers mapping the old file keep reading it
+    with open(path + '.tmp', 'wb') as f:
+        write(f)
+    os.replace(path + '.tmp', path)
+
+
+def save_ivf_index(index, path=ann_index_path):
+    """
+    Save an index, replacing every file atomically and meta.json last, so that workers reload a
+    complete index once its version changes.
+    """
+    os.makedirs(path, exist_ok=True)
+    arrays = {
+        'centroids.npy': index.centroids,
+        'offsets.npy': index.offsets,
+        'rows.npy': index.rows,
+        'vectors.npy': index.vectors,
+        'movie_ids.npy': index.movie_index.movie_ids,
+    }
+    for name, array in arrays.items():
+        _replace_file(os.path.join(path, name), lambda f, array=array: np.save(f, array))
+    meta = {
+        'source': index.source,
+        'n_lists': index.n_lists,
+        'dim': int(index.vectors.shape[1]),
+        'size': len(index),
+        'model_fingerprint': index.model_fingerprint,
+        'built_at': datetime.utcnow().isoformat(),
+    }
+    _replace_file(os.path.join(path, 'meta.json'), lambda f: f.write(json.dumps(meta).encode()))
+
+
+def load_ivf_index(path=ann_index_path):
+    """
+    Memory-map an index saved by :func:`save_ivf_index`.
+
+    Returns:
+        IVFIndex: The index, or None if it has not been built.
+    """
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return None
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    return IVFIndex(
+        np.load(os.path.join(path, 'centroids.npy')),
+        np.load(os.path.join(path, 'offsets.npy')),
+        np.load(os.path.join(path, 'rows.npy'), mmap_mode='r'),
+        np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r'),
+        np.load(os.path.join(path, 'movie_ids.npy')),
+        source=meta['source'],
+        model_fingerprint=meta.get('model_fingerprint'),
+    )
+
+
+def ann_index_version(path=ann_index_path):
+    """
+    Get a cheap token that changes whenever a new index is saved, in any process.
+    """
+    try:
+        return os.stat(os.path.join(path, 'meta.json')).st_mtime_ns
+    except OSError:
+        return None
+
+
+# Load the index on first use, and again in every worker whenever build-ann-index saves a new one
+ann_index = LazyResource('ann_index', load_ivf_index, version=ann_index_version)
+
+
+def load_item_vectors(source, dim=128):
+    """
+    Get the item vectors an index is built over.
+
+    Args:
+        source (str): 'tfidf' for SVD-reduced TF-IDF embeddings of genres and tags, 'collaborative'
+            for the item factors of the trained matrix factorization model.
+        dim (int): The embedding size of the 'tfidf' source.
+
+    Returns:
+        tuple: The vectors, the movie ID of every row and the fingerprint of the factor model they come
+        from, or None.
+    """
+    if source == 'collaborative':
+        from flaskr.services.collaborative_filtering import load_factor_model
+
+        model = load_factor_model()
+        if model is None:
+            raise click.ClickException('The collaborative filtering model has not been trained, run "flask train-cf".')
+        return np.asarray(model.item_factors), model.item_index.movie_ids, model.fingerprint
+
+    from flaskr.services.item_features import build_item_embeddings, build_tfidf_matrix, load_movie_documents
+
+    movie_ids, documents = load_movie_documents()
+    _, tfidf_matrix = build_tfidf_matrix(documents)
+    return build_item_embeddings(tfidf_matrix, dim=dim), movie_ids, None
+
+
+@click.command('build-ann-index')
+@click.option('--source', type=click.Choice(['tfidf', 'collaborative']), default='collaborative', show_default=True,
+              help='Index the collaborative filtering item factors, which /for_me queries, or TF-IDF/SVD '
+                   'embeddings, which only the recall benchmark reads.')
+@click.option('--dim', default=128, show_default=True, help='Embedding size of the tfidf source.')
+@click.option('--lists', type=int, default=None, help='Number of inverted lists, 4 * sqrt(n) by default.')
+@click.option('--iterations', default=20, show_default=True, help='Number of k-means iterations.')
+@with_appcontext
+def build_ann_index_command(source, dim, lists, iterations):
+    """Build the approximate nearest-neighbor index over item vectors."""
+    started = time.monotonic()
+    vectors, movie_ids, model_fingerprint = load_item_vectors(source, dim=dim)
+    index = build_ivf_index(vectors, movie_ids, n_lists=lists, iterations=iterations, source=source,
+                            model_fingerprint=model_fingerprint)
+    save_ivf_index(index)
+    ann_index.reset()
+    click.echo(f'Built {index.n_lists}-list index over {len(index)} {source} vectors in '
+               f'{time.monotonic() - started:.1f}s ({ann_index_path}).')
@@ -0,0 +1,63 @@
+import os
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+from flaskr.services.redis_pool import get_redis_client
+
+# Redis key of the catalog version, bumped whenever the movie, genre or rating stats tables are rebuilt
+CATALOG_VERSION_KEY = 'catalog_version'
+# Seconds a process trusts the version it last read before asking Redis again
+CATALOG_VERSION_TTL = float(os.getenv('CATALOG_VERSION_TTL', 1))
+
+_version = None
+_checked_at = None
+_lock = threading.Lock()
+
+
+def catalog_version_token():
+    """
+    Get a cheap token that changes whenever any process repopulates or rebuilds the catalog tables.
+
+    The version is read from Redis at most every ``CATALOG_VERSION_TTL`` seconds. While Redis is
+    unavailable, the last version read is kept, so the in-memory indexes are not reloaded on every call.
+
+    Returns:
+        str: The version, or None if it has never been bumped.
+    """
+    global _version, _checked_at
+
+    checked_at = _checked_at
+    if checked_at is not None and time.monotonic() - checked_at < CATALOG_VERSION_TTL:
+        return _version
+
+    with _lock:
+        if _checked_at is checked_at:
+            try:
+                _version = get_redis_client().get(CATALOG_VERSION_KEY)
+            except RedisError as e:
+                print(f"Could not read the catalog version: {e}")
+            _checked_at = time.monotonic()
+        return _version
+
+
+def bump_catalog_version():
+    """
+    Make every worker reload its catalog indexes on next use.
+
+    Call it once the change to the catalog tables is committed, so no worker reloads before it can see
+    the new rows. The calling process sees the new version at once.
+    """
+    global _version, _checked_at
+
+    try:
+        version = get_redis_client().incr(CATALOG_VERSION_KEY)
+    except RedisError as e:
+        # Only this process drops its indexes, through their own invalidate function
+        print(f"Could not publish the new catalog version: {e}")
+        return
+
+    with _lock:
+        _version = str(version)
+        _checked_at = time.monotonic()
@@ -0,0 +1,326 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import click
+import numpy as np
+import pandas as pd
+from flask.cli import with_appcontext
+from scipy.sparse import csr_matrix
+
+from flaskr import db
+from flaskr.database_models import MovielensRating
+from flaskr.services.movie_index import MovieIndex
+from flaskr.services.resources import LazyResource
+
+# Construct the absolute path
+base_dir = os.path.abspath(os.path.dirname(__file__))
+# base file path for machine learning models
+base_path = os.path.join(base_dir, '../../../machine_learning/models/')
+cf_model_path = os.path.join(base_path, 'collaborative_filtering')
+ratings_csv_path = os.path.join(base_dir, '../../../machine_learning/data/raw/ml-25m/ratings.csv')
+
+DEFAULT_FACTORS = 64
+DEFAULT_ITERATIONS = 10
+DEFAULT_REGULARIZATION = 0.1
+# Upper bound in bytes on the working arrays of a block of rows; every worker thread holds one
+BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def load_rating_matrix(source='csv'):
+    """
+    Load the MovieLens ratings as a sparse users x items matrix.
+
+    Args:
+        source (str): 'csv' to read ratings.csv, 'db' to read the movielens_ratings table.
+
+    Returns:
+        tuple: The ratings csr_matrix (float32), the MovieLens user IDs of its rows and the movie IDs of its columns.
+    """
+    if source == 'db':
+        ratings = pd.read_sql(
+            db.session.query(MovielensRating.movielens_user_id, MovielensRating.movie_id, MovielensRating.rating)
+            .statement, db.engine
+        ).rename(columns={'movielens_user_id': 'userId', 'movie_id': 'movieId'})
+    else:
+        ratings = pd.read_csv(ratings_csv_path, usecols=['userId', 'movieId', 'rating'],
+                              dtype={'userId': np.int32, 'movieId': np.int32, 'rating': np.float32})
+
+    user_ids, user_rows = np.unique(ratings['userId'].to_numpy(), return_inverse=True)
+    item_ids, item_columns = np.unique(ratings['movieId'].to_numpy(), return_inverse=True)
+    matrix = csr_matrix(
+        (ratings['rating'].to_numpy(dtype=np.float32), (user_rows, item_columns)),
+        shape=(len(user_ids), len(item_ids)),
+    )
+    return matrix, user_ids, item_ids
+
+
+def _block_nnz(n_factors, block_bytes=BLOCK_BYTES):
+    """
+    Get the number of ratings per block whose working arrays fit in ``block_bytes``.
+
+    Every rating takes an ``n_factors x n_factors`` float32 outer product and, at worst when every row
+    of the block holds a single rating, a float32 Gram matrix reduced from it and its float64 copy.
+    """
+    bytes_per_rating = n_factors * n_factors * (2 * np.dtype(np.float32).itemsize + np.dtype(np.float64).itemsize)
+    return max(1, block_bytes // bytes_per_rating)
+
+
+def _row_blocks(indptr, block_nnz):
+    """
+    Split matrix rows into contiguous blocks holding at most ``block_nnz`` stored entries each, or a
+    single row when that row alone holds more.
+    """
+    blocks = []
+    start = 0
+    n_rows = len(indptr) - 1
+    while start < n_rows:
+        end = int(np.searchsorted(indptr, indptr[start] + block_nnz, side='right')) - 1
+        end = min(max(end, start + 1), n_rows)
+        blocks.append((start, end))
+        start = end
+    return blocks
+
+
+def _solve_block(matrix, fixed_factors, regularization, start, end):
+    """
+    Solve the regularized least squares problems of rows ``start:end`` against the fixed factors.
+
+    The Gram matrices of all rows of the block are built at once from stacked outer products and
+    solved in a single batched ``np.linalg.solve``. Blocks are sized by :func:`_block_nnz` so that the
+    outer products and the Gram matrices, accumulated in float32 and solved in float64, stay within
+    ``BLOCK_BYTES``; a block of a single row uses a plain matrix product.
+    """
+    n_factors = fixed_factors.shape[1]
+    indptr = matrix.indptr[start:end + 1]
+    low, high = indptr[0], indptr[-1]
+    counts = np.diff(indptr)
+    solution = np.zeros((end - start, n_factors), dtype=np.float32)
+
+    rated = counts > 0
+    if not rated.any():
+        return solution
+
+    factors = fixed_factors[matrix.indices[low:high]]
+    values = matrix.data[low:high]
+
+    if end - start == 1:
+        gram = (factors.T @ factors)[None].astype(np.float64)
+        rhs = (factors.T @ values)[None].astype(np.float64)
+    else:
+        offsets = (indptr[:-1] - low)[rated]
+        gram = np.add.reduceat(factors[:, :, None] * factors[:, None, :], offsets, axis=0).astype(np.float64)
+        rhs = np.add.reduceat(factors * values[:, None], offsets, axis=0).astype(np.float64)
+
+    # Weighted-lambda regularization: rows with more ratings get a proportionally larger penalty
+    gram += regularization * counts[rated][:, None, None] * np.eye(n_factors)
+    solution[rated] = np.linalg.solve(gram, rhs[..., None])[..., 0]
+    return solution
+
+
+def _solve_side(matrix, fixed_factors, regularization, executor):
+    blocks = _row_blocks(matrix.indptr, _block_nnz(fixed_factors.shape[1]))
+    results = executor.map(lambda block: _solve_block(matrix, fixed_factors, regularization, *block), blocks)
+    return np.vstack(list(results))
+
+
+def _rmse(matrix, user_factors, item_factors, chunk_size=1000000):
+    coo = matrix.tocoo()
+    squared_error = 0.0
+    for start in range(0, coo.nnz, chunk_size):
+        rows, columns = coo.row[start:start + chunk_size], coo.col[start:start + chunk_size]
+        predictions = np.einsum('ij,ij->i', user_factors[rows], item_factors[columns])
+        squared_error += float(np.sum((coo.data[start:start + chunk_size] - predictions) ** 2))
+    return (squared_error / coo.nnz) ** 0.5 if coo.nnz else 0.0
+
+
+def train_als(matrix, factors=DEFAULT_FACTORS, iterations=DEFAULT_ITERATIONS, regularization=DEFAULT_REGULARIZATION,
+              workers=None, seed=0, log=print):
+    """
+    Factorize a ratings matrix with alternating least squares.
+
+    Ratings are centered on their global mean, and each half-step solves every row of one side in
+    blocks spread over a thread pool (NumPy releases the GIL in its heavy kernels).
+
+    Args:
+        matrix (csr_matrix): The users x items ratings.
+        factors (int): The number of latent factors.
+        iterations (int): The number of ALS sweeps.
+        regularization (float): The weighted-lambda regularization strength.
+        workers (int): The number of threads, one per CPU by default.
+        seed (int): The random seed of the initial factors.
+        log (callable): Receives one progress line per iteration.
+
+    Returns:
+        tuple: The float32 user factors, item factors and the global mean.
+    """
+    global_mean = float(matrix.data.mean()) if matrix.nnz else 0.0
+    centered = matrix.copy()
+    centered.data = centered.data - np.float32(global_mean)
+    centered_t = centered.T.tocsr()
+
+    rng = np.random.default_rng(seed)
+    user_factors = np.zeros((matrix.shape[0], factors), dtype=np.float32)
+    item_factors = (rng.standard_normal((matrix.shape[1], factors)) * 0.01).astype(np.float32)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for iteration in range(iterations):
+            started = time.monotonic()
+            user_factors = _solve_side(centered, item_factors, regularization, executor)
+            item_factors = _solve_side(centered_t, user_factors, regularization, executor)
+            log(f"Iteration {iteration + 1}/{iterations}: train RMSE "
+                f"{_rmse(centered, user_factors, item_factors):.4f} in {time.monotonic() - started:.1f}s")
+
+    return user_factors, item_factors, global_mean
+
+
+def _replace_file(path, write):
+    # Written next to the target and renamed over it: workers mapping the old file keep reading it
+    with open(path + '.tmp', 'wb') as f:
+        write(f)
+    os.replace(path + '.tmp', path)
+
+
+def save_factor_model(path, user_factors, user_ids, item_factors, item_ids, global_mean, regularization):
+    """
+    Save trained factors, replacing every file atomically and meta.json last, so that workers reload a
+    complete model once its version changes.
+    """
+    os.makedirs(path, exist_ok=True)
+    arrays = {
+        'user_factors.npy': user_factors.astype(np.float32, copy=False),
+        'user_ids.npy': np.asarray(user_ids, dtype=np.int64),
+        'item_factors.npy': item_factors.astype(np.float32, copy=False),
+        'item_ids.npy': np.asarray(item_ids, dtype=np.int64),
+    }
+    for name, array in arrays.items():
+        _replace_file(os.path.join(path, name), lambda f, array=array: np.save(f, array))
+    meta = {
+        'global_mean': global_mean,
+        'regularization': regularization,
+        'factors': int(item_factors.shape[1]),
+        'trained_at': datetime.utcnow().isoformat(),
+    }
+    _replace_file(os.path.join(path, 'meta.json'), lambda f: f.write(json.dumps(meta).encode()))
+
+
+class FactorModel:
+    """
+    Serving side of the matrix factorization: ranks items for a user vector with one matrix-vector product.
+    """
+
+    def __init__(self, item_factors, item_ids, global_mean, regularization, fingerprint=None):
+        self.item_factors = item_factors
+        self.item_index = MovieIndex(item_ids)
+        self.global_mean = global_mean
+        self.regularization = regularization
+        # Identifies the training run, so that indexes built over these factors can be matched to them
+        self.fingerprint = fingerprint
+
+    def fold_in(self, movie_ids, ratings):
+        """
+        Compute the factors of a user that was not part of training from their ratings.
+
+        Solves the same regularized least squares problem as a training half-step, with the item
+        factors held fixed, so no retraining is needed.
+
+        Args:
+            movie_ids (list): The rated movie IDs.
+            ratings (list): The ratings, on the MovieLens 0.5-5 scale.
+
+        Returns:
+            np.ndarray: The user factors, or None if none of the movies is known to the model.
+        """
+        indices = self.item_index.indices_of(movie_ids)
+        known = indices >= 0
+        if not known.any():
+            return None
+
+        factors = np.asarray(self.item_factors[indices[known]], dtype=np.float64)
+        values = np.asarray(ratings, dtype=np.float64)[known] - self.global_mean
+        gram = factors.T @ factors + self.regularization * known.sum() * np.eye(factors.shape[1])
+        return np.linalg.solve(gram, factors.T @ values).astype(np.float32)
+
+    def recommend(self, user_factors, top_n=10, exclude_movie_ids=None):
+        """
+        Rank all items for a user and keep the ``top_n`` best with ``argpartition``.
+
+        Args:
+            user_factors (np.ndarray): The user factors.
+            top_n (int): The number of movies to return.
+            exclude_movie_ids (list): Movie IDs that must not be returned.
+
+        Returns:
+            list: The recommended movie IDs, best first.
+        """
+        scores = self.item_factors @ user_factors
+        if exclude_movie_ids:
+            excluded = self.item_index.indices_of(exclude_movie_ids)
+            scores[excluded[excluded >= 0]] = -np.inf
+
+        top_n = min(top_n, len(scores))
+        top = np.argpartition(-scores, top_n - 1)[:top_n] if top_n else np.empty(0, dtype=np.int64)
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return self.item_index.movie_ids_of(top[np.isfinite(scores[top])])
+
+
+def load_factor_model(path=cf_model_path):
+    """
+    Memory-map a trained factor model.
+
+    Returns:
+        FactorModel: The model, or None if it has not been trained.
+    """
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return None
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    return FactorModel(
+        np.load(os.path.join(path, 'item_factors.npy'), mmap_mode='r'),
+        np.load(os.path.join(path, 'item_ids.npy')),
+        meta['global_mean'],
+        meta['regularization'],
+        fingerprint=f"{meta['trained_at']}:{meta['factors']}",
+    )
+
+
+def factor_model_version(path=cf_model_path):
+    """
+    Get a cheap token that changes whenever a new model is saved, in any process.
+    """
+    try:
+        return os.stat(os.path.join(path, 'meta.json')).st_mtime_ns
+    except OSError:
+        return None
+
+
+# Load the factor model on first use, and again in every worker whenever train-cf saves a new one
+factor_model = LazyResource('factor_model', load_factor_model, version=factor_model_version)
+
+
+@click.command('train-cf')
+@click.option('--factors', default=DEFAULT_FACTORS, show_default=True, help='Number of latent factors.')
+@click.option('--iterations', default=DEFAULT_ITERATIONS, show_default=True, help='Number of ALS sweeps.')
+@click.option('--regularization', default=DEFAULT_REGULARIZATION, show_default=True, help='Regularization strength.')
+@click.option('--workers', type=int, default=None, help='Worker threads, one per CPU by default.')
+@click.option('--source', type=click.Choice(['csv', 'db']), default='csv', show_default=True,
+              help='Read ratings from ratings.csv or from the movielens_ratings table.')
+@with_appcontext
+def train_cf_command(factors, iterations, regularization, workers, source):
+    """Train the collaborative filtering model with ALS and save its factors."""
+    started = time.monotonic()
+    matrix, user_ids, item_ids = load_rating_matrix(source)
+    click.echo(f'Loaded {matrix.nnz} ratings from {matrix.shape[0]} users on {matrix.shape[1]} movies '
+               f'in {time.monotonic() - started:.1f}s.')
+
+    user_factors, item_factors, global_mean = train_als(
+        matrix, factors=factors, iterations=iterations, regularization=regularization, workers=workers, log=click.echo
+    )
+    save_factor_model(cf_model_path, user_factors, user_ids, item_factors, item_ids, global_mean, regularization)
+    factor_model.reset()
+    click.echo(f'Saved factors to {cf_model_path} ({time.monotonic() - started:.1f}s total).')
+    click.echo('A collaborative ANN index built before is ignored until "flask build-ann-index --source '
+               'collaborative" is run again.')
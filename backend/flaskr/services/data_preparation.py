@@ -1,23 +1,21 @@
 import json
-import os
-import redis
-import requests
-from dotenv import load_dotenv
 
-import numpy as np
-import pandas as pd
+from redis.exceptions import RedisError
 
 from flaskr import db
-from flaskr.database_models import MovielensMovie
+from flaskr.database_models import MovielensMovie, OmdbMovieDetails
+from flaskr.services.local_cache import LocalCache, record_redis_lookup
+from flaskr.services.omdb_client import get_omdb_client
+from flaskr.services.redis_pool import get_redis_client
 
-# Load environment variables from the .env file
-load_dotenv()
+# Time in seconds OMDB details stay in the cache
+OMDB_CACHE_TIMEOUT = 86400
 
-OMDB_API_KEY = os.getenv('OMDB_API_KEY')
-OMDB_API_URL = "https://www.omdbapi.com/"
+# The shared Redis client
+redis_client = get_redis_client()
 
-# Set up Redis client
-redis_client = redis.StrictRedis(host='localhost', port=6379, db=0, decode_responses=True)
+# Decoded OMDB details of the hot movies, in front of Redis
+omdb_cache = LocalCache('omdb_details')
 
 
 def format_imdb_id(imdb_id):
@@ -33,6 +31,20 @@ def format_imdb_id(imdb_id):
     return f"tt{str(imdb_id).zfill(7)}"
 
 
+def load_stored_omdb_details(imdb_ids):
+    """
+    Read OMDB details persisted by `flask warm-omdb-cache` from the omdb_movie_details table.
+
+    Args:
+        imdb_ids (list): The formatted IMDb IDs.
+
+    Returns:
+        dict: The stored movie details keyed by IMDb ID.
+    """
+    rows = OmdbMovieDetails.query.filter(OmdbMovieDetails.imdb_id.in_(list(imdb_ids))).all()
+    return {row.imdb_id: json.loads(row.details) for row in rows}
+
+
 def fetch_omdb_details(imdb_id):
     """
     Fetch movie details from OMDB API and cache the result.
@@ -43,87 +55,177 @@ def fetch_omdb_details(imdb_id):
     Returns:
         dict: The movie details from OMDB API, or None if an error occurs.
     """
-    # Check Redis cache
-    cached_data = redis_client.get(imdb_id)
-    if cached_data:
-        print(f"Cache hit for {imdb_id}")
-        return json.loads(cached_data)
-
-    print(f"Cache miss for {imdb_id}. Fetching from OMDB API.")
-
-    params = {
-        'i': imdb_id,
-        'apikey': OMDB_API_KEY,
-        'plot': 'full',
-    }
+    return fetch_omdb_details_batch([imdb_id]).get(imdb_id)
+
+
+def fetch_omdb_details_batch(imdb_ids):
+    """
+    Fetch movie details for several movies, reading the cache with a single MGET.
+
+    The in-process cache is checked first, so popular movies usually need no Redis round-trip. Cache
+    misses are looked up in the omdb_movie_details table first, and only what is still missing is
+    fetched from the OMDB API. Everything found is written back to the cache in one pipeline.
+
+    Args:
+        imdb_ids (list): The formatted IMDb IDs.
+
+    Returns:
+        dict: The movie details keyed by IMDb ID. Movies that could not be fetched are left out.
+    """
+    imdb_ids = list(dict.fromkeys(imdb_ids))
+    if not imdb_ids:
+        return {}
+
+    omdb_details = omdb_cache.get_many(imdb_ids)
+    remaining = [imdb_id for imdb_id in imdb_ids if imdb_id not in omdb_details]
+    if not remaining:
+        return omdb_details
 
     try:
-        response = requests.get(OMDB_API_URL, params=params)
-        response.raise_for_status()
-        movie_details = response.json()
-
-        if movie_details.get('Response') == 'True':
-            # Store in Redis cache with an expiration time (e.g., 1 day)
-            redis_client.setex(imdb_id, 86400, json.dumps(movie_details))
-            return movie_details
+        cached = redis_client.mget(remaining)
+    except RedisError:
+        # Redis is down, fall back to the omdb_movie_details table
+        cached = [None] * len(remaining)
+
+    misses = []
+    for imdb_id, cached_data in zip(remaining, cached):
+        if cached_data:
+            omdb_details[imdb_id] = json.loads(cached_data)
+            omdb_cache.set(imdb_id, omdb_details[imdb_id], len(cached_data))
         else:
-            print(f"Error fetching details for IMDb ID {imdb_id}: {movie_details.get('Error')}")
-            return None
+            misses.append(imdb_id)
+    record_redis_lookup(omdb_cache.name, len(remaining) - len(misses), len(misses))
+
+    if not misses:
+        return omdb_details
+
+    print(f"Cache miss for {len(misses)} of {len(imdb_ids)} IMDb IDs. Fetching from OMDB API.")
+
+    fetched = load_stored_omdb_details(misses)
+    fetched.update(get_omdb_client().fetch_many(
+        [imdb_id for imdb_id in misses if imdb_id not in fetched]
+    ))
+
+    if fetched:
+        # Store in Redis cache with an expiration time (e.g., 1 day)
+        pipeline = redis_client.pipeline(transaction=False)
+        for imdb_id, movie_details in fetched.items():
+            serialized = json.dumps(movie_details)
+            pipeline.setex(imdb_id, OMDB_CACHE_TIMEOUT, serialized)
+            omdb_cache.set(imdb_id, movie_details, len(serialized))
+        try:
+            pipeline.execute()
+        except RedisError:
+            pass
 
-    except requests.exceptions.RequestException as e:
-        print(f"Request error: {e}")
-        return None
+    omdb_details.update(fetched)
+    return omdb_details
+
+
+def format_movie_details(movie, omdb_details=None):
+    """
+    Build the response dictionary of a catalog movie.
+
+    Args:
+        movie (MovielensMovie): The catalog movie.
+        omdb_details (dict): The movie details from OMDB API, if any.
+
+    Returns:
+        dict: The movie details.
+    """
+    movie_details = {
+        "movie_id": movie.movie_id,
+        "movie_name": movie.movie_name,
+        "genres": movie.genres,
+        "imdb_id": movie.imdb_id,
+        "tmdb_id": movie.tmdb_id
+    }
+
+    if omdb_details:
+        movie_details.update({
+            "omdb_title": omdb_details.get('Title'),
+            "omdb_year": omdb_details.get('Year'),
+            "omdb_director": omdb_details.get('Director'),
+            "omdb_actors": omdb_details.get('Actors'),
+            "omdb_plot": omdb_details.get('Plot'),
+            "omdb_poster": omdb_details.get('Poster'),
+            "omdb_rating": omdb_details.get('imdbRating'),
+            "omdb_genres": omdb_details.get('Genre')
+        })
+
+    return movie_details
+
+
+def get_movie_details_batch(movie_ids, extras=None):
+    """
+    Get detailed information for several movies with one catalog query and one cache round-trip.
+
+    Args:
+        movie_ids (list): The MovieLens movie IDs, in the order of the result.
+        extras (list): Optional dictionaries merged into the details of the movie at the same position,
+            e.g. ``{"avg_rating": 4.1, "rating_count": 812}``.
+
+    Returns:
+        list: The movie details, in input order. Movies missing from the catalog are left out.
+    """
+    movie_ids = list(movie_ids)
+    if not movie_ids:
+        return []
+
+    movies = {
+        movie.movie_id: movie
+        for movie in MovielensMovie.query.filter(MovielensMovie.movie_id.in_(set(movie_ids))).all()
+    }
+
+    omdb_details = fetch_omdb_details_batch(
+        format_imdb_id(movie.imdb_id) for movie in movies.values() if movie.imdb_id
+    )
+
+    movie_details_list = []
+    for position, movie_id in enumerate(movie_ids):
+        movie = movies.get(movie_id)
+        if movie is None:
+            continue
+
+        movie_details = format_movie_details(
+            movie, omdb_details.get(format_imdb_id(movie.imdb_id)) if movie.imdb_id else None
+        )
+        if extras and extras[position]:
+            movie_details.update(extras[position])
+
+        movie_details_list.append(movie_details)
+
+    return movie_details_list
 
 
 def get_movie_details(movies):
     """
     Get detailed information for a list of movies.
-    :param movies:
-    :return:
+
+    Args:
+        movies: A movie ID, or a list of rows that have a ``movie_id`` attribute (watchlist entries,
+            rating aggregates, ...). ``avg_rating`` and ``rating_count`` attributes are passed through.
+
+    Returns:
+        list: The movie details, in input order.
     """
     if type(movies) != list:
         movies = [movies]
-    else:
-        # Retrieve movie names in a single query
-        movies = [movie.movie_id for movie in movies]
-
-    movie_details_list = []
 
+    movie_ids = []
+    extras = []
     for movie in movies:
-        # Basic movie details
-        movie_details = {
-            "movie_id": movie,
-            "movie_name": MovielensMovie.query.get(movie).movie_name,
-            "genres": MovielensMovie.query.get(movie).genres,
-            "imdb_id": MovielensMovie.query.get(movie).imdb_id,
-            "tmdb_id": MovielensMovie.query.get(movie).tmdb_id
-        }
-
-        # Fetch additional details from OMDB
-        if movie_details['imdb_id']:
-            omdb_details = fetch_omdb_details(format_imdb_id(movie_details['imdb_id']))
-            if omdb_details:
-                movie_details.update({
-                    "omdb_title": omdb_details.get('Title'),
-                    "omdb_year": omdb_details.get('Year'),
-                    "omdb_director": omdb_details.get('Director'),
-                    "omdb_actors": omdb_details.get('Actors'),
-                    "omdb_plot": omdb_details.get('Plot'),
-                    "omdb_poster": omdb_details.get('Poster'),
-                    "omdb_rating": omdb_details.get('imdbRating'),
-                    "omdb_genres": omdb_details.get('Genre')
-                })
+        movie_ids.append(getattr(movie, 'movie_id', movie))
 
         # Conditionally add avg_rating and rating_count if they exist
+        extra = {}
         if hasattr(movie, 'avg_rating'):
-            movie_details["avg_rating"] = movie.avg_rating
-
+            extra["avg_rating"] = movie.avg_rating
         if hasattr(movie, 'rating_count'):
-            movie_details["rating_count"] = movie.rating_count
+            extra["rating_count"] = movie.rating_count
+        extras.append(extra)
 
-        movie_details_list.append(movie_details)
-
-    return movie_details_list
+    return get_movie_details_batch(movie_ids, extras)
 
 
 def age_map_convertor(age):
@@ -143,29 +245,12 @@ def age_map_convertor(age):
         return 56
 
 
-def prepare_data(age, occupation, gender, age_encoder, occupation_encoder, age_map):
-    possible_gender_values_map = {
-        "male": 1,
-        "female": 0,
-        "1": 1,
-        "0": 0,
-        1: 1,
-        0: 0,
-    }
-    gender = possible_gender_values_map[gender]
-
-    age_str = age_map[age_map_convertor(age)]
-    age_input = np.array(age_str).reshape(1, -1)
-    occupation_input = np.array(occupation).reshape(1, -1)
-
-    age_encoded = age_encoder.transform(age_input).toarray()
-    occupation_encoded = occupation_encoder.transform(occupation_input).toarray()
-
-    input_features = np.hstack([gender, age_encoded.flatten(), occupation_encoded.flatten()])
-    input_features = input_features.reshape(1, -1)
-
-    feature_names = ['gender'] + list(age_encoder.get_feature_names_out(['AgeRange'])) + list(
-        occupation_encoder.get_feature_names_out(['Occupation']))
-    input_features_df = pd.DataFrame(input_features, columns=feature_names)
-
-    return input_features_df
+# Gender values accepted by the genre model, mapped to its encoding
+possible_gender_values_map = {
+    "male": 1,
+    "female": 0,
+    "1": 1,
+    "0": 0,
+    1: 1,
+    0: 0,
+}
@@ -0,0 +1,173 @@
+import threading
+
+import click
+import numpy as np
+from flask.cli import with_appcontext
+
+from flaskr import db
+from flaskr.database_models import Genre, MovieGenre, MovielensMovie
+from flaskr.services.catalog_version import bump_catalog_version, catalog_version_token
+from flaskr.services.movie_index import get_movie_index
+
+# Genre spellings from other MovieLens releases mapped to their ML-25M name
+GENRE_ALIASES = {
+    "children's": "children",
+}
+
+
+def normalize_genre_name(name):
+    name = name.strip().lower()
+    return GENRE_ALIASES.get(name, name)
+
+
+def split_genres(genres):
+    """
+    Split a MovieLens ``genres`` column value, e.g. "Adventure|Children|Fantasy".
+
+    Returns:
+        list: The genre names, without the "(no genres listed)" placeholder.
+    """
+    return [genre for genre in genres.split('|') if genre and genre != '(no genres listed)']
+
+
+def populate_movie_genres(movies):
+    """
+    Fill the genre and movie_genre tables from catalog rows.
+
+    Does not commit.
+
+    Args:
+        movies: An iterable of ``(movie_id, genres)`` pairs.
+    """
+    movie_genres = [(int(movie_id), genre) for movie_id, genres in movies for genre in split_genres(genres)]
+
+    genre_ids = {genre.name: genre.id for genre in Genre.query.all()}
+    new_genres = sorted({genre for _, genre in movie_genres} - set(genre_ids))
+    if new_genres:
+        db.session.bulk_insert_mappings(Genre, [{'name': genre} for genre in new_genres])
+        genre_ids = {genre.name: genre.id for genre in Genre.query.all()}
+
+    db.session.bulk_insert_mappings(MovieGenre, [
+        {'movie_id': movie_id, 'genre_id': genre_ids[genre]} for movie_id, genre in movie_genres
+    ])
+    invalidate_genre_index()
+
+
+def rebuild_movie_genres():
+    """
+    Recreate the movie_genre table from movielens_movies.genres.
+
+    Does not commit.
+    """
+    db.session.execute(MovieGenre.__table__.delete())
+    populate_movie_genres(db.session.query(MovielensMovie.movie_id, MovielensMovie.genres))
+
+
+class GenreIndex:
+    """
+    In-memory genre lookups for hot queries.
+
+    Holds, per genre, its ID, the sorted IDs of its movies and a boolean bitmap over the similarity
+    matrix rows, so genre filters never touch the database.
+    """
+
+    def __init__(self, genres, movie_index, catalog_version=None):
+        self.movie_index = movie_index
+        self.catalog_version = catalog_version
+        self._genres = {}
+        self._masks = {}
+        for genre_id, name, movie_ids in genres:
+            self._genres[normalize_genre_name(name)] = (genre_id, name, np.sort(np.asarray(movie_ids, dtype=np.int64)))
+
+    def __contains__(self, genre):
+        return normalize_genre_name(genre) in self._genres
+
+    @property
+    def names(self):
+        return sorted(name for _, name, _ in self._genres.values())
+
+    def genre_id(self, genre):
+        entry = self._genres.get(normalize_genre_name(genre))
+        return entry[0] if entry else None
+
+    def movie_ids(self, genre):
+        entry = self._genres.get(normalize_genre_name(genre))
+        return entry[2] if entry else np.empty(0, dtype=np.int64)
+
+    def mask(self, genre):
+        """
+        Get the bitmap of a genre over the similarity matrix rows.
+
+        Args:
+            genre (str): The genre name, in any case.
+
+        Returns:
+            np.ndarray: A read-only boolean array, True for the rows of movies in the genre.
+        """
+        key = normalize_genre_name(genre)
+        mask = self._masks.get(key)
+        if mask is None:
+            indices = self.movie_index.indices_of(self.movie_ids(genre))
+            mask = np.zeros(len(self.movie_index), dtype=bool)
+            mask[indices[indices >= 0]] = True
+            mask.setflags(write=False)
+            self._masks[key] = mask
+        return mask
+
+
+_genre_index = None
+_genre_index_lock = threading.Lock()
+
+
+def load_genre_index(catalog_version=None):
+    movie_ids_by_genre = {}
+    for genre_id, movie_id in db.session.query(MovieGenre.genre_id, MovieGenre.movie_id):
+        movie_ids_by_genre.setdefault(genre_id, []).append(movie_id)
+
+    genres = [
+        (genre.id, genre.name, movie_ids_by_genre.get(genre.id, []))
+        for genre in Genre.query.all()
+    ]
+    return GenreIndex(genres, get_movie_index(), catalog_version)
+
+
+def get_genre_index():
+    """
+    Get the process-wide genre index, loading it on first use.
+
+    The index is rebuilt when any process bumps the catalog version, when the movie IDs of the matrix
+    rows it maps onto change, or after :func:`invalidate_genre_index`.
+
+    Returns:
+        GenreIndex: The genre index.
+    """
+    global _genre_index
+
+    # Read before loading, so a bump during the load triggers another one
+    version = catalog_version_token()
+    genre_index = _genre_index
+    if genre_index is not None and genre_index.catalog_version == version \
+            and genre_index.movie_index.version == get_movie_index().version:
+        return genre_index
+
+    with _genre_index_lock:
+        if _genre_index is genre_index:
+            _genre_index = load_genre_index(version)
+        return _genre_index
+
+
+def invalidate_genre_index():
+    global _genre_index
+
+    with _genre_index_lock:
+        _genre_index = None
+
+
+@click.command('rebuild-genre-index')
+@with_appcontext
+def rebuild_genre_index_command():
+    """Recreate the movie_genre table from the genres column of movielens_movies."""
+    rebuild_movie_genres()
+    db.session.commit()
+    bump_catalog_version()
+    click.echo(f'Indexed {MovieGenre.query.count()} movie genres across {Genre.query.count()} genres.')
@@ -0,0 +1,211 @@
+import csv
+import io
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from dateutil import tz
+from flask import current_app
+from sqlalchemy import insert
+
+from flaskr import db
+from flaskr.database_models import IngestionCheckpoint, MovieGenre, MovielensMovie, MovielensRating, MovieRatingStats
+from flaskr.decorators import invalidate_cache_tags
+from flaskr.services.catalog_version import bump_catalog_version
+from flaskr.services.genre_index import populate_movie_genres, rebuild_movie_genres
+from flaskr.services.movie_index import invalidate_movie_index
+from flaskr.services.title_index import invalidate_title_index
+from flaskr.services.rating_stats import apply_rating_deltas, rebuild_movie_rating_stats, refresh_weighted_scores
+
+RATINGS_SOURCE = 'movielens_ratings'
+RATINGS_COLUMNS = ['movie_id', 'movielens_user_id', 'rating', 'timestamp']
+RATINGS_CSV_DTYPES = {'userId': np.int32, 'movieId': np.int32, 'rating': np.float32, 'timestamp': np.int64}
+
+
+def ingest_movies(movies_df, links_df):
+    """
+    Load the MovieLens catalog and its genres, unless the catalog is already populated.
+
+    Args:
+        movies_df (pd.DataFrame): The content of movies.csv.
+        links_df (pd.DataFrame): The content of links.csv.
+    """
+    if MovielensMovie.query.count() == 0:
+        # Merge movies with links on movieId
+        movies_with_links_df = movies_df.merge(links_df, on='movieId', how='left')
+        movie_data = movies_with_links_df[['movieId', 'title', 'genres', 'tmdbId', 'imdbId']].rename(columns={
+            'movieId': 'movie_id',
+            'title': 'movie_name',
+            'tmdbId': 'tmdb_id',
+            'imdbId': 'imdb_id'
+        })
+
+        # Insert movies into the database
+        db.session.bulk_insert_mappings(MovielensMovie, movie_data.to_dict(orient='records'))
+        # Normalize the genres into the genre and movie_genre tables
+        populate_movie_genres(zip(movie_data['movie_id'], movie_data['genres']))
+        db.session.commit()
+
+        # The catalog changed, so the cached movie ID <-> matrix row mapping and titles are stale,
+        # here and in every other worker
+        invalidate_movie_index()
+        invalidate_title_index()
+        bump_catalog_version()
+    elif MovieGenre.query.count() == 0:
+        # Movies were loaded before the genre index existed
+        rebuild_movie_genres()
+        db.session.commit()
+        bump_catalog_version()
+
+
+def get_checkpoint(source):
+    checkpoint = db.session.get(IngestionCheckpoint, source)
+    if checkpoint is None:
+        checkpoint = IngestionCheckpoint(source=source, rows_done=0, completed=False, updated_at=datetime.utcnow())
+        db.session.add(checkpoint)
+    return checkpoint
+
+
+def prepare_ratings_chunk(chunk):
+    """
+    Convert a chunk of ratings.csv into movielens_ratings columns, without Python-level loops.
+
+    Timestamps are converted to naive local datetimes, like ``datetime.fromtimestamp`` does.
+    """
+    timestamps = pd.to_datetime(chunk['timestamp'], unit='s', utc=True).dt.tz_convert(tz.tzlocal()).dt.tz_localize(None)
+    return pd.DataFrame({
+        'movie_id': chunk['movieId'].to_numpy(),
+        'movielens_user_id': chunk['userId'].to_numpy(),
+        'rating': chunk['rating'].to_numpy(dtype=np.float64),
+        'timestamp': timestamps.to_numpy(),
+    })
+
+
+def copy_ratings(ratings):
+    """
+    Stream a chunk of ratings into PostgreSQL with COPY, inside the current session transaction.
+    """
+    buffer = io.StringIO()
+    ratings.to_csv(buffer, index=False, header=False, date_format='%Y-%m-%d %H:%M:%S', quoting=csv.QUOTE_MINIMAL)
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {MovielensRating.__tablename__} ({', '.join(RATINGS_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+    finally:
+        cursor.close()
+
+
+def insert_ratings(ratings):
+    """
+    Insert a chunk of ratings with a single executemany, inside the current session transaction.
+    """
+    records = [
+        dict(zip(RATINGS_COLUMNS, row))
+        for row in zip(
+            ratings['movie_id'].tolist(),
+            ratings['movielens_user_id'].tolist(),
+            ratings['rating'].tolist(),
+            ratings['timestamp'].dt.to_pydatetime().tolist(),
+        )
+    ]
+    db.session.execute(insert(MovielensRating.__table__), records)
+
+
+def ingest_ratings(ratings_path, batch_size=None, progress=None):
+    """
+    Load ratings.csv into movielens_ratings, resuming after the last committed batch.
+
+    Each batch is bulk loaded through the driver (COPY on PostgreSQL, executemany elsewhere) and
+    committed together with its rating aggregates and the ingestion checkpoint, so a crash loses at
+    most the batch in progress.
+
+    Args:
+        ratings_path (str): The path to ratings.csv.
+        batch_size (int): The number of ratings per batch, INGEST_BATCH_SIZE by default.
+        progress (callable): Called with the number of ratings loaded so far after each committed batch.
+            It may raise to stop the load; the next call resumes after the last committed batch.
+
+    Returns:
+        int: The number of ratings loaded by this call.
+    """
+    batch_size = batch_size or current_app.config['INGEST_BATCH_SIZE']
+    logger = current_app.logger
+
+    checkpoint = get_checkpoint(RATINGS_SOURCE)
+    if checkpoint.completed:
+        if MovieRatingStats.query.count() == 0:
+            rebuild_movie_rating_stats()
+            db.session.commit()
+            bump_catalog_version()
+        return 0
+
+    if checkpoint.rows_done == 0 and db.session.query(MovielensRating.movie_id).first() is not None:
+        # Ratings loaded before checkpoints existed: consider the load complete
+        checkpoint.completed = True
+        checkpoint.updated_at = datetime.utcnow()
+        if MovieRatingStats.query.count() == 0:
+            rebuild_movie_rating_stats()
+        db.session.commit()
+        bump_catalog_version()
+        return 0
+
+    use_copy = db.engine.dialect.name == 'postgresql'
+    rows_loaded = 0
+    started = time.monotonic()
+    if checkpoint.rows_done:
+        logger.info("Resuming ratings ingestion after %d rows", checkpoint.rows_done)
+
+    reader = pd.read_csv(ratings_path, chunksize=batch_size, dtype=RATINGS_CSV_DTYPES)
+    # Rows of the file already read, to drop the chunks loaded before the checkpoint; a skiprows range
+    # would build a skip set as large as the rows done
+    rows_read = 0
+    resume_after = checkpoint.rows_done
+    for chunk in reader:
+        chunk_start = rows_read
+        rows_read += len(chunk)
+        if rows_read <= resume_after:
+            continue
+        if chunk_start < resume_after:
+            chunk = chunk.iloc[resume_after - chunk_start:]
+
+        chunk_started = time.monotonic()
+        ratings = prepare_ratings_chunk(chunk)
+
+        if use_copy:
+            copy_ratings(ratings)
+        else:
+            insert_ratings(ratings)
+
+        # Keep the per-movie aggregates in step, in the same transaction
+        chunk_stats = ratings.groupby('movie_id')['rating'].agg(['count', 'sum'])
+        apply_rating_deltas(dict(zip(chunk_stats.index, zip(chunk_stats['count'], chunk_stats['sum']))))
+
+        checkpoint.rows_done += len(ratings)
+        checkpoint.updated_at = datetime.utcnow()
+        db.session.commit()
+
+        rows_loaded += len(ratings)
+        chunk_elapsed = time.monotonic() - chunk_started
+        logger.info("Loaded %d ratings (%d total) at %.0f rows/s",
+                    len(ratings), checkpoint.rows_done, len(ratings) / chunk_elapsed if chunk_elapsed else 0)
+        if progress:
+            progress(rows_loaded)
+
+    refresh_weighted_scores()
+    checkpoint.completed = True
+    checkpoint.updated_at = datetime.utcnow()
+    db.session.commit()
+
+    # The charts are read from the rating aggregates, and title search ranks by them
+    invalidate_cache_tags('ratings')
+    bump_catalog_version()
+
+    elapsed = time.monotonic() - started
+    logger.info("Ratings ingestion finished: %d rows in %.1fs (%.0f rows/s)",
+                rows_loaded, elapsed, rows_loaded / elapsed if elapsed else 0)
+    return rows_loaded
@@ -0,0 +1,110 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+from flaskr import db
+from flaskr.database_models import MovielensMovie
+
+# Construct the absolute path
+base_dir = os.path.abspath(os.path.dirname(__file__))
+data_path = os.path.join(base_dir, '../../../machine_learning/data/raw/ml-25m/')
+movies_csv_path = os.path.join(data_path, 'movies.csv')
+tags_csv_path = os.path.join(data_path, 'tags.csv')
+
+
+def build_movie_documents(movies, tags):
+    """
+    Build the text describing each movie: its genres followed by all of its user tags.
+
+    This is the ``combined_features`` column of the recommendation notebook.
+
+    Args:
+        movies (pd.DataFrame): ``movieId`` and ``genres`` columns.
+        tags (pd.DataFrame): ``movieId`` and ``tag`` columns.
+
+    Returns:
+        tuple: The movie IDs and the matching documents, in ``movies`` order.
+    """
+    tags = tags.assign(tag=tags['tag'].fillna('').astype(str))
+    movie_tags = tags.groupby('movieId')['tag'].agg(' '.join)
+
+    documents = movies['genres'].str.replace('|', ' ', regex=False) + ' ' + \
+        movies['movieId'].map(movie_tags).fillna('')
+    return movies['movieId'].to_numpy(dtype=np.int64), documents.tolist()
+
+
+def load_movie_documents(movies_path=movies_csv_path, tags_path=tags_csv_path):
+    """
+    Build the documents of the ``movies.csv`` snapshot, in file order.
+    """
+    movies = pd.read_csv(movies_path, usecols=['movieId', 'genres'])
+    tags = pd.read_csv(tags_path, usecols=['movieId', 'tag'])
+    return build_movie_documents(movies, tags)
+
+
+def load_catalog_documents(movies_path=movies_csv_path, tags_path=tags_csv_path):
+    """
+    Build the documents of the current catalog: the ``movies.csv`` snapshot, with genres taken from
+    the movielens_movies table when it has them and movies added to the table appended.
+
+    Returns:
+        tuple: The movie IDs and the matching documents.
+    """
+    movies = pd.read_csv(movies_path, usecols=['movieId', 'genres'])
+    tags = pd.read_csv(tags_path, usecols=['movieId', 'tag'])
+
+    catalog = pd.read_sql(
+        db.session.query(MovielensMovie.movie_id, MovielensMovie.genres).statement, db.engine
+    ).rename(columns={'movie_id': 'movieId'})
+    if len(catalog):
+        catalog_genres = catalog.set_index('movieId')['genres']
+        movies['genres'] = movies['movieId'].map(catalog_genres).fillna(movies['genres'])
+        added = catalog[~catalog['movieId'].isin(movies['movieId'])].sort_values('movieId')
+        movies = pd.concat([movies, added], ignore_index=True)
+
+    return build_movie_documents(movies, tags)
+
+
+def document_hashes(documents):
+    """
+    Hash every document to 64 bits, to detect the movies whose features changed.
+    """
+    return np.array([
+        int.from_bytes(hashlib.blake2b(document.encode(), digest_size=8).digest(), 'little', signed=True)
+        for document in documents
+    ], dtype=np.int64)
+
+
+def build_tfidf_matrix(documents):
+    """
+    Vectorize movie documents with the same TF-IDF settings as the notebook.
+
+    Returns:
+        tuple: The fitted TfidfVectorizer and the L2-normalized csr_matrix of the documents.
+    """
+    vectorizer = TfidfVectorizer(stop_words='english')
+    return vectorizer, vectorizer.fit_transform(documents)
+
+
+def build_item_embeddings(tfidf_matrix, dim=128, seed=0):
+    """
+    Reduce TF-IDF features to dense, unit-length item embeddings with a truncated SVD.
+
+    Inner products between embeddings approximate the cosine similarities of the TF-IDF rows.
+
+    Args:
+        tfidf_matrix: The TF-IDF matrix, one row per movie.
+        dim (int): The embedding size.
+        seed (int): The SVD random seed.
+
+    Returns:
+        np.ndarray: The float32 embeddings, one row per movie.
+    """
+    dim = min(dim, tfidf_matrix.shape[1] - 1)
+    embeddings = TruncatedSVD(n_components=dim, random_state=seed).fit_transform(tfidf_matrix)
+    return normalize(embeddings).astype(np.float32)
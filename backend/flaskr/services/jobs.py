@@ -0,0 +1,247 @@
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app
+from redis.exceptions import LockError, RedisError
+
+from flaskr.services.redis_pool import get_redis_client
+
+# Time in seconds the lock of a job kind outlives the last heartbeat of its job, e.g. after a crash
+JOB_LOCK_TIMEOUT = 60
+# Time in seconds the state of a job stays readable by every worker
+JOB_STATE_TIMEOUT = 86400
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    State of a background job, updated by the job itself and read by the status endpoint.
+    """
+
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = 'queued'
+        self.phase = None
+        self.rows_processed = 0
+        self.error = None
+        self.submitted_at = datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+        self._started = None
+        self._cancel_requested = threading.Event()
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    @property
+    def throughput(self):
+        if self._started is None:
+            return 0.0
+        elapsed = time.monotonic() - self._started
+        return self.rows_processed / elapsed if elapsed else 0.0
+
+    def cancel(self):
+        self._cancel_requested.set()
+        _request_cancel(self.id)
+
+    def save(self):
+        """
+        Share the state of the job with the other workers, see :meth:`JobRunner.get`.
+        """
+        try:
+            get_redis_client().setex(f"job:{self.id}", JOB_STATE_TIMEOUT, json.dumps(self.to_dict()))
+        except RedisError:
+            # Only this process can report on the job until Redis is back
+            pass
+
+    def _cancel_requested_elsewhere(self):
+        try:
+            return bool(get_redis_client().exists(f"job_cancel:{self.id}"))
+        except RedisError:
+            return False
+
+    def report(self, phase=None, rows_processed=None):
+        """
+        Record progress, and stop the job if it has been cancelled.
+
+        Call it between units of work that are safe to interrupt.
+
+        Raises:
+            JobCancelled: If cancellation was requested.
+        """
+        if phase is not None:
+            self.phase = phase
+        if rows_processed is not None:
+            self.rows_processed = rows_processed
+        self.save()
+        if self._cancel_requested.is_set() or self._cancel_requested_elsewhere():
+            raise JobCancelled()
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'phase': self.phase,
+            'rows_processed': self.rows_processed,
+            'rows_per_second': round(self.throughput, 1),
+            'error': self.error,
+            'submitted_at': self.submitted_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class RemoteJob:
+    """
+    Read-only view of a job run by another worker, from the state it shares in Redis.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.id = state['job_id']
+        self.kind = state['kind']
+        self.status = state['status']
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    def cancel(self):
+        _request_cancel(self.id)
+
+    def to_dict(self):
+        return dict(self.state)
+
+
+def _request_cancel(job_id):
+    try:
+        get_redis_client().setex(f"job_cancel:{job_id}", JOB_STATE_TIMEOUT, 1)
+    except RedisError:
+        pass
+
+
+class JobRunner:
+    """
+    Runs jobs on a small thread pool inside the current process, one active job per kind.
+
+    The one-job-per-kind guard is a Redis lock, so it holds across gunicorn workers and processes, and
+    job states are shared in Redis so that any worker can report on or cancel any job. The running job
+    keeps its lock alive with a heartbeat; the lock of a crashed worker expires after
+    ``JOB_LOCK_TIMEOUT`` seconds. While Redis is down, the guard only covers the current process.
+    """
+
+    def __init__(self, max_workers=1):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, func, *args, **kwargs):
+        """
+        Run ``func(job, *args, **kwargs)`` in the background, inside an application context.
+
+        Submissions of a kind that already has a queued or running job, in any process, are deduplicated.
+
+        Args:
+            kind (str): The kind of job, e.g. "populate_tables".
+            func (callable): The job body. It receives the Job as first argument.
+
+        Returns:
+            tuple: The Job, or a RemoteJob run by another process, and whether it was newly created.
+        """
+        app = current_app._get_current_object()
+
+        with self._lock:
+            for job in self._jobs.values():
+                if job.kind == kind and job.active:
+                    return job, False
+
+            job = Job(kind)
+            redis_client = get_redis_client()
+            kind_lock = redis_client.lock(f"job_lock:{kind}", timeout=JOB_LOCK_TIMEOUT, thread_local=False)
+            try:
+                if not kind_lock.acquire(blocking=False, token=job.id):
+                    holder = redis_client.get(kind_lock.name)
+                    existing = self.get(holder) if holder else None
+                    if existing is None:
+                        existing = RemoteJob({'job_id': holder, 'kind': kind, 'status': 'running'})
+                    return existing, False
+            except RedisError:
+                kind_lock = None
+
+            self._jobs[job.id] = job
+            job.save()
+            self._executor.submit(self._run, app, job, kind_lock, func, args, kwargs)
+            return job, True
+
+    def _run(self, app, job, kind_lock, func, args, kwargs):
+        finished = threading.Event()
+        if kind_lock is not None:
+            threading.Thread(target=self._heartbeat, args=(kind_lock, finished), name=f"job-{job.id}-heartbeat",
+                             daemon=True).start()
+
+        with app.app_context():
+            job.status = 'running'
+            job.started_at = datetime.utcnow()
+            job._started = time.monotonic()
+            try:
+                job.report()
+                func(job, *args, **kwargs)
+                job.status = 'succeeded'
+            except JobCancelled:
+                job.status = 'cancelled'
+                app.logger.info("Job %s (%s) cancelled", job.id, job.kind)
+            except Exception as e:
+                job.status = 'failed'
+                job.error = str(e)
+                app.logger.exception("Job %s (%s) failed", job.id, job.kind)
+            finally:
+                job.finished_at = datetime.utcnow()
+                job.save()
+                finished.set()
+                if kind_lock is not None:
+                    try:
+                        kind_lock.release()
+                    except (LockError, RedisError):
+                        # Expired, it no longer guards anything
+                        pass
+
+    @staticmethod
+    def _heartbeat(kind_lock, finished):
+        while not finished.wait(JOB_LOCK_TIMEOUT / 3):
+            try:
+                kind_lock.reacquire()
+            except (LockError, RedisError):
+                # Try again on the next beat; the lock may expire if Redis stays unreachable
+                pass
+
+    def get(self, job_id):
+        """
+        Get a job of this process, or the shared state of a job run by another process.
+
+        Returns:
+            Job: The Job or RemoteJob, or None if it is unknown.
+        """
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        try:
+            state = get_redis_client().get(f"job:{job_id}")
+        except RedisError:
+            return None
+        return RemoteJob(json.loads(state)) if state else None
+
+    def list(self):
+        return sorted(self._jobs.values(), key=lambda job: job.submitted_at, reverse=True)
+
+
+job_runner = JobRunner()
@@ -0,0 +1,244 @@
+import json
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+# Channel on which workers broadcast the keys they invalidated
+INVALIDATION_CHANNEL = 'local_cache:invalidate'
+# Entries kept by every local cache, and their total size in bytes
+LOCAL_CACHE_MAX_ENTRIES = int(os.getenv('LOCAL_CACHE_MAX_ENTRIES', 2048))
+LOCAL_CACHE_MAX_BYTES = int(os.getenv('LOCAL_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+# Upper bound in seconds on how long an entry is served without asking Redis, in case an
+# invalidation message is lost
+LOCAL_CACHE_TTL = float(os.getenv('LOCAL_CACHE_TTL', 60))
+# Set to 0 to disable the local caches and always go to Redis
+LOCAL_CACHE_ENABLED = os.getenv('LOCAL_CACHE_ENABLED', '1').lower() in ('1', 'true', 'yes')
+
+# Every LocalCache, by name
+_caches = {}
+# Redis hit/miss counters of the layer behind each local cache, by cache name
+_redis_counters = {}
+_counters_lock = threading.Lock()
+
+_redis_client = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+class LocalCache:
+    """
+    Bounded in-process LRU cache with per-entry expiry, in front of Redis.
+
+    It holds decoded values, so a hit costs neither a network round-trip nor a JSON decode. The cache
+    is limited both in entries and in bytes, the size of an entry being given by the caller (usually
+    the length of its serialized form). Invalidations are broadcast to the other workers over Redis
+    pub/sub, see :func:`configure_local_caches`.
+    """
+
+    def __init__(self, name, max_entries=LOCAL_CACHE_MAX_ENTRIES, max_bytes=LOCAL_CACHE_MAX_BYTES,
+                 ttl=LOCAL_CACHE_TTL):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        # key -> (expires_at, size, value), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        _caches[name] = self
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        if not LOCAL_CACHE_ENABLED:
+            return default
+        _ensure_listener()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def get_many(self, keys):
+        """
+        Get the cached values of several keys.
+
+        Returns:
+            dict: The values found, by key.
+        """
+        found = {}
+        for key in keys:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                found[key] = value
+        return found
+
+    def set(self, key, value, size, ttl=None):
+        """
+        Cache a value.
+
+        Args:
+            key: The cache key.
+            value: The value, which callers must not modify afterwards.
+            size (int): The size of the value in bytes, e.g. the length of its JSON.
+            ttl (float): Time in seconds the value may be served, at most the cache TTL.
+        """
+        if not LOCAL_CACHE_ENABLED or size > self.max_bytes:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, size, value)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+    def discard(self, keys=None):
+        """
+        Drop keys from this process only, or every entry if ``keys`` is None.
+        """
+        with self._lock:
+            if keys is None:
+                self._entries.clear()
+                self.size = 0
+                return
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+
+    def invalidate(self, keys=None):
+        """
+        Drop keys, or every entry if ``keys`` is None, in this process and in all other workers.
+        """
+        keys = None if keys is None else list(keys)
+        self.discard(keys)
+        if _redis_client is None:
+            return
+        try:
+            _redis_client.publish(INVALIDATION_CHANNEL, json.dumps({
+                'origin': _origin(), 'cache': self.name, 'keys': keys,
+            }))
+        except RedisError as e:
+            # The other workers still drop the entries when their TTL expires
+            print(f"Could not broadcast the invalidation of {self.name}: {e}")
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+_MISSING = object()
+
+
+def _origin():
+    # Computed on every call: forked workers share the memory of the master
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def record_redis_lookup(name, hits, misses=0):
+    """
+    Count the lookups of a local cache's misses in Redis, the next layer.
+    """
+    with _counters_lock:
+        counters = _redis_counters.setdefault(name, {'hits': 0, 'misses': 0})
+        counters['hits'] += hits
+        counters['misses'] += misses
+
+
+def cache_stats():
+    """
+    Get the hit/miss counters of every cache layer.
+
+    Returns:
+        dict: For every local cache name, the ``local`` and ``redis`` layer counters of this process.
+    """
+    with _counters_lock:
+        redis_counters = {name: dict(counters) for name, counters in _redis_counters.items()}
+    return {
+        name: {'local': cache.stats(), 'redis': redis_counters.get(name, {'hits': 0, 'misses': 0})}
+        for name, cache in _caches.items()
+    }
+
+
+def configure_local_caches(redis_client):
+    """
+    Use a Redis client to broadcast and receive invalidations of the local caches.
+
+    Every process subscribes from a daemon thread, started on its first cache access so that forked
+    gunicorn workers each get their own.
+    """
+    global _redis_client, _listener_pid
+
+    _redis_client = redis_client
+    _listener_pid = None
+
+
+def _ensure_listener():
+    global _listener_pid
+
+    if _redis_client is None or _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid != os.getpid():
+            _listener_pid = os.getpid()
+            threading.Thread(target=_listen, args=(_redis_client,), name='local-cache-invalidation',
+                             daemon=True).start()
+
+
+def _listen(redis_client):
+    origin = _origin()
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Messages may have been missed while disconnected
+            for cache in list(_caches.values()):
+                cache.discard()
+            while True:
+                # Polled with a timeout, as the shared pool's socket timeout would interrupt listen()
+                message = pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    _apply_invalidation(message.get('data'), origin)
+        except RedisError as e:
+            print(f"Local cache invalidation listener disconnected: {e}")
+            time.sleep(1)
+
+
+def _apply_invalidation(data, origin):
+    try:
+        payload = json.loads(data)
+    except (TypeError, ValueError):
+        return
+    if payload.get('origin') == origin:
+        return
+    cache = _caches.get(payload.get('cache'))
+    if cache is not None:
+        cache.discard(payload.get('keys'))
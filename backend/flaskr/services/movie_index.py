@@ -0,0 +1,188 @@
+import hashlib
+import os
+import threading
+
+import click
+import numpy as np
+import pandas as pd
+from flask.cli import with_appcontext
+
+from flaskr import db
+from flaskr.database_models import MovielensMovie
+from flaskr.services.catalog_version import catalog_version_token
+from flaskr.services.similarity_store import current_similarity_path
+
+# Construct the absolute path
+base_dir = os.path.abspath(os.path.dirname(__file__))
+# base file path for machine learning models
+base_path = os.path.join(base_dir, '../../../machine_learning/models/')
+# Movie IDs in similarity matrix row order, saved alongside the similarity matrix
+movie_index_path = os.path.join(base_path, 'movie_ids.npy')
+movies_csv_path = os.path.join(base_dir, '../../../machine_learning/data/raw/ml-25m/movies.csv')
+
+
+class MovieIndex:
+    """
+    Bidirectional mapping between MovieLens movie IDs and similarity matrix row indices.
+
+    Row ``i`` of the similarity matrix belongs to ``movie_ids[i]``. Lookups by movie ID go through a
+    sorted copy of the IDs with ``np.searchsorted``, so no per-request dictionary is ever built.
+    """
+
+    def __init__(self, movie_ids, source=None, mtime=None, catalog_version=None):
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self._sorter = np.argsort(self.movie_ids, kind='stable')
+        self._sorted_ids = self.movie_ids[self._sorter]
+        self.version = hashlib.sha1(self.movie_ids.tobytes()).hexdigest()[:12]
+        self.source = source
+        self.mtime = mtime
+        self.catalog_version = catalog_version
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def index_of(self, movie_id):
+        """
+        Get the matrix row index of a movie.
+
+        Args:
+            movie_id (int): The MovieLens movie ID.
+
+        Returns:
+            int: The row index, or None if the movie is not part of the index.
+        """
+        position = np.searchsorted(self._sorted_ids, movie_id)
+        if position < len(self._sorted_ids) and self._sorted_ids[position] == movie_id:
+            return int(self._sorter[position])
+        return None
+
+    def indices_of(self, movie_ids):
+        """
+        Get the matrix row indices of several movies at once.
+
+        Args:
+            movie_ids (list): The MovieLens movie IDs.
+
+        Returns:
+            np.ndarray: The row indices, with -1 for movies that are not part of the index.
+        """
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        if not len(self._sorted_ids):
+            return np.full(len(movie_ids), -1, dtype=np.int64)
+        positions = np.searchsorted(self._sorted_ids, movie_ids)
+        positions = np.minimum(positions, len(self._sorted_ids) - 1)
+        found = self._sorted_ids[positions] == movie_ids
+        return np.where(found, self._sorter[positions], -1)
+
+    def movie_id_of(self, idx):
+        return int(self.movie_ids[idx])
+
+    def movie_ids_of(self, indices):
+        return self.movie_ids[np.asarray(indices, dtype=np.int64)].tolist()
+
+
+_movie_index = None
+_movie_index_lock = threading.Lock()
+
+
+def _artifact_path():
+    # A published similarity version carries the movie IDs of its own rows
+    current = current_similarity_path()
+    return os.path.join(current, 'movie_ids.npy') if current is not None else movie_index_path
+
+
+def _artifact_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load_movie_index(catalog_version=None):
+    """
+    Load the movie index from the published similarity version or the saved artifact, or from the
+    catalog table if neither has been built.
+
+    Args:
+        catalog_version (str): The catalog version read before loading, recorded on an index loaded
+            from the catalog table.
+
+    Returns:
+        MovieIndex: The loaded movie index.
+    """
+    path = _artifact_path()
+    mtime = _artifact_mtime(path)
+    if mtime is not None:
+        return MovieIndex(np.load(path), source=path, mtime=mtime)
+
+    # Same row order as the catalog was populated in, which follows movies.csv
+    movie_ids = [movie_id for movie_id, in db.session.query(MovielensMovie.movie_id)]
+    return MovieIndex(movie_ids, source='movielens_movies', catalog_version=catalog_version)
+
+
+def get_movie_index():
+    """
+    Get the process-wide movie index, loading it on first use.
+
+    The index is reloaded when the saved artifact changes on disk, when a new similarity version is
+    published, or after :func:`invalidate_movie_index`. Without an artifact, the index read from the
+    catalog table is reloaded whenever any process bumps the catalog version.
+
+    Returns:
+        MovieIndex: The movie index.
+    """
+    global _movie_index
+
+    movie_index = _movie_index
+    path = _artifact_path()
+    mtime = _artifact_mtime(path)
+    version = catalog_version_token() if mtime is None else None
+    if movie_index is not None and movie_index.mtime == mtime:
+        if mtime is not None and movie_index.source == path:
+            return movie_index
+        if mtime is None and movie_index.catalog_version == version:
+            return movie_index
+
+    with _movie_index_lock:
+        if _movie_index is movie_index:
+            _movie_index = load_movie_index(version)
+            print(f"Loaded movie index version {_movie_index.version} "
+                  f"({len(_movie_index)} movies) from {_movie_index.source}")
+        return _movie_index
+
+
+def invalidate_movie_index():
+    """
+    Drop the cached movie index so it is reloaded on next use, e.g. after the catalog is repopulated.
+    """
+    global _movie_index
+
+    with _movie_index_lock:
+        _movie_index = None
+
+
+def save_movie_index(movie_ids, path=movie_index_path):
+    """
+    Save movie IDs in similarity matrix row order.
+
+    Args:
+        movie_ids (list): The movie IDs, one per similarity matrix row.
+        path (str): The output ``.npy`` file.
+    """
+    np.save(path, np.asarray(movie_ids, dtype=np.int64))
+    invalidate_movie_index()
+
+
+@click.command('build-movie-index')
+@click.option('--from-db', is_flag=True, help='Read the movie IDs from the movielens_movies table instead of movies.csv.')
+@with_appcontext
+def build_movie_index_command(from_db):
+    """Save the movie ID <-> similarity matrix row mapping next to the similarity matrix."""
+    if from_db:
+        movie_ids = [movie_id for movie_id, in db.session.query(MovielensMovie.movie_id)]
+    else:
+        movie_ids = pd.read_csv(movies_csv_path, usecols=['movieId'])['movieId'].to_numpy()
+
+    save_movie_index(movie_ids)
+    movie_index = get_movie_index()
+    click.echo(f'Saved movie index version {movie_index.version} ({len(movie_index)} movies) to {movie_index_path}.')
@@ -0,0 +1,148 @@
+import os
+
+import click
+import numpy as np
+from flask.cli import with_appcontext
+from scipy.sparse import csr_matrix
+
+from flaskr.services.similarity_store import current_similarity_path, load_similarity_matrix
+
+# Construct the absolute path
+base_dir = os.path.abspath(os.path.dirname(__file__))
+# base file path for machine learning models
+base_path = os.path.join(base_dir, '../../../machine_learning/models/')
+neighbor_index_path = os.path.join(base_path, 'neighbor_index')
+
+# File names of the neighbor table inside its artifact directory
+NEIGHBOR_INDICES_FILE = 'neighbor_indices.npy'
+NEIGHBOR_SCORES_FILE = 'neighbor_scores.npy'
+
+# Number of neighbors kept per movie when building the table
+DEFAULT_NEIGHBORS = 50
+
+
+class NeighborIndex:
+    """
+    Read-only top-K neighbor table.
+
+    Row ``i`` of ``indices`` holds the matrix indices of the K most similar movies to movie index ``i``,
+    sorted by decreasing similarity, and row ``i`` of ``scores`` holds the matching similarity scores.
+    Rows with fewer than K neighbors are padded with -1 / 0.0.
+    """
+
+    def __init__(self, indices, scores):
+        self.indices = indices
+        self.scores = scores
+
+    @property
+    def k(self):
+        return self.indices.shape[1]
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    def lookup(self, idx, top_n=10):
+        """
+        Get the nearest neighbors of a movie index.
+
+        Args:
+            idx (int): The movie index in the similarity matrix.
+            top_n (int): The number of neighbors to return, at most ``k``.
+
+        Returns:
+            tuple: The neighbor indices (int32) and their similarity scores (float32).
+        """
+        neighbor_indices = self.indices[idx, :top_n]
+        valid = neighbor_indices >= 0
+        return np.asarray(neighbor_indices[valid]), np.asarray(self.scores[idx, :top_n][valid])
+
+
+def build_neighbor_index(similarity_matrix, k=DEFAULT_NEIGHBORS):
+    """
+    Turn a square similarity matrix into a top-K neighbor table.
+
+    Each row is processed on its stored (non-zero) entries only, so the full row is never densified.
+    The movie itself is excluded from its own neighbors.
+
+    Args:
+        similarity_matrix: A square (sparse) similarity matrix.
+        k (int): The number of neighbors to keep per movie.
+
+    Returns:
+        NeighborIndex: The in-memory neighbor table.
+    """
+    similarity_matrix = csr_matrix(similarity_matrix)
+    n_rows = similarity_matrix.shape[0]
+
+    neighbor_indices = np.full((n_rows, k), -1, dtype=np.int32)
+    neighbor_scores = np.zeros((n_rows, k), dtype=np.float32)
+
+    indptr = similarity_matrix.indptr
+    for row in range(n_rows):
+        start, end = indptr[row], indptr[row + 1]
+        columns = similarity_matrix.indices[start:end]
+        values = similarity_matrix.data[start:end]
+
+        keep = (columns != row) & (values > 0)
+        columns, values = columns[keep], values[keep]
+
+        if len(values) > k:
+            top = np.argpartition(-values, k - 1)[:k]
+            columns, values = columns[top], values[top]
+
+        order = np.argsort(-values, kind='stable')
+        neighbor_indices[row, :len(order)] = columns[order]
+        neighbor_scores[row, :len(order)] = values[order]
+
+    return NeighborIndex(neighbor_indices, neighbor_scores)
+
+
+def save_neighbor_index(neighbor_index, path):
+    """
+    Save a neighbor table as two fixed-width ``.npy`` arrays.
+
+    Args:
+        neighbor_index (NeighborIndex): The table to save.
+        path (str): The output directory.
+    """
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, NEIGHBOR_INDICES_FILE), np.ascontiguousarray(neighbor_index.indices, dtype=np.int32))
+    np.save(os.path.join(path, NEIGHBOR_SCORES_FILE), np.ascontiguousarray(neighbor_index.scores, dtype=np.float32))
+
+
+def load_neighbor_index(path):
+    """
+    Memory-map a neighbor table saved by :func:`save_neighbor_index`.
+
+    Args:
+        path (str): The directory containing the table.
+
+    Returns:
+        NeighborIndex: The memory-mapped table, or None if it has not been built.
+    """
+    indices_path = os.path.join(path, NEIGHBOR_INDICES_FILE)
+    scores_path = os.path.join(path, NEIGHBOR_SCORES_FILE)
+    if not (os.path.exists(indices_path) and os.path.exists(scores_path)):
+        return None
+
+    return NeighborIndex(np.load(indices_path, mmap_mode='r'), np.load(scores_path, mmap_mode='r'))
+
+
+def current_neighbor_index_path():
+    """
+    Get the neighbor table directory matching the served similarity matrix.
+    """
+    current = current_similarity_path()
+    return os.path.join(current, 'neighbor_index') if current is not None else neighbor_index_path
+
+
+@click.command('build-neighbor-index')
+@click.option('--k', default=DEFAULT_NEIGHBORS, show_default=True, help='Number of neighbors kept per movie.')
+@with_appcontext
+def build_neighbor_index_command(k):
+    """Build the top-K neighbor table from the cosine similarity matrix."""
+    similarity_matrix = load_similarity_matrix()
+    neighbor_index = build_neighbor_index(similarity_matrix, k=k)
+    path = current_neighbor_index_path()
+    save_neighbor_index(neighbor_index, path)
+    click.echo(f'Built neighbor index for {len(neighbor_index)} movies (k={k}) in {path}.')
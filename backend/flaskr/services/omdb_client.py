@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from flaskr import metrics
+
+# Load environment variables from the .env file
+load_dotenv()
+
+OMDB_API_KEY = os.getenv('OMDB_API_KEY')
+# Overridable so the client can be pointed at a local stub server
+OMDB_API_URL = os.getenv('OMDB_API_URL', "https://www.omdbapi.com/")
+# Seconds to wait for OMDB to connect and to answer
+OMDB_TIMEOUT = float(os.getenv('OMDB_TIMEOUT', 5))
+# Maximum number of concurrent requests to OMDB
+OMDB_MAX_WORKERS = int(os.getenv('OMDB_MAX_WORKERS', 8))
+# Retries on connection errors and 429/5xx responses, with exponential backoff
+OMDB_RETRIES = int(os.getenv('OMDB_RETRIES', 3))
+OMDB_BACKOFF_FACTOR = float(os.getenv('OMDB_BACKOFF_FACTOR', 0.5))
+# Maximum requests per second to OMDB, 0 for unlimited
+OMDB_RATE_LIMIT = float(os.getenv('OMDB_RATE_LIMIT', 0))
+
+
+class RateLimiter:
+    """
+    Token bucket allowing ``rate`` calls per second on average, shared by all threads.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a call is allowed.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class OmdbClient:
+    """
+    Thread-safe OMDB API client.
+
+    Requests go through a pooled HTTP session with per-call timeouts and retries with backoff, run on a
+    bounded worker pool, optionally under a rate limit, and concurrent requests for the same IMDb ID share
+    a single HTTP call.
+    """
+
+    def __init__(self, api_key=OMDB_API_KEY, base_url=OMDB_API_URL, timeout=OMDB_TIMEOUT,
+                 max_workers=OMDB_MAX_WORKERS, retries=OMDB_RETRIES, backoff_factor=OMDB_BACKOFF_FACTOR,
+                 rate_limit=OMDB_RATE_LIMIT):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='omdb')
+        self._in_flight = {}
+        self._in_flight_lock = threading.RLock()
+
+    def request(self, imdb_id):
+        """
+        Fetch movie details from the OMDB API on the calling thread.
+
+        Args:
+            imdb_id (str): The formatted IMDb ID.
+
+        Returns:
+            dict: The movie details from OMDB API, or None if an error occurs.
+        """
+        params = {
+            'i': imdb_id,
+            'apikey': self.api_key,
+            'plot': 'full',
+        }
+
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            response = self.session.get(self.base_url, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            movie_details = response.json()
+
+            if movie_details.get('Response') == 'True':
+                outcome = 'ok'
+                return movie_details
+            else:
+                outcome = 'not_found'
+                print(f"Error fetching details for IMDb ID {imdb_id}: {movie_details.get('Error')}")
+                return None
+
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Request error for IMDb ID {imdb_id}: {e}")
+            return None
+        finally:
+            metrics.observe('omdb_request_duration_seconds', time.perf_counter() - started, outcome=outcome)
+
+    def submit(self, imdb_id):
+        """
+        Schedule a fetch on the worker pool, joining the in-flight fetch of the same IMDb ID if there is one.
+
+        Args:
+            imdb_id (str): The formatted IMDb ID.
+
+        Returns:
+            concurrent.futures.Future: A future resolving to the movie details or None.
+        """
+        with self._in_flight_lock:
+            future = self._in_flight.get(imdb_id)
+            if future is None:
+                future = self._executor.submit(self.request, imdb_id)
+                self._in_flight[imdb_id] = future
+                future.add_done_callback(lambda done, key=imdb_id: self._forget(key, done))
+            return future
+
+    def _forget(self, imdb_id, future):
+        with self._in_flight_lock:
+            if self._in_flight.get(imdb_id) is future:
+                del self._in_flight[imdb_id]
+
+    def fetch(self, imdb_id):
+        return self.submit(imdb_id).result()
+
+    def fetch_many(self, imdb_ids):
+        """
+        Fetch movie details for several movies in parallel.
+
+        Args:
+            imdb_ids (list): The formatted IMDb IDs.
+
+        Returns:
+            dict: The movie details keyed by IMDb ID. Movies that could not be fetched are left out.
+        """
+        futures = {imdb_id: self.submit(imdb_id) for imdb_id in dict.fromkeys(imdb_ids)}
+        wait(futures.values())
+        return {imdb_id: future.result() for imdb_id, future in futures.items() if future.result()}
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+
+_omdb_client = None
+_omdb_client_lock = threading.Lock()
+
+
+def get_omdb_client():
+    """
+    Get the process-wide OMDB client, creating it on first use.
+
+    Returns:
+        OmdbClient: The shared client.
+    """
+    global _omdb_client
+
+    if _omdb_client is None:
+        with _omdb_client_lock:
+            if _omdb_client is None:
+                _omdb_client = OmdbClient()
+    return _omdb_client
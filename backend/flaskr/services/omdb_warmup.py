@@ -0,0 +1,162 @@
+import json
+import time
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from redis.exceptions import RedisError
+
+from flaskr import db
+from flaskr.database_models import MovielensMovie, MovieRatingStats, OmdbMovieDetails
+from flaskr.services.data_preparation import OMDB_CACHE_TIMEOUT, format_imdb_id, redis_client
+from flaskr.services.omdb_client import OmdbClient, OMDB_MAX_WORKERS
+
+# Number of movies fetched and committed together
+WARMUP_BATCH_SIZE = 200
+
+
+def cache_omdb_details(omdb_details, timeout=OMDB_CACHE_TIMEOUT):
+    """
+    Write OMDB details to the Redis cache in one pipeline.
+
+    Args:
+        omdb_details (dict): The movie details keyed by IMDb ID.
+        timeout (int): Time in seconds to cache the details, 0 to cache them indefinitely.
+
+    Returns:
+        bool: False if Redis is unavailable and nothing was cached.
+    """
+    pipeline = redis_client.pipeline(transaction=False)
+    for imdb_id, movie_details in omdb_details.items():
+        if timeout:
+            pipeline.setex(imdb_id, timeout, json.dumps(movie_details))
+        else:
+            pipeline.set(imdb_id, json.dumps(movie_details))
+    try:
+        pipeline.execute()
+    except RedisError as e:
+        # The details stay in omdb_movie_details, from which --restore reloads Redis
+        print(f"Could not cache {len(omdb_details)} OMDB details: {e}")
+        return False
+    return True
+
+
+def store_omdb_details(omdb_details):
+    """
+    Persist OMDB details to the omdb_movie_details table, replacing existing rows.
+
+    Args:
+        omdb_details (dict): The movie details keyed by IMDb ID.
+    """
+    fetched_at = datetime.utcnow()
+    for imdb_id, movie_details in omdb_details.items():
+        db.session.merge(OmdbMovieDetails(imdb_id=imdb_id, details=json.dumps(movie_details), fetched_at=fetched_at))
+
+
+def get_warmup_imdb_ids(top_n=None):
+    """
+    List the IMDb IDs to warm up, most rated movies first when ``top_n`` is given.
+
+    Args:
+        top_n (int): Only warm up the ``top_n`` most rated movies.
+
+    Returns:
+        list: The formatted IMDb IDs.
+    """
+    if top_n:
+        query = (db.session.query(MovielensMovie.imdb_id)
+                 .join(MovieRatingStats, MovieRatingStats.movie_id == MovielensMovie.movie_id)
+                 .filter(MovielensMovie.imdb_id.isnot(None))
+                 .order_by(MovieRatingStats.rating_count.desc())
+                 .limit(top_n))
+    else:
+        query = (db.session.query(MovielensMovie.imdb_id)
+                 .filter(MovielensMovie.imdb_id.isnot(None))
+                 .order_by(MovielensMovie.movie_id))
+
+    return list(dict.fromkeys(format_imdb_id(imdb_id) for imdb_id, in query))
+
+
+def restore_omdb_cache(timeout=OMDB_CACHE_TIMEOUT, batch_size=WARMUP_BATCH_SIZE):
+    """
+    Rebuild the Redis cache from the omdb_movie_details table without touching the network.
+
+    Returns:
+        int: The number of restored movies, without the batches Redis did not accept.
+    """
+    restored = 0
+    batch = {}
+    for row in OmdbMovieDetails.query.yield_per(batch_size):
+        batch[row.imdb_id] = json.loads(row.details)
+        if len(batch) >= batch_size:
+            if cache_omdb_details(batch, timeout):
+                restored += len(batch)
+            batch = {}
+
+    if batch and cache_omdb_details(batch, timeout):
+        restored += len(batch)
+
+    return restored
+
+
+@click.command('warm-omdb-cache')
+@click.option('--top-n', type=int, default=None, help='Only warm up the N most rated movies.')
+@click.option('--rate', type=float, default=5.0, show_default=True, help='Maximum OMDB requests per second.')
+@click.option('--workers', type=int, default=OMDB_MAX_WORKERS, show_default=True, help='Concurrent OMDB requests.')
+@click.option('--batch-size', type=int, default=WARMUP_BATCH_SIZE, show_default=True,
+              help='Movies fetched and committed together.')
+@click.option('--timeout', type=int, default=OMDB_CACHE_TIMEOUT, show_default=True,
+              help='Redis TTL in seconds, 0 to cache indefinitely.')
+@click.option('--restore', is_flag=True, help='Only reload Redis from the omdb_movie_details table.')
+@with_appcontext
+def warm_omdb_cache_command(top_n, rate, workers, batch_size, timeout, restore):
+    """Fetch missing OMDB metadata into Redis and the omdb_movie_details table.
+
+    Movies already stored in omdb_movie_details are skipped, so an interrupted run resumes where it
+    stopped. Details found in Redis are persisted without a network call.
+    """
+    if restore:
+        click.echo(f'Restored {restore_omdb_cache(timeout, batch_size)} movies into Redis.')
+        return
+
+    imdb_ids = get_warmup_imdb_ids(top_n)
+    stored_ids = {imdb_id for imdb_id, in db.session.query(OmdbMovieDetails.imdb_id)}
+    pending_ids = [imdb_id for imdb_id in imdb_ids if imdb_id not in stored_ids]
+    click.echo(f'{len(imdb_ids)} movies selected, {len(imdb_ids) - len(pending_ids)} already stored, '
+               f'{len(pending_ids)} to fetch.')
+
+    client = OmdbClient(max_workers=workers, rate_limit=rate)
+    fetched = failed = 0
+    started = time.monotonic()
+    try:
+        with click.progressbar(length=len(pending_ids), label='Warming OMDB cache') as progress:
+            for start in range(0, len(pending_ids), batch_size):
+                batch_ids = pending_ids[start:start + batch_size]
+
+                # Reuse what Redis already has, fetch the rest from OMDB
+                try:
+                    cached = redis_client.mget(batch_ids)
+                except RedisError:
+                    # Redis is down: fetch every movie, the table does not depend on it
+                    cached = [None] * len(batch_ids)
+                omdb_details = {
+                    imdb_id: json.loads(cached_data) for imdb_id, cached_data in zip(batch_ids, cached) if cached_data
+                }
+                omdb_details.update(client.fetch_many(
+                    [imdb_id for imdb_id in batch_ids if imdb_id not in omdb_details]
+                ))
+
+                if omdb_details:
+                    store_omdb_details(omdb_details)
+                    db.session.commit()
+                    cache_omdb_details(omdb_details, timeout)
+
+                fetched += len(omdb_details)
+                failed += len(batch_ids) - len(omdb_details)
+                progress.update(len(batch_ids))
+    finally:
+        client.close()
+
+    elapsed = time.monotonic() - started
+    click.echo(f'Stored {fetched} movies, {failed} failed, in {elapsed:.1f}s '
+               f'({fetched / elapsed if elapsed else 0:.1f} movies/s).')
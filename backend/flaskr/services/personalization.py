@@ -0,0 +1,163 @@
+import json
+
+import numpy as np
+from redis.exceptions import RedisError
+
+from flaskr import db
+from flaskr.database_models import UserRatings, UserWatchHistory
+from flaskr.decorators import invalidate_cache_tags, user_cache_tag
+from flaskr.services.ann_index import ann_index
+from flaskr.services.collaborative_filtering import factor_model
+from flaskr.services.data_preparation import get_movie_details_batch
+from flaskr.services.movie_index import get_movie_index
+from flaskr.services.recommandation_service import get_blended_indices
+from flaskr.services.redis_pool import get_redis_client
+
+# Time in seconds a user's recommendations stay cached, unless their ratings or history change first
+PERSONALIZED_CACHE_TIMEOUT = 3600
+# Ratings at this value are neutral; lower ratings push similar movies down
+NEUTRAL_RATING = 3
+# Weight of a watched movie the user has not rated
+WATCHED_WEIGHT = 1.0
+
+
+def build_user_profile(user_id):
+    """
+    Build the weighted seed movies describing a user's taste.
+
+    Rated movies are weighted by how far their rating is from neutral, and watched movies the user
+    has not rated count as a mild positive signal.
+
+    Args:
+        user_id (int): The user ID.
+
+    Returns:
+        tuple: The seed movie IDs, their weights, and the IDs of every movie the user has already seen.
+    """
+    profile = {
+        movie_id: WATCHED_WEIGHT
+        for movie_id, in db.session.query(UserWatchHistory.movie_id).filter(UserWatchHistory.user_id == user_id)
+    }
+    for movie_id, rating in db.session.query(UserRatings.movie_id, UserRatings.rating).filter(
+            UserRatings.user_id == user_id):
+        profile[movie_id] = float(rating - NEUTRAL_RATING)
+
+    seen_movie_ids = list(profile)
+    seed_movie_ids = [movie_id for movie_id, weight in profile.items() if weight != 0]
+    return seed_movie_ids, [profile[movie_id] for movie_id in seed_movie_ids], seen_movie_ids
+
+
+def _cache_key(user_id, top_n, engine):
+    version = get_redis_client().get(f"for_me_version:{user_id}") or 0
+    return f"for_me:{user_id}:{version}:{engine}:{top_n}"
+
+
+def invalidate_user_recommendations(user_id):
+    """
+    Drop the cached recommendations of a user, e.g. after they rate or watch a movie.
+
+    Bumps a per-user version that is part of the cache keys, so stale entries are never read again
+    and simply expire.
+    """
+    try:
+        get_redis_client().incr(f"for_me_version:{user_id}")
+    except RedisError as e:
+        print(f"Could not invalidate the recommendations of user {user_id}: {e}")
+    # Blended recommendations cached for the user exclude their watch history too
+    invalidate_cache_tags(user_cache_tag(user_id))
+
+
+def _content_recommendations(user_id, top_n):
+    seed_movie_ids, weights, seen_movie_ids = build_user_profile(user_id)
+
+    movie_index = get_movie_index()
+    seed_indices = movie_index.indices_of(seed_movie_ids)
+    found = seed_indices >= 0
+
+    recommended_movie_ids = []
+    if found.any():
+        seen_indices = movie_index.indices_of(seen_movie_ids)
+        blended_indices = get_blended_indices(
+            seed_indices[found],
+            top_n=top_n,
+            weights=np.asarray(weights)[found],
+            exclude_indices=seen_indices[seen_indices >= 0],
+        )
+        recommended_movie_ids = movie_index.movie_ids_of(blended_indices)
+
+    return int(found.sum()), recommended_movie_ids
+
+
+def _collaborative_recommendations(user_id, top_n):
+    """
+    Fold the user's ratings into the trained factor model and rank every movie for them.
+
+    Returns:
+        tuple: The number of ratings used and the recommended movie IDs, or None if the model is not
+        trained or knows none of the user's movies.
+    """
+    model = factor_model.get()
+    if model is None:
+        return None
+
+    ratings = db.session.query(UserRatings.movie_id, UserRatings.rating).filter(UserRatings.user_id == user_id).all()
+    user_factors = model.fold_in([movie_id for movie_id, _ in ratings], [rating for _, rating in ratings])
+    if user_factors is None:
+        return None
+
+    seen_movie_ids = [movie_id for movie_id, in
+                      db.session.query(UserWatchHistory.movie_id).filter(UserWatchHistory.user_id == user_id)]
+    seen_movie_ids.extend(movie_id for movie_id, _ in ratings)
+
+    # Scan a few clusters of the ANN index instead of every item when it was built over these factors;
+    # an index built before the model was last trained holds stale vectors, possibly of another size
+    index = ann_index.get()
+    if index is not None and index.source == 'collaborative' and index.model_fingerprint is not None \
+            and index.model_fingerprint == model.fingerprint:
+        return len(ratings), index.search_movie_ids(user_factors, top_n, exclude_movie_ids=seen_movie_ids)
+    return len(ratings), model.recommend(user_factors, top_n, exclude_movie_ids=seen_movie_ids)
+
+
+def get_personalized_recommendations(user_id, top_n=10, engine='content'):
+    """
+    Recommend movies for a user from their ratings and watch history.
+
+    The content engine scores every seed movie's similarity row in one vectorized pass. The
+    collaborative engine folds the user's ratings into the matrix factorization model, and falls
+    back to the content engine when the model is not trained or the user has no usable ratings.
+    Already seen movies are filtered out, and the result is cached per user.
+
+    Args:
+        user_id (int): The user ID.
+        top_n (int): The number of movies to recommend.
+        engine (str): 'content' or 'collaborative'.
+
+    Returns:
+        dict: The engine used, the number of movies the profile is based on and the recommended movies.
+    """
+    try:
+        cache_key = _cache_key(user_id, top_n, engine)
+        cached_response = get_redis_client().get(cache_key)
+    except RedisError:
+        # Redis is down, compute without the cache
+        cache_key = cached_response = None
+    if cached_response:
+        return json.loads(cached_response)
+
+    result = _collaborative_recommendations(user_id, top_n) if engine == 'collaborative' else None
+    if result is None:
+        engine = 'content'
+        result = _content_recommendations(user_id, top_n)
+    based_on, recommended_movie_ids = result
+
+    recommendations = {
+        'engine': engine,
+        'based_on': based_on,
+        'recommended_movies': get_movie_details_batch(recommended_movie_ids),
+    }
+    if cache_key is not None:
+        try:
+            get_redis_client().setex(cache_key, PERSONALIZED_CACHE_TIMEOUT, json.dumps(recommendations))
+        except RedisError:
+            pass
+    return recommendations
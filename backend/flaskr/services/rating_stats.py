@@ -0,0 +1,113 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, insert, select, update
+
+from flaskr import db
+from flaskr.database_models import MovieRatingStats, MovielensRating
+from flaskr.decorators import invalidate_cache_tags
+from flaskr.services.catalog_version import bump_catalog_version
+
+# Number of "prior" votes at the global mean added to every movie by the Bayesian score.
+# Movies with far fewer ratings than this are pulled towards the global mean.
+BAYESIAN_PRIOR_VOTES = 50
+
+
+def rebuild_movie_rating_stats():
+    """
+    Recompute movie_rating_stats from scratch with a single INSERT ... SELECT ... GROUP BY.
+
+    Does not commit.
+    """
+    db.session.execute(MovieRatingStats.__table__.delete())
+    db.session.execute(insert(MovieRatingStats.__table__).from_select(
+        ['movie_id', 'rating_count', 'rating_sum', 'rating_mean', 'weighted_score'],
+        select(
+            MovielensRating.movie_id,
+            func.count(MovielensRating.rating),
+            func.sum(MovielensRating.rating),
+            func.avg(MovielensRating.rating),
+            func.avg(MovielensRating.rating),
+        ).where(MovielensRating.rating.isnot(None)).group_by(MovielensRating.movie_id)
+    ))
+    refresh_weighted_scores()
+
+
+def apply_rating_deltas(deltas):
+    """
+    Fold newly inserted ratings into movie_rating_stats.
+
+    Does not commit, so the deltas can be applied in the same transaction as the ratings themselves.
+
+    Args:
+        deltas: A mapping of movie ID to a ``(rating_count, rating_sum)`` pair of the new ratings.
+    """
+    if not deltas:
+        return
+
+    deltas = {int(movie_id): delta for movie_id, delta in deltas.items()}
+    existing = {
+        stats.movie_id: stats
+        for stats in MovieRatingStats.query.filter(MovieRatingStats.movie_id.in_(list(deltas))).all()
+    }
+    prior_mean = get_global_mean()
+
+    new_stats = []
+    updated_stats = []
+    for movie_id, (count, total) in deltas.items():
+        stats = existing.get(movie_id)
+        rating_count = int(count) + (stats.rating_count if stats else 0)
+        rating_sum = float(total) + (stats.rating_sum if stats else 0.0)
+        values = {
+            'movie_id': movie_id,
+            'rating_count': rating_count,
+            'rating_sum': rating_sum,
+            'rating_mean': rating_sum / rating_count,
+            'weighted_score': bayesian_score(rating_count, rating_sum, prior_mean),
+        }
+        (updated_stats if stats else new_stats).append(values)
+
+    if updated_stats:
+        db.session.bulk_update_mappings(MovieRatingStats, updated_stats)
+    if new_stats:
+        db.session.bulk_insert_mappings(MovieRatingStats, new_stats)
+
+
+def get_global_mean():
+    """
+    Get the mean of all ratings, used as the prior of the Bayesian score.
+
+    Returns:
+        float: The global mean, or 0.0 when there are no ratings yet.
+    """
+    total_count, total_sum = db.session.query(
+        func.sum(MovieRatingStats.rating_count), func.sum(MovieRatingStats.rating_sum)
+    ).one()
+    return float(total_sum) / float(total_count) if total_count else 0.0
+
+
+def bayesian_score(rating_count, rating_sum, prior_mean, prior_votes=BAYESIAN_PRIOR_VOTES):
+    return (rating_sum + prior_votes * prior_mean) / (rating_count + prior_votes)
+
+
+def refresh_weighted_scores(prior_votes=BAYESIAN_PRIOR_VOTES):
+    """
+    Recompute the Bayesian score of every movie against the current global mean in one UPDATE.
+
+    Does not commit.
+    """
+    prior_mean = get_global_mean()
+    db.session.execute(update(MovieRatingStats).values(
+        weighted_score=(MovieRatingStats.rating_sum + prior_votes * prior_mean)
+        / (MovieRatingStats.rating_count + prior_votes)
+    ))
+
+
+@click.command('rebuild-rating-stats')
+@with_appcontext
+def rebuild_rating_stats_command():
+    """Recompute movie_rating_stats from movielens_ratings."""
+    rebuild_movie_rating_stats()
+    db.session.commit()
+    invalidate_cache_tags('ratings')
+    bump_catalog_version()
+    click.echo(f'Rebuilt rating stats for {MovieRatingStats.query.count()} movies.')
@@ -1,96 +1,285 @@
-import os
-
 import numpy as np
-import joblib
-
 from scipy.sparse import csr_matrix
-from flaskr.services.data_preparation import get_movie_details
 
-from flaskr.database_models import MovielensMovie
+from flaskr.services.data_preparation import get_movie_details_batch
+from flaskr.services.genre_index import get_genre_index
+from flaskr.services.movie_index import get_movie_index
+from flaskr.services.neighbor_index import current_neighbor_index_path, load_neighbor_index
+from flaskr.services.resources import LazyResource
+from flaskr.services.similarity_store import load_similarity_matrix, similarity_version_token
+from flaskr.services.title_index import get_title_index
+
+# Number of movies a single title resolves to at most
+MAX_MATCHES_PER_TITLE = 3
+# Number of input movies a request is expanded into at most
+MAX_RESOLVED_IDS = 10
+
+# Load the similarity matrix on first use, and again whenever a new version is published
+sparse_similarity_matrix = LazyResource('similarity_matrix', load_similarity_matrix, version=similarity_version_token)
+# Load the precomputed top-K neighbor table, if it has been built with `flask build-neighbor-index`
+neighbor_index = LazyResource('neighbor_index', lambda: load_neighbor_index(current_neighbor_index_path()),
+                              version=similarity_version_token)
+
+
+def get_similar_indices(idx, top_n=10, mask=None):
+    """
+    Get the matrix indices of the movies most similar to a movie, excluding the movie itself.
+
+    Served from the precomputed neighbor table in O(K) when it is available and holds enough
+    candidates, otherwise from the stored entries of the similarity matrix row.
+
+    Args:
+        idx (int): The movie index in the similarity matrix.
+        top_n (int): The number of similar movies to return.
+        mask (np.ndarray): Optional boolean bitmap over the matrix rows; only movies set in it are returned.
+
+    Returns:
+        list: The matrix indices of the similar movies, most similar first.
+    """
+    if top_n < 1:
+        # A negative top_n would slice the neighbor table from its end
+        return []
+
+    neighbors = neighbor_index.get()
+    if neighbors is not None and top_n <= neighbors.k:
+        if mask is None:
+            neighbor_indices, _ = neighbors.lookup(idx, top_n)
+            return neighbor_indices.tolist()
+
+        # A filtered query can be answered from the table if enough neighbors pass the filter,
+        # or if the table already holds every neighbor of the movie
+        neighbor_indices, _ = neighbors.lookup(idx, neighbors.k)
+        neighbor_indices = neighbor_indices[mask[neighbor_indices]]
+        if len(neighbor_indices) >= top_n or neighbors.indices[idx, -1] < 0:
+            return neighbor_indices[:top_n].tolist()
+
+    row = sparse_similarity_matrix.get()[idx]
+    columns, values = row.indices, row.data
+    keep = columns != idx
+    if mask is not None:
+        keep &= mask[columns]
+
+    return select_top(columns[keep], values[keep], top_n)
 
-# Construct the absolute path
-base_dir = os.path.abspath(os.path.dirname(__file__))
-# base file path for machine learning models
-base_path = os.path.join(base_dir, '../../../machine_learning/models/')
-# Load the similarity matrix
-sparse_similarity_matrix = csr_matrix(joblib.load(base_path + 'cosine_similarity_matrix.joblib', mmap_mode='r'))
 
+def select_top(columns, values, top_n):
+    """
+    Select the ``top_n`` highest scored columns with ``argpartition``, without sorting all of them.
 
-def get_recommendations(movie_id, movie_indices, top_n=10):
-    index_to_movie_id = {v: k for k, v in movie_indices.items()}
+    Returns:
+        list: The selected columns, highest score first.
+    """
+    if top_n < 1:
+        return []
+    if len(values) > top_n:
+        top = np.argpartition(-values, top_n - 1)[:top_n]
+        columns, values = columns[top], values[top]
+
+    return columns[np.argsort(-values, kind='stable')].tolist()
+
+
+def get_recommendations(movie_id, top_n=10, movie_index=None, genre_mask=None):
+    movie_index = movie_index or get_movie_index()
 
-    idx = movie_indices.get(movie_id)
+    idx = movie_index.index_of(movie_id)
     if idx is None:
         return []
 
-    sim_scores = sparse_similarity_matrix[idx].toarray().flatten()
-    sorted_indices = np.argsort(sim_scores)[::-1]
+    return movie_index.movie_ids_of(get_similar_indices(idx, top_n, mask=genre_mask))
+
+
+def get_blended_indices(seed_indices, top_n=10, weights=None, exclude_indices=None, mask=None):
+    """
+    Rank movies by their weighted similarity to several seed movies at once.
+
+    The similarity rows of all seeds are summed in one sparse vector-matrix product, and the top
+    candidates are selected with ``argpartition``.
+
+    Args:
+        seed_indices (list): The matrix indices of the seed movies.
+        top_n (int): The number of movies to return.
+        weights (list): One weight per seed, 1.0 each by default.
+        exclude_indices (list): Matrix indices that must not be returned, e.g. already watched movies.
+            The seeds themselves are always excluded.
+        mask (np.ndarray): Optional boolean bitmap over the matrix rows; only movies set in it are returned.
+
+    Returns:
+        list: The matrix indices of the recommended movies, best first.
+    """
+    similarity_matrix = sparse_similarity_matrix.get()
+    n_movies = similarity_matrix.shape[0]
+
+    seed_indices = np.asarray(seed_indices, dtype=np.int64)
+    weights = np.ones(len(seed_indices)) if weights is None else np.asarray(weights, dtype=np.float64)
+    selector = csr_matrix(
+        (weights, (np.zeros(len(seed_indices), dtype=np.int64), seed_indices)), shape=(1, n_movies)
+    )
+    scores = (selector @ similarity_matrix).tocsr()
+
+    excluded = np.zeros(n_movies, dtype=bool)
+    excluded[seed_indices] = True
+    if exclude_indices is not None and len(exclude_indices):
+        excluded[np.asarray(exclude_indices, dtype=np.int64)] = True
+
+    columns, values = scores.indices, scores.data
+    keep = ~excluded[columns] & (values > 0)
+    if mask is not None:
+        keep &= mask[columns]
+
+    return select_top(columns[keep], values[keep], top_n)
+
 
-    top_similar_indices = [index_to_movie_id[j] for j in sorted_indices[:top_n] if j != idx]
-    return top_similar_indices
+def get_blended_recommendations(movie_input, top_n=10, weights=None, exclude_movie_ids=None, genre=None):
+    """
+    Recommend one ranked list of movies for a set of seed movies ("because you liked X, Y, Z").
+
+    Args:
+        movie_input: A movie ID, movie name, or a list of movie IDs/names.
+        top_n (int): The number of movies to recommend.
+        weights (list): One weight per ``movie_input`` item. A name matching several movies gives each
+            of them the weight of the name.
+        exclude_movie_ids (list): Movie IDs that must not be recommended, e.g. already watched movies.
+        genre (str): Only recommend movies of this genre.
+
+    Returns:
+        dict: The seed movies and the recommended movies, or an error message string.
+    """
+    items = movie_input if isinstance(movie_input, list) else [movie_input]
+    if weights is not None and len(weights) != len(items):
+        return "Please provide one weight per movie input."
+
+    movie_index = get_movie_index()
+
+    seed_movie_ids = []
+    seed_weights = []
+    for position, item in enumerate(items):
+        item_movie_ids = get_movie_ids(item)
+        if isinstance(item_movie_ids, str):
+            return item_movie_ids
+        seed_movie_ids.extend(item_movie_ids)
+        seed_weights.extend([weights[position] if weights is not None else 1.0] * len(item_movie_ids))
+
+    seed_indices = movie_index.indices_of(seed_movie_ids)
+    found = seed_indices >= 0
+    if not found.any():
+        return {'seed_movies': [], 'recommended_movies': []}
+
+    exclude_indices = movie_index.indices_of(exclude_movie_ids or [])
+    blended_indices = get_blended_indices(
+        seed_indices[found],
+        top_n=top_n,
+        weights=np.asarray(seed_weights)[found],
+        exclude_indices=exclude_indices[exclude_indices >= 0],
+        mask=get_genre_index().mask(genre) if genre else None,
+    )
+    recommended_movie_ids = movie_index.movie_ids_of(blended_indices)
+
+    # Hydrate the seed and recommended movies in a single batch
+    seed_movie_ids = list(dict.fromkeys(np.asarray(seed_movie_ids)[found].tolist()))
+    movie_details = {
+        details['movie_id']: details for details in get_movie_details_batch(seed_movie_ids + recommended_movie_ids)
+    }
+
+    return {
+        'seed_movies': [movie_details[movie_id] for movie_id in seed_movie_ids if movie_id in movie_details],
+        'recommended_movies': [
+            movie_details[movie_id] for movie_id in recommended_movie_ids if movie_id in movie_details
+        ],
+    }
+
+
+def find_movie_matches(movie_name, limit=MAX_MATCHES_PER_TITLE):
+    """
+    Resolve a possibly misspelled title to the movies it most likely means, with a confidence score.
+    """
+    return get_title_index().resolve(movie_name, limit=limit)
 
 
 def find_movie_ids_by_name(movie_name):
-    matching_movies = MovielensMovie.query.filter(
-        MovielensMovie.movie_name.ilike(f"%{movie_name}%")
-    ).all()
-    return [movie.movie_id for movie in matching_movies]
+    return [match['movie_id'] for match in find_movie_matches(movie_name)]
 
 
-def get_movie_ids(movie_input):
-    movie_ids = []
-    if isinstance(movie_input, list):
-        for movie in movie_input:
-            if isinstance(movie, int):
-                movie_ids.append(movie)
-            elif isinstance(movie, str):
-                movie_ids.extend(find_movie_ids_by_name(movie))
-            else:
-                return "Invalid input type. Please provide a movie ID (int) or movie name (str)."
-    elif isinstance(movie_input, int) or isinstance(movie_input, str):
-        if isinstance(movie_input, int):
-            movie_ids = [movie_input]
-        elif isinstance(movie_input, str):
-            movie_ids = find_movie_ids_by_name(movie_input)
-            if not movie_ids:
-                return f"No movie with the name '{movie_input}' exists. Please try again."
+def resolve_movie_input(movie_input):
+    """
+    Resolve movie IDs and titles to at most ``MAX_RESOLVED_IDS`` distinct movie IDs.
+
+    Args:
+        movie_input: A movie ID, movie name, or a list of movie IDs/names.
+
+    Returns:
+        list: ``(movie_id, confidence)`` pairs, the confidence being None for IDs given as such, or an
+        error message string.
+    """
+    if isinstance(movie_input, (int, str)):
+        items = [movie_input]
+    elif isinstance(movie_input, list):
+        items = movie_input
     else:
         return "Invalid input type. Please provide a movie ID (int), movie name (str) or list of movie IDs/names."
 
-    return movie_ids
+    resolved = {}
+    for item in items:
+        if isinstance(item, int):
+            resolved.setdefault(item, None)
+        elif isinstance(item, str):
+            matches = find_movie_matches(item)
+            if not matches and not isinstance(movie_input, list):
+                return f"No movie with the name '{movie_input}' exists. Please try again."
+            for match in matches:
+                resolved.setdefault(match['movie_id'], match['confidence'])
+        else:
+            return "Invalid input type. Please provide a movie ID (int) or movie name (str)."
 
+    # Every resolved movie is expanded into its own recommendations, so bound the work per request
+    return list(resolved.items())[:MAX_RESOLVED_IDS]
 
-def get_movie_recommendations(movie_input, top_n=10):
-    top_n = top_n + 1 # Include the input movie in the recommendations
-    input_movie_ids = get_movie_ids(movie_input)
-    # movie_indices_local = {movieId: idx for idx, movieId in enumerate(movie_dataset['movieId'])}
-    movie_indices_local = {
-        movie.movie_id: idx for idx, movie in enumerate(MovielensMovie.query.all())
-    }
-    recommendations_dict = []
 
-    for movie_id in input_movie_ids:
-        movie = MovielensMovie.query.get(movie_id)
-        if not movie:
-            continue
+def get_movie_ids(movie_input):
+    resolved = resolve_movie_input(movie_input)
+    if isinstance(resolved, str):
+        return resolved
+    return [movie_id for movie_id, _ in resolved]
+
 
-        input_movie_info = get_movie_details(movie_id)[0]
+def get_movie_recommendations(movie_input, top_n=10, genre=None):
+    resolved = resolve_movie_input(movie_input)
+    if isinstance(resolved, str):
+        return []
+    input_movie_ids = [movie_id for movie_id, _ in resolved]
+    confidences = dict(resolved)
 
-        # Get the recommendations based on the movie ID
-        _recommendations = get_recommendations(movie_id, movie_indices=movie_indices_local, top_n=top_n)
-        print(f"Recommendations for movie ID {movie_id}: {_recommendations}")
+    movie_index = get_movie_index()
+    genre_mask = get_genre_index().mask(genre) if genre else None
 
-        recommended_movies_info = []
+    # Get the recommendations based on the movie ID
+    recommendations = {}
+    for movie_id in input_movie_ids:
+        recommendations[movie_id] = get_recommendations(
+            movie_id, top_n=top_n, movie_index=movie_index, genre_mask=genre_mask
+        )
+        print(f"Recommendations for movie ID {movie_id}: {recommendations[movie_id]}")
 
-        for rec_movie_id in _recommendations:
-            recommended_movie = get_movie_details(rec_movie_id)[0]
-            if recommended_movie:
-                movie_info = recommended_movie
-                recommended_movies_info.append(movie_info)
+    # Hydrate the input and recommended movies in a single batch
+    all_movie_ids = list(input_movie_ids) + [
+        rec_movie_id for rec_movie_ids in recommendations.values() for rec_movie_id in rec_movie_ids
+    ]
+    movie_details = {details['movie_id']: details for details in get_movie_details_batch(all_movie_ids)}
+
+    recommendations_dict = []
+    for movie_id, rec_movie_ids in recommendations.items():
+        input_movie_info = movie_details.get(movie_id)
+        if not input_movie_info:
+            continue
 
-        recommendations_dict.append({
+        recommendation = {
             'movie': input_movie_info,
-            'recommended_movies': recommended_movies_info
-        })
+            'recommended_movies': [
+                movie_details[rec_movie_id] for rec_movie_id in rec_movie_ids if rec_movie_id in movie_details
+            ]
+        }
+        if confidences[movie_id] is not None:
+            # How closely the movie title matched the name it was resolved from
+            recommendation['match_confidence'] = confidences[movie_id]
+        recommendations_dict.append(recommendation)
 
     return recommendations_dict
@@ -0,0 +1,220 @@
+import os
+import threading
+import time
+
+import redis
+from dotenv import load_dotenv
+from redis.client import Pipeline
+from redis.exceptions import ConnectionError, TimeoutError
+
+from flaskr.metrics import Histogram, metrics_enabled
+
+# Load environment variables from the .env file
+load_dotenv()
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+# Seconds to wait for Redis to connect and to answer; keep them short, the caller falls back to the database
+REDIS_CONNECT_TIMEOUT = float(os.getenv('REDIS_CONNECT_TIMEOUT', 0.5))
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', 0.5))
+# Connections kept by every process
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 32))
+# Consecutive connection failures after which calls fail fast, and for how many seconds
+REDIS_BREAKER_THRESHOLD = int(os.getenv('REDIS_BREAKER_THRESHOLD', 5))
+REDIS_BREAKER_COOLDOWN = float(os.getenv('REDIS_BREAKER_COOLDOWN', 10))
+
+
+class RedisUnavailable(ConnectionError):
+    """
+    Raised without calling Redis while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Fail fast after ``threshold`` consecutive failures, for ``cooldown`` seconds.
+
+    Once the cooldown is over, a single trial call is let through: the breaker closes again if it
+    succeeds, and stays open for another cooldown otherwise.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.cooldown else 'open'
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        with self._lock:
+            if self._trial or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        if self.failures or self.opened_at is not None:
+            with self._lock:
+                self.failures = 0
+                self.opened_at = None
+                self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    print(f"Redis unavailable after {self.failures} failures, failing fast for {self.cooldown}s")
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+
+class RedisMetrics:
+    """
+    Call counters and latency of the shared client, across all threads of the process.
+
+    Nothing is recorded unless metrics are enabled, like the metrics of :mod:`flaskr.metrics`.
+    """
+
+    def __init__(self):
+        self.outcomes = {'ok': 0, 'error': 0, 'rejected': 0}
+        self.latency = Histogram()
+        self._lock = threading.Lock()
+
+    def record(self, seconds, error=False):
+        if not metrics_enabled():
+            return
+        with self._lock:
+            self.outcomes['error' if error else 'ok'] += 1
+            self.latency.observe(seconds)
+
+    def record_rejected(self):
+        if not metrics_enabled():
+            return
+        with self._lock:
+            self.outcomes['rejected'] += 1
+
+    def snapshot(self):
+        """
+        Returns:
+            tuple: A copy of the call counts by outcome and of the latency histogram.
+        """
+        with self._lock:
+            return dict(self.outcomes), self.latency.copy()
+
+
+class GuardedRedis(redis.StrictRedis):
+    """
+    Redis client whose commands go through a circuit breaker and are timed.
+
+    Connection errors and timeouts count as failures. Other errors, e.g. a wrong type, mean Redis
+    answered and do not.
+    """
+
+    def __init__(self, breaker, metrics, **kwargs):
+        super().__init__(**kwargs)
+        self.breaker = breaker
+        self.metrics = metrics
+
+    def guarded(self, call, *args, **kwargs):
+        if not self.breaker.allow():
+            self.metrics.record_rejected()
+            raise RedisUnavailable('Redis circuit breaker is open')
+
+        started = time.perf_counter()
+        try:
+            result = call(*args, **kwargs)
+        except (ConnectionError, TimeoutError):
+            self.metrics.record(time.perf_counter() - started, error=True)
+            self.breaker.record_failure()
+            raise
+        except Exception:
+            # Redis answered, e.g. with a WRONGTYPE error
+            self.metrics.record(time.perf_counter() - started, error=True)
+            self.breaker.record_success()
+            raise
+        else:
+            self.metrics.record(time.perf_counter() - started)
+            self.breaker.record_success()
+            return result
+
+    def execute_command(self, *args, **options):
+        return self.guarded(super().execute_command, *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return GuardedPipeline(self, self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class GuardedPipeline(Pipeline):
+    """
+    Pipeline executed through the circuit breaker of the client that created it.
+    """
+
+    def __init__(self, client, *args):
+        super().__init__(*args)
+        self.client = client
+
+    def execute(self, raise_on_error=True):
+        return self.client.guarded(super().execute, raise_on_error)
+
+
+_redis_client = None
+_redis_client_lock = threading.Lock()
+
+
+def get_redis_client():
+    """
+    Get the Redis client shared by the whole process.
+
+    Connections come from a single pool, which redis-py recreates in forked workers. Commands fail
+    fast with :class:`RedisUnavailable` while Redis is down, so callers should catch
+    ``redis.exceptions.RedisError`` and carry on without the cache.
+
+    Returns:
+        GuardedRedis: The client, decoding responses to str.
+    """
+    global _redis_client
+
+    if _redis_client is None:
+        with _redis_client_lock:
+            if _redis_client is None:
+                pool = redis.ConnectionPool.from_url(
+                    REDIS_URL,
+                    decode_responses=True,
+                    socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+                    socket_timeout=REDIS_SOCKET_TIMEOUT,
+                    max_connections=REDIS_MAX_CONNECTIONS,
+                    health_check_interval=30,
+                )
+                _redis_client = GuardedRedis(
+                    CircuitBreaker(REDIS_BREAKER_THRESHOLD, REDIS_BREAKER_COOLDOWN), RedisMetrics(),
+                    connection_pool=pool,
+                )
+    return _redis_client
+
+
+def redis_stats():
+    """
+    Get the state and counters of the shared client.
+
+    Returns:
+        dict: The breaker state, number of calls, failed calls, calls rejected by the breaker and total
+        seconds spent in Redis, the counters staying at 0 unless metrics are enabled.
+    """
+    client = get_redis_client()
+    outcomes, latency = client.metrics.snapshot()
+    return {
+        'state': client.breaker.state,
+        'calls': outcomes['ok'] + outcomes['error'],
+        'errors': outcomes['error'],
+        'rejected': outcomes['rejected'],
+        'seconds': latency.sum,
+    }
@@ -0,0 +1,83 @@
+import threading
+import time
+
+_NOT_LOADED = object()
+
+# Every LazyResource, by name, in creation order
+_resources = {}
+
+
+class LazyResource:
+    """
+    A heavy resource (CSV, model, matrix...) loaded on first use and then shared by the whole process.
+
+    Loading is thread-safe: concurrent first calls wait for a single load. Loaded resources can be
+    preloaded in the gunicorn master before forking so that workers share their pages copy-on-write.
+
+    If ``version`` is given, it is called on every access and the resource is loaded again whenever
+    the value it returns changes, e.g. when a new artifact is published on disk.
+    """
+
+    def __init__(self, name, loader, version=None):
+        self.name = name
+        self.loader = loader
+        self.version = version
+        self.load_time = None
+        self._value = _NOT_LOADED
+        self._loaded_version = None
+        self._lock = threading.Lock()
+        _resources[name] = self
+
+    @property
+    def loaded(self):
+        return self._value is not _NOT_LOADED
+
+    def get(self):
+        value = self._value
+        if value is not _NOT_LOADED and (self.version is None or self._loaded_version == self.version()):
+            return value
+
+        with self._lock:
+            version = self.version() if self.version is not None else None
+            if self._value is _NOT_LOADED or self._loaded_version != version:
+                started = time.perf_counter()
+                self._value = self.loader()
+                self._loaded_version = version
+                self.load_time = time.perf_counter() - started
+                print(f"Loaded {self.name} in {self.load_time:.2f}s")
+            return self._value
+
+    def reset(self):
+        """
+        Drop the loaded value so the next call to :meth:`get` loads it again.
+        """
+        with self._lock:
+            self._value = _NOT_LOADED
+            self._loaded_version = None
+            self.load_time = None
+
+
+def preload_resources(names=None):
+    """
+    Load resources eagerly, e.g. before gunicorn forks its workers.
+
+    Args:
+        names (list): The resources to load, all registered resources by default.
+    """
+    for name, resource in list(_resources.items()):
+        if names is None or name in names:
+            try:
+                resource.get()
+            except Exception as e:
+                # A missing artifact should not prevent the app from starting
+                print(f"Error preloading {name}: {e}")
+
+
+def startup_report():
+    """
+    Get the load time of every registered resource.
+
+    Returns:
+        list: ``(name, seconds)`` pairs, with None for resources that are not loaded yet.
+    """
+    return [(name, resource.load_time) for name, resource in _resources.items()]
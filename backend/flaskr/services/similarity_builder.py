@@ -0,0 +1,504 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+import click
+import joblib
+import numpy as np
+from flask.cli import with_appcontext
+from scipy.sparse import csr_matrix, vstack
+
+from flaskr.decorators import invalidate_cache_tags
+from flaskr.services.item_features import (build_tfidf_matrix, document_hashes, load_catalog_documents,
+                                           load_movie_documents, movies_csv_path, tags_csv_path)
+from flaskr.services.movie_index import MovieIndex
+from flaskr.services.neighbor_index import build_neighbor_index, save_neighbor_index
+from flaskr.services.similarity_store import (SHAPE_FILE, current_similarity_path, load_similarity_csr,
+                                              publish_similarity_version, save_similarity_csr,
+                                              similarity_versions_path)
+
+# Number of most similar movies kept per row
+DEFAULT_TOP_K = 200
+# Number of rows whose similarities are computed together
+DEFAULT_BATCH_SIZE = 256
+# Number of columns scored at once for a block of rows: a block never holds more than
+# batch_size x (column_chunk + top_k) dense values, whatever the size of the catalog
+DEFAULT_COLUMN_CHUNK = 8192
+# Refit TF-IDF from scratch when more than this share of the catalog is new or changed...
+REFIT_FRACTION = 0.1
+# ...or when more than this share of the new documents' terms is missing from the vocabulary
+REFIT_OOV_FRACTION = 0.2
+
+MANIFEST_FILE = 'manifest.json'
+# Blocks submitted to the process pool per worker and not yet written
+IN_FLIGHT_PER_WORKER = 2
+
+
+def _top_k_entries(rows, columns, values, top_k):
+    """
+    Keep the ``top_k`` highest values of every row of a matrix given as coordinates.
+    """
+    order = np.lexsort((-values, rows))
+    rows, columns, values = rows[order], columns[order], values[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows, side='left')
+    keep = rank < top_k
+    return rows[keep], columns[keep], values[keep]
+
+
+class SimilarityKernel:
+    """
+    Scores blocks of rows against every movie, one column chunk at a time.
+
+    The transposed feature chunks are prepared once, so that a worker only runs sparse products
+    and ``argpartition`` calls per block.
+    """
+
+    def __init__(self, features, column_chunk=DEFAULT_COLUMN_CHUNK):
+        self.features = csr_matrix(features, dtype=np.float32)
+        self.n = self.features.shape[0]
+        self.column_starts = list(range(0, self.n, column_chunk))
+        self.chunks_t = [self.features[start:start + column_chunk].T.tocsr() for start in self.column_starts]
+
+    def block(self, rows, top_k, floors=None):
+        """
+        Compute the similarities of a block of rows against every movie and keep the top-K of each row.
+
+        Args:
+            rows (np.ndarray): The rows of the block.
+            top_k (int): The number of similarities kept per row.
+            floors (np.ndarray): When given, also return the similarities that beat ``floors[j]``, the
+                smallest value kept in row ``j``, so that existing rows can be updated symmetrically.
+
+        Returns:
+            tuple: The kept ``(rows, columns, values)`` of the block, sorted by row then column, and,
+            with ``floors``, the ``(rows, columns, values)`` entries to merge into the other rows.
+        """
+        block_features = self.features[rows]
+        best_columns = np.empty((len(rows), 0), dtype=np.int64)
+        best_values = np.empty((len(rows), 0), dtype=np.float32)
+        reverse = []
+
+        for start, chunk_t in zip(self.column_starts, self.chunks_t):
+            values = (block_features @ chunk_t).toarray()
+            # A movie is not similar to itself
+            own = (rows >= start) & (rows < start + chunk_t.shape[1])
+            values[np.flatnonzero(own), rows[own] - start] = 0
+
+            if floors is not None:
+                block_rows, chunk_columns = np.nonzero(values > floors[start:start + chunk_t.shape[1]])
+                reverse.append((chunk_columns + start, rows[block_rows], values[block_rows, chunk_columns]))
+
+            columns = np.concatenate([best_columns, np.broadcast_to(
+                np.arange(start, start + chunk_t.shape[1]), values.shape)], axis=1)
+            values = np.concatenate([best_values, values], axis=1)
+            if values.shape[1] > top_k:
+                top = np.argpartition(-values, top_k - 1, axis=1)[:, :top_k]
+                columns = np.take_along_axis(columns, top, axis=1)
+                values = np.take_along_axis(values, top, axis=1)
+            best_columns, best_values = columns, values
+
+        block_rows = np.repeat(rows, best_values.shape[1])
+        columns, values = best_columns.ravel(), best_values.ravel()
+        keep = values > 0
+        order = np.lexsort((columns[keep], block_rows[keep]))
+        forward = (block_rows[keep][order], columns[keep][order], values[keep][order])
+        if floors is None:
+            return forward, None
+        return forward, tuple(np.concatenate(arrays) for arrays in zip(*reverse))
+
+
+# State of a similarity worker process, set up once by _init_worker
+_worker_kernel = None
+
+
+def _init_worker(features_path, column_chunk):
+    global _worker_kernel
+    _worker_kernel = SimilarityKernel(load_similarity_csr(features_path), column_chunk)
+
+
+def _worker_block(rows, top_k):
+    return _worker_kernel.block(rows, top_k)[0]
+
+
+def _batches(rows, batch_size):
+    return [rows[start:start + batch_size] for start in range(0, len(rows), batch_size)]
+
+
+def _bounded_map(executor, fn, args, window):
+    """
+    Like ``executor.map``, but with at most ``window`` calls submitted and not yet consumed.
+    """
+    pending = deque()
+    for call_args in args:
+        pending.append(executor.submit(fn, *call_args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def compute_similarity_rows(features, rows, top_k=DEFAULT_TOP_K, batch_size=DEFAULT_BATCH_SIZE, workers=None,
+                            floors=None, column_chunk=DEFAULT_COLUMN_CHUNK):
+    """
+    Compute the top-K similarity rows of a few movies in-process, in batches spread over a thread pool.
+
+    Args:
+        features: The L2-normalized feature rows of every movie.
+        rows (np.ndarray): The rows to compute.
+        top_k (int): The number of similarities kept per row.
+        batch_size (int): The number of rows per block.
+        workers (int): The number of threads, one per CPU by default.
+        floors (np.ndarray): See :meth:`SimilarityKernel.block`.
+        column_chunk (int): The number of columns scored at once.
+
+    Returns:
+        tuple: The ``(rows, columns, values)`` of the computed rows and, with ``floors``, the entries to
+        merge into the other rows.
+    """
+    kernel = SimilarityKernel(features, column_chunk)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        results = list(executor.map(
+            lambda batch: kernel.block(batch, top_k, floors), _batches(np.asarray(rows), batch_size)
+        ))
+
+    def concatenate(parts):
+        if not parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return tuple(np.concatenate(arrays) for arrays in zip(*parts))
+
+    forward = concatenate([result[0] for result in results])
+    reverse = concatenate([result[1] for result in results]) if floors is not None else None
+    return forward, reverse
+
+
+def write_similarity_matrix(features_path, path, top_k=DEFAULT_TOP_K, batch_size=DEFAULT_BATCH_SIZE, workers=None,
+                            column_chunk=DEFAULT_COLUMN_CHUNK, log=print):
+    """
+    Compute the full top-K similarity matrix across a process pool and stream it to disk.
+
+    Workers memory-map the features saved at ``features_path``. At most ``IN_FLIGHT_PER_WORKER`` blocks
+    per worker are submitted ahead of the one being written, and blocks are written in row order, so
+    the parent never holds more than that many blocks. The result is the same CSR layout as
+    :func:`save_similarity_csr` writes.
+
+    Args:
+        features_path (str): The directory of the features, saved with :func:`save_similarity_csr`.
+        path (str): The output directory.
+        top_k (int): The number of similarities kept per row.
+        batch_size (int): The number of rows per block.
+        workers (int): The number of processes, one per CPU by default.
+        column_chunk (int): The number of columns scored at once.
+        log (callable): Receives progress lines.
+    """
+    with open(os.path.join(features_path, SHAPE_FILE)) as f:
+        n = json.load(f)['shape'][0]
+
+    os.makedirs(path, exist_ok=True)
+    row_counts = np.zeros(n, dtype=np.int64)
+    started = time.monotonic()
+
+    workers = workers or os.cpu_count()
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(features_path, column_chunk)) as executor, \
+            open(os.path.join(path, 'indices.bin'), 'wb') as indices_file, \
+            open(os.path.join(path, 'data.bin'), 'wb') as data_file:
+        blocks = _bounded_map(executor, _worker_block, ((batch, top_k) for batch in _batches(np.arange(n), batch_size)),
+                              workers * IN_FLIGHT_PER_WORKER)
+        for done, (rows, columns, values) in enumerate(blocks):
+            np.add.at(row_counts, rows, 1)
+            indices_file.write(columns.astype(np.int32).tobytes())
+            data_file.write(values.astype(np.float32).tobytes())
+            if (done + 1) % 50 == 0:
+                log(f"{min((done + 1) * batch_size, n)}/{n} rows in {time.monotonic() - started:.1f}s")
+
+    nnz = int(row_counts.sum())
+    indptr = np.zeros(n + 1, dtype=np.int32 if nnz < np.iinfo(np.int32).max else np.int64)
+    np.cumsum(row_counts, out=indptr[1:])
+    np.save(os.path.join(path, 'indptr.npy'), indptr)
+    for name, dtype in (('indices', np.int32), ('data', np.float32)):
+        raw = np.memmap(os.path.join(path, f'{name}.bin'), dtype=dtype, mode='r', shape=(nnz,)) if nnz else \
+            np.empty(0, dtype=dtype)
+        output = np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', dtype=dtype, shape=(nnz,))
+        for start in range(0, nnz, 1 << 24):
+            output[start:start + (1 << 24)] = raw[start:start + (1 << 24)]
+        output.flush()
+        del raw, output
+        os.remove(os.path.join(path, f'{name}.bin'))
+
+    with open(os.path.join(path, SHAPE_FILE), 'w') as f:
+        json.dump({'shape': [n, n], 'nnz': nnz}, f)
+
+
+def _to_csr(entries, n):
+    rows, columns, values = entries
+    return csr_matrix((values.astype(np.float32), (rows, columns)), shape=(n, n))
+
+
+def _file_sha256(*paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _new_version():
+    name = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    return name, os.path.join(similarity_versions_path, name)
+
+
+def finish_similarity_version(name, path, movie_ids, hashes, vectorizer, top_k, manifest):
+    """
+    Complete a version whose matrix and features are written, then publish it.
+
+    Adds the movie IDs, the document hashes and the vectorizer needed to update the version
+    incrementally later, its neighbor table and its manifest. The version is only made visible to
+    the workers once it has been fully written.
+
+    Args:
+        manifest (dict): Build details recorded in the manifest, e.g. the build parameters.
+
+    Returns:
+        str: The version directory.
+    """
+    np.save(os.path.join(path, 'movie_ids.npy'), np.asarray(movie_ids, dtype=np.int64))
+    np.save(os.path.join(path, 'document_hashes.npy'), hashes)
+    joblib.dump(vectorizer, os.path.join(path, 'tfidf_vectorizer.joblib'))
+
+    matrix = load_similarity_csr(path)
+    save_neighbor_index(build_neighbor_index(matrix), os.path.join(path, 'neighbor_index'))
+
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+        json.dump({
+            'version': name,
+            'built_at': datetime.utcnow().isoformat(),
+            'top_k': top_k,
+            'shape': list(matrix.shape),
+            'nnz': int(matrix.nnz),
+            # Same documents in the same order give the same matrix
+            'documents_sha256': hashlib.sha256(
+                np.asarray(movie_ids, dtype=np.int64).tobytes() + hashes.tobytes()
+            ).hexdigest(),
+            'matrix_sha256': _file_sha256(*(os.path.join(path, f'{part}.npy') for part in ('data', 'indices', 'indptr'))),
+            **manifest,
+        }, f, indent=2)
+
+    publish_similarity_version(name)
+    invalidate_cache_tags('similarity')
+    return path
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        return json.load(f)
+
+
+def rebuild_similarity(top_k=DEFAULT_TOP_K, batch_size=DEFAULT_BATCH_SIZE, workers=None,
+                       column_chunk=DEFAULT_COLUMN_CHUNK, source='catalog', log=print):
+    """
+    Rebuild the similarity matrix from scratch and publish it.
+
+    Args:
+        source (str): 'csv' to read only ``movies.csv``/``tags.csv``, 'catalog' to also take the
+            movies of the movielens_movies table into account.
+
+    Returns:
+        str: The published version directory.
+    """
+    started = time.monotonic()
+    movie_ids, documents = load_movie_documents() if source == 'csv' else load_catalog_documents()
+    vectorizer, features = build_tfidf_matrix(documents)
+    log(f"Vectorized {len(movie_ids)} movies ({features.shape[1]} terms) in {time.monotonic() - started:.1f}s")
+
+    name, path = _new_version()
+    features_path = os.path.join(path, 'features')
+    save_similarity_csr(features, features_path)
+    del features
+
+    write_similarity_matrix(features_path, path, top_k=top_k, batch_size=batch_size, workers=workers,
+                            column_chunk=column_chunk, log=log)
+    build_seconds = time.monotonic() - started
+    log(f"Computed the similarity matrix in {build_seconds:.1f}s")
+
+    return finish_similarity_version(name, path, movie_ids, document_hashes(documents), vectorizer, top_k, {
+        'source': source,
+        'inputs': {
+            os.path.basename(movies_csv_path): _file_sha256(movies_csv_path),
+            os.path.basename(tags_csv_path): _file_sha256(tags_csv_path),
+        },
+        'parameters': {'batch_size': batch_size, 'column_chunk': column_chunk},
+        'build_seconds': round(build_seconds, 1),
+    })
+
+
+def _needs_refit(vectorizer, documents, n_affected, n_movies):
+    if n_affected > REFIT_FRACTION * n_movies:
+        return True
+
+    analyzer = vectorizer.build_analyzer()
+    terms = [term for document in documents for term in analyzer(document)]
+    missing = sum(term not in vectorizer.vocabulary_ for term in terms)
+    return bool(terms) and missing > REFIT_OOV_FRACTION * len(terms)
+
+
+def update_similarity(batch_size=DEFAULT_BATCH_SIZE, workers=None, allow_refit=True, log=print):
+    """
+    Bring the published similarity matrix up to date with the catalog.
+
+    Only the rows of new or changed movies are computed, against the whole corpus, with the fitted
+    TF-IDF vectorizer. Their similarities are also merged into the rows of the other movies, which
+    keep their top-K. Rows that lose similarities to changed movies without enough new ones to
+    replace them are recomputed, so that they are back to top-K. The vectorizer is refit, through a
+    full rebuild, only when too much of the catalog changed or the new documents are poorly covered
+    by its vocabulary.
+
+    Args:
+        allow_refit (bool): Run the full rebuild when a refit is needed. Without it, nothing is
+            published and ``flask rebuild-similarity`` has to be run instead.
+
+    Returns:
+        str: The published version directory, or None if there was nothing to update or no version
+        to update yet.
+    """
+    current = current_similarity_path()
+    if current is None:
+        log("No similarity version published yet, run `flask rebuild-similarity` first")
+        return None
+
+    started = time.monotonic()
+    previous_manifest = read_manifest(current)
+    top_k = previous_manifest['top_k']
+    previous_ids = np.load(os.path.join(current, 'movie_ids.npy'))
+    previous_hashes = np.load(os.path.join(current, 'document_hashes.npy'))
+
+    movie_ids, documents = load_catalog_documents()
+    hashes = document_hashes(documents)
+    positions = MovieIndex(previous_ids).indices_of(movie_ids)
+    added = positions < 0
+    changed = ~added
+    changed[changed] = previous_hashes[positions[changed]] != hashes[changed]
+
+    affected = np.flatnonzero(added | changed)
+    if not len(affected):
+        log("Similarity matrix is up to date")
+        return None
+
+    vectorizer = joblib.load(os.path.join(current, 'tfidf_vectorizer.joblib'))
+    affected_documents = [documents[i] for i in affected]
+    if _needs_refit(vectorizer, affected_documents, len(affected), len(movie_ids)):
+        if not allow_refit:
+            log(f"{len(affected)} new or changed movies need a TF-IDF refit, "
+                f"run `flask rebuild-similarity` to rebuild the similarity matrix")
+            return None
+        log(f"{len(affected)} new or changed movies, refitting TF-IDF with a full rebuild")
+        return rebuild_similarity(top_k=top_k, batch_size=batch_size, workers=workers, log=log)
+
+    # Previous rows keep their index, new movies are appended
+    n_previous = len(previous_ids)
+    new_ids = movie_ids[added]
+    n = n_previous + len(new_ids)
+    affected_rows = np.concatenate([positions[changed], np.arange(n_previous, n)])
+
+    transformed = csr_matrix(vectorizer.transform(
+        [documents[i] for i in np.flatnonzero(changed)] + [documents[i] for i in np.flatnonzero(added)]
+    ), dtype=np.float32)
+    source_rows = np.arange(n)
+    source_rows[affected_rows] = n_previous + np.arange(len(affected_rows))
+    previous_features = load_similarity_csr(os.path.join(current, 'features'))
+    features = vstack([previous_features, transformed], format='csr')[source_rows]
+
+    all_hashes = np.concatenate([previous_hashes, hashes[added]])
+    all_hashes[positions[changed]] = hashes[changed]
+
+    previous = load_similarity_csr(current)
+    indptr = np.concatenate([previous.indptr, np.repeat(previous.indptr[-1], len(new_ids))])
+
+    # A row only takes a new similarity if it beats the smallest one it already keeps
+    row_counts = np.diff(indptr)
+    floors = np.zeros(n, dtype=np.float32)
+    stored = row_counts > 0
+    if stored.any():
+        row_minimums = np.zeros(n, dtype=np.float32)
+        row_minimums[stored] = np.minimum.reduceat(previous.data, indptr[:-1][stored])
+        full = row_counts >= top_k
+        floors[full] = row_minimums[full]
+
+    previous = csr_matrix((previous.data, previous.indices, indptr), shape=(n, n)).tocoo()
+
+    forward, reverse = compute_similarity_rows(
+        features, affected_rows, top_k=top_k, batch_size=batch_size, workers=workers, floors=floors
+    )
+
+    is_affected = np.zeros(n, dtype=bool)
+    is_affected[affected_rows] = True
+    stale = is_affected[previous.row] | is_affected[previous.col]
+    reverse_kept = ~is_affected[reverse[0]]
+
+    rows, columns, values = _top_k_entries(
+        np.concatenate([previous.row[~stale], reverse[0][reverse_kept], forward[0]]),
+        np.concatenate([previous.col[~stale], reverse[1][reverse_kept], forward[1]]),
+        np.concatenate([previous.data[~stale], reverse[2][reverse_kept], forward[2]]),
+        top_k,
+    )
+
+    # Rows that dropped similarities to changed movies are recomputed if they are left short of top-K
+    lost = np.zeros(n, dtype=bool)
+    lost[previous.row[stale & ~is_affected[previous.row]]] = True
+    depleted = np.flatnonzero(lost & (np.bincount(rows, minlength=n) < top_k))
+    if len(depleted):
+        refilled, _ = compute_similarity_rows(features, depleted, top_k=top_k, batch_size=batch_size, workers=workers)
+        is_depleted = np.zeros(n, dtype=bool)
+        is_depleted[depleted] = True
+        keep = ~is_depleted[rows]
+        rows, columns, values = (np.concatenate([part[keep], refilled_part])
+                                 for part, refilled_part in zip((rows, columns, values), refilled))
+
+    build_seconds = time.monotonic() - started
+    log(f"Updated {len(affected_rows)} movies ({len(new_ids)} new) and refilled {len(depleted)} others "
+        f"in {build_seconds:.1f}s")
+
+    name, path = _new_version()
+    save_similarity_csr(_to_csr((rows, columns, values), n), path)
+    save_similarity_csr(features, os.path.join(path, 'features'))
+    return finish_similarity_version(name, path, np.concatenate([previous_ids, new_ids]), all_hashes, vectorizer, top_k, {
+        'source': 'catalog',
+        'updated_from': previous_manifest['version'],
+        'updated_movies': int(len(affected_rows)),
+        'build_seconds': round(build_seconds, 1),
+    })
+
+
+@click.command('rebuild-similarity')
+@click.option('--top-k', default=DEFAULT_TOP_K, show_default=True, help='Similarities kept per movie.')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True, help='Rows computed per block.')
+@click.option('--column-chunk', default=DEFAULT_COLUMN_CHUNK, show_default=True,
+              help='Columns scored at once per block; bounds the memory of every worker.')
+@click.option('--workers', type=int, default=None, help='Worker processes, one per CPU by default.')
+@click.option('--source', type=click.Choice(['catalog', 'csv']), default='catalog', show_default=True,
+              help='Build from movies.csv/tags.csv only, or include movies added to the movielens_movies table.')
+@with_appcontext
+def rebuild_similarity_command(top_k, batch_size, column_chunk, workers, source):
+    """Rebuild the movie similarity matrix from scratch and publish it."""
+    path = rebuild_similarity(top_k=top_k, batch_size=batch_size, workers=workers, column_chunk=column_chunk,
+                              source=source, log=click.echo)
+    manifest = read_manifest(path)
+    click.echo(f"Published {path} ({manifest['shape'][0]} movies, {manifest['nnz']} similarities, "
+               f"matrix sha256 {manifest['matrix_sha256'][:12]}).")
+
+
+@click.command('update-similarity')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True, help='Rows computed per block.')
+@click.option('--workers', type=int, default=None, help='Worker threads, one per CPU by default.')
+@with_appcontext
+def update_similarity_command(batch_size, workers):
+    """Compute similarities for new or changed movies only and publish the updated matrix."""
+    path = update_similarity(batch_size=batch_size, workers=workers, log=click.echo)
+    if path is not None:
+        click.echo(f'Published {path}.')
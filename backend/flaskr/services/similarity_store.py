@@ -0,0 +1,154 @@
+import json
+import os
+import shutil
+
+import click
+import joblib
+import numpy as np
+from flask.cli import with_appcontext
+from scipy.sparse import csr_matrix
+
+# Construct the absolute path
+base_dir = os.path.abspath(os.path.dirname(__file__))
+# base file path for machine learning models
+base_path = os.path.join(base_dir, '../../../machine_learning/models/')
+# Legacy pickled matrix produced by the notebook
+similarity_joblib_path = os.path.join(base_path, 'cosine_similarity_matrix.joblib')
+# Raw CSR arrays, memory-mapped by every worker
+similarity_csr_path = os.path.join(base_path, 'similarity_csr')
+# Versions built by `flask rebuild-similarity` / `flask update-similarity`, one directory each
+similarity_versions_path = os.path.join(base_path, 'similarity')
+
+SHAPE_FILE = 'shape.json'
+# File holding the name of the version that is served
+CURRENT_FILE = 'CURRENT'
+# Number of versions kept on disk, the served one included
+KEEP_VERSIONS = 2
+
+
+def save_similarity_csr(matrix, path=similarity_csr_path):
+    """
+    Save a sparse matrix as raw ``data``/``indices``/``indptr`` ``.npy`` arrays.
+
+    Indices use int32 when the matrix is small enough, and data is stored as float32.
+
+    Args:
+        matrix: The (sparse) similarity matrix.
+        path (str): The output directory.
+    """
+    matrix = csr_matrix(matrix)
+    matrix.sum_duplicates()
+    matrix.sort_indices()
+
+    index_dtype = np.int32 if max(matrix.nnz, matrix.shape[1]) < np.iinfo(np.int32).max else np.int64
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'data.npy'), matrix.data.astype(np.float32, copy=False))
+    np.save(os.path.join(path, 'indices.npy'), matrix.indices.astype(index_dtype, copy=False))
+    np.save(os.path.join(path, 'indptr.npy'), matrix.indptr.astype(index_dtype, copy=False))
+    with open(os.path.join(path, SHAPE_FILE), 'w') as f:
+        json.dump({'shape': list(matrix.shape), 'nnz': int(matrix.nnz)}, f)
+
+
+def load_similarity_csr(path=similarity_csr_path):
+    """
+    Memory-map a matrix saved by :func:`save_similarity_csr` without copying it.
+
+    The arrays are opened read-only, so every process mapping them shares one page-cache copy.
+
+    Args:
+        path (str): The directory containing the arrays.
+
+    Returns:
+        csr_matrix: The matrix, backed by the memory-mapped arrays.
+    """
+    with open(os.path.join(path, SHAPE_FILE)) as f:
+        shape = tuple(json.load(f)['shape'])
+
+    data = np.load(os.path.join(path, 'data.npy'), mmap_mode='r')
+    indices = np.load(os.path.join(path, 'indices.npy'), mmap_mode='r')
+    indptr = np.load(os.path.join(path, 'indptr.npy'), mmap_mode='r')
+
+    return csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+def current_similarity_path():
+    """
+    Get the directory of the published similarity version.
+
+    Returns:
+        str: The version directory, or None if no version has been published.
+    """
+    try:
+        with open(os.path.join(similarity_versions_path, CURRENT_FILE)) as f:
+            name = f.read().strip()
+    except OSError:
+        return None
+    return os.path.join(similarity_versions_path, name) if name else None
+
+
+def similarity_version_token():
+    """
+    Get a cheap token that changes whenever a new similarity version is published.
+    """
+    try:
+        return os.stat(os.path.join(similarity_versions_path, CURRENT_FILE)).st_mtime_ns
+    except OSError:
+        return None
+
+
+def publish_similarity_version(name):
+    """
+    Atomically make a fully written version directory the served one.
+
+    The pointer file is replaced with ``os.replace``, so readers see either the old or the new
+    version, never a partial one. Running workers pick the new version up on their next request.
+    Older versions beyond :data:`KEEP_VERSIONS` are deleted; workers still mapping them keep their
+    pages until they reload.
+
+    Args:
+        name (str): The name of the version directory inside the versions directory.
+    """
+    pointer_path = os.path.join(similarity_versions_path, CURRENT_FILE)
+    with open(pointer_path + '.tmp', 'w') as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer_path + '.tmp', pointer_path)
+
+    versions = sorted(
+        entry for entry in os.listdir(similarity_versions_path)
+        if os.path.isdir(os.path.join(similarity_versions_path, entry))
+    )
+    for stale in versions[:-KEEP_VERSIONS]:
+        if stale != name:
+            shutil.rmtree(os.path.join(similarity_versions_path, stale), ignore_errors=True)
+
+
+def load_similarity_matrix():
+    """
+    Load the similarity matrix, memory-mapped from its CSR arrays when they have been built or exported.
+
+    The published version is preferred, then the exported notebook matrix. Falls back to the pickled
+    matrix, which is materialized in memory.
+
+    Returns:
+        csr_matrix: The similarity matrix.
+    """
+    current = current_similarity_path()
+    if current is not None:
+        return load_similarity_csr(current)
+
+    if os.path.exists(os.path.join(similarity_csr_path, SHAPE_FILE)):
+        return load_similarity_csr(similarity_csr_path)
+
+    return csr_matrix(joblib.load(similarity_joblib_path, mmap_mode='r'))
+
+
+@click.command('export-similarity-csr')
+@with_appcontext
+def export_similarity_csr_command():
+    """Convert the pickled similarity matrix into memory-mappable CSR arrays."""
+    matrix = csr_matrix(joblib.load(similarity_joblib_path, mmap_mode='r'))
+    save_similarity_csr(matrix)
+    click.echo(f'Exported {matrix.shape[0]}x{matrix.shape[1]} matrix ({matrix.nnz} non-zeros) '
+               f'to {similarity_csr_path}.')
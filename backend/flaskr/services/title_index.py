@@ -0,0 +1,306 @@
+import bisect
+import re
+import threading
+import unicodedata
+
+import numpy as np
+
+from flaskr import db
+from flaskr.database_models import MovieRatingStats, MovielensMovie
+from flaskr.services.catalog_version import catalog_version_token
+
+# "Toy Story (1995)", "Stranger Things (2016-)"
+TITLE_YEAR_PATTERN = re.compile(r'^(.*?)\s*\((\d{4})(?:[-–]\d{0,4})?\)\s*$')
+# MovieLens moves leading articles to the end: "Godfather, The"
+TRAILING_ARTICLE_PATTERN = re.compile(r"^(.*),\s*(the|a|an|les|la|le|l'|il|el|die|das|der|los|las)$", re.IGNORECASE)
+NON_ALPHANUMERIC_PATTERN = re.compile(r'[^0-9a-z]+')
+
+MIN_YEAR = 1870
+MAX_YEAR = 2100
+
+# Fuzzy matches below this trigram similarity are not considered the same title
+MIN_CONFIDENCE = 0.3
+# Fuzzy matches this far below the best one are dropped, so "Toy Story" does not resolve to its sequels
+CONFIDENCE_MARGIN = 0.1
+# Candidates drawn from each of the token and trigram indexes before scoring
+FUZZY_CANDIDATES = 50
+
+
+def normalize_text(text):
+    """
+    Lowercase a string, strip its accents and punctuation and collapse whitespace.
+    """
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(char for char in text if not unicodedata.combining(char)).lower()
+    return NON_ALPHANUMERIC_PATTERN.sub(' ', text).strip()
+
+
+def parse_title(raw_title):
+    """
+    Split a MovieLens title into its display title and release year.
+
+    Args:
+        raw_title (str): E.g. "Godfather, The (1972)".
+
+    Returns:
+        tuple: The title with its article moved back to the front ("The Godfather") and the year, or None.
+    """
+    title, year = raw_title.strip(), None
+    match = TITLE_YEAR_PATTERN.match(title)
+    if match:
+        title, year = match.group(1), int(match.group(2))
+
+    article = TRAILING_ARTICLE_PATTERN.match(title)
+    if article:
+        separator = '' if article.group(2).endswith("'") else ' '
+        title = f"{article.group(2)}{separator}{article.group(1)}"
+    return title, year
+
+
+def trigrams(text):
+    """
+    Get the trigrams of a normalized string, each word padded like PostgreSQL's pg_trgm does.
+    """
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def parse_query(query):
+    """
+    Split a search query into normalized tokens and an optional year, e.g. "toy story 1995".
+
+    Returns:
+        tuple: The tokens and the year, or None.
+    """
+    title, year = parse_title(query)
+    tokens = normalize_text(title).split()
+    if year is None and len(tokens) > 1 and tokens[-1].isdigit() and len(tokens[-1]) == 4 \
+            and MIN_YEAR <= int(tokens[-1]) <= MAX_YEAR:
+        year = int(tokens.pop())
+    return tokens, year
+
+
+class TitleIndex:
+    """
+    In-memory inverted index over movie titles.
+
+    Every normalized title token maps to the sorted array of the entries containing it. Query tokens
+    must all be present; the last one may be a prefix, which is answered by a binary search over the
+    sorted vocabulary. Matches are ranked with vectorized features: exact title, same first word,
+    share of the title covered by the query and popularity.
+
+    A second inverted index over title trigrams scores typo-tolerant matches: counting, for every
+    title, the trigrams it shares with the query is a single ``np.bincount`` over their postings.
+    """
+
+    def __init__(self, movies, popularity, catalog_version=None):
+        """
+        Args:
+            movies (list): ``(movie_id, raw_title, genres)`` tuples.
+            popularity (dict): Number of ratings by movie ID.
+            catalog_version (str): The catalog version the movies and popularity were read at.
+        """
+        self.catalog_version = catalog_version
+        self.movie_ids = np.array([movie_id for movie_id, _, _ in movies], dtype=np.int64)
+        self.genres = [genres for _, _, genres in movies]
+        self.titles = []
+        self.years = np.full(len(movies), -1, dtype=np.int32)
+        self.token_counts = np.zeros(len(movies), dtype=np.int32)
+        self.first_tokens = []
+        self.exact = {}
+
+        postings = {}
+        trigram_postings = {}
+        self.trigram_counts = np.zeros(len(movies), dtype=np.int32)
+        for entry, (_, raw_title, _) in enumerate(movies):
+            title, year = parse_title(raw_title)
+            tokens = normalize_text(title).split()
+            title_trigrams = trigrams(' '.join(tokens))
+            self.trigram_counts[entry] = len(title_trigrams)
+            for trigram in title_trigrams:
+                trigram_postings.setdefault(trigram, []).append(entry)
+            self.titles.append(title)
+            if year is not None:
+                self.years[entry] = year
+            self.token_counts[entry] = max(len(tokens), 1)
+            self.first_tokens.append(tokens[0] if tokens else '')
+            self.exact.setdefault(' '.join(tokens), []).append(entry)
+            for token in set(tokens):
+                postings.setdefault(token, []).append(entry)
+
+        self.vocabulary = sorted(postings)
+        self.postings = {token: np.array(entries, dtype=np.int32) for token, entries in postings.items()}
+        self.trigram_postings = {
+            trigram: np.array(entries, dtype=np.int32) for trigram, entries in trigram_postings.items()
+        }
+        self.popularity = np.log1p(np.array([popularity.get(movie_id, 0) for movie_id, _, _ in movies],
+                                            dtype=np.float32))
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def _prefix_postings(self, prefix):
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        end = bisect.bisect_left(self.vocabulary, prefix + '\uffff')
+        if start == end:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate([self.postings[token] for token in self.vocabulary[start:end]]))
+
+    def _candidates(self, tokens, prefix):
+        complete = tokens[:-1] if prefix else tokens
+        postings = [self.postings.get(token) for token in complete]
+        if any(entries is None for entries in postings):
+            return np.empty(0, dtype=np.int32)
+        if prefix:
+            postings.append(self._prefix_postings(tokens[-1]))
+
+        postings.sort(key=len)
+        candidates = postings[0]
+        for entries in postings[1:]:
+            candidates = np.intersect1d(candidates, entries, assume_unique=True)
+        return candidates
+
+    def _ranked_entries(self, query, limit, prefix):
+        tokens, year = parse_query(query)
+        if not tokens:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+
+        candidates = self._candidates(tokens, prefix)
+        if year is not None:
+            in_year = candidates[self.years[candidates] == year]
+            if not len(in_year):
+                # The number was part of the title, as in "Blade Runner 2049"
+                tokens = tokens + [str(year)]
+                in_year = self._candidates(tokens, prefix)
+            candidates = in_year
+        if not len(candidates):
+            return candidates, np.empty(0, dtype=np.float32)
+
+        exact = np.isin(candidates, self.exact.get(' '.join(tokens), []))
+        same_start = np.array([self.first_tokens[entry] == tokens[0] for entry in candidates])
+        coverage = len(tokens) / np.maximum(self.token_counts[candidates], len(tokens))
+        scores = 4.0 * exact + 1.0 * same_start + 2.0 * coverage + 0.2 * self.popularity[candidates]
+
+        if limit is not None and len(scores) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            candidates, scores = candidates[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return candidates[order], scores[order]
+
+    def _describe(self, entry, **extra):
+        return {
+            'movie_id': int(self.movie_ids[entry]),
+            'title': self.titles[entry],
+            'year': int(self.years[entry]) if self.years[entry] >= 0 else None,
+            'genres': self.genres[entry],
+            **extra,
+        }
+
+    def search(self, query, limit=10, prefix=True):
+        """
+        Find the movies whose title matches a query, best match first.
+
+        Args:
+            query (str): Free text, optionally ending with a year ("toy story 1995", "Toy Story (1995)").
+            limit (int): The maximum number of results, or None for all of them.
+            prefix (bool): Treat the last word as a prefix, for typeahead.
+
+        Returns:
+            list: ``{'movie_id', 'title', 'year', 'genres', 'score'}`` dicts.
+        """
+        entries, scores = self._ranked_entries(query, limit, prefix)
+        return [self._describe(entry, score=round(float(score), 3)) for entry, score in zip(entries, scores)]
+
+    def search_movie_ids(self, query, limit=10, prefix=False):
+        return [result['movie_id'] for result in self.search(query, limit=limit, prefix=prefix)]
+
+    def _shared_trigrams(self, query_trigrams):
+        postings = [self.trigram_postings[trigram] for trigram in query_trigrams if trigram in self.trigram_postings]
+        if not postings:
+            return np.zeros(len(self), dtype=np.int64)
+        return np.bincount(np.concatenate(postings), minlength=len(self))
+
+    def resolve(self, query, limit=3):
+        """
+        Resolve free text, possibly misspelled, to the titles it most likely means.
+
+        Candidates come from the token index and from the titles sharing the most trigrams with the
+        query. Each one gets a confidence, the trigram similarity ``shared / (query + title - shared)``
+        of its title. Only candidates close to the best one are kept, and popularity breaks ties.
+
+        Args:
+            query (str): Free text, e.g. "shawshank redemtion" or "Godfather 1972".
+            limit (int): The maximum number of matches.
+
+        Returns:
+            list: ``{'movie_id', 'title', 'year', 'genres', 'confidence'}`` dicts, most likely first.
+        """
+        tokens, year = parse_query(query)
+        query_trigrams = trigrams(' '.join(tokens))
+        if not query_trigrams:
+            return []
+
+        shared = self._shared_trigrams(query_trigrams)
+        similarity = shared / np.maximum(len(query_trigrams) + self.trigram_counts - shared, 1)
+
+        fuzzy = min(FUZZY_CANDIDATES, len(self))
+        candidates = np.argpartition(-similarity, fuzzy - 1)[:fuzzy] if fuzzy else np.empty(0, dtype=np.int64)
+        token_matches, _ = self._ranked_entries(query, FUZZY_CANDIDATES, prefix=False)
+        candidates = np.union1d(candidates, token_matches).astype(np.int64)
+
+        if year is not None and (self.years[candidates] == year).any():
+            candidates = candidates[self.years[candidates] == year]
+
+        confidence = similarity[candidates]
+        keep = confidence >= max(MIN_CONFIDENCE, confidence.max(initial=0) - CONFIDENCE_MARGIN)
+        candidates, confidence = candidates[keep], confidence[keep]
+
+        order = np.lexsort((-self.popularity[candidates], -confidence))[:limit]
+        return [
+            self._describe(entry, confidence=round(float(score), 3))
+            for entry, score in zip(candidates[order], confidence[order])
+        ]
+
+
+_title_index = None
+_title_index_lock = threading.Lock()
+
+
+def load_title_index(catalog_version=None):
+    movies = db.session.query(MovielensMovie.movie_id, MovielensMovie.movie_name, MovielensMovie.genres).all()
+    popularity = dict(db.session.query(MovieRatingStats.movie_id, MovieRatingStats.rating_count))
+    return TitleIndex(movies, popularity, catalog_version)
+
+
+def get_title_index():
+    """
+    Get the process-wide title index, loading it on first use.
+
+    The index is rebuilt when any process bumps the catalog version, see
+    :func:`~flaskr.services.catalog_version.bump_catalog_version`, or after :func:`invalidate_title_index`.
+
+    Returns:
+        TitleIndex: The title index.
+    """
+    global _title_index
+
+    # Read before loading, so a bump during the load triggers another one
+    version = catalog_version_token()
+    title_index = _title_index
+    if title_index is not None and title_index.catalog_version == version:
+        return title_index
+
+    with _title_index_lock:
+        if _title_index is title_index:
+            _title_index = load_title_index(version)
+        return _title_index
+
+
+def invalidate_title_index():
+    global _title_index
+
+    with _title_index_lock:
+        _title_index = None
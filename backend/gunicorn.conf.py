@@ -0,0 +1,8 @@
+import os
+
+wsgi_app = 'flaskr:create_app()'
+
+# Create the app, and load the CSVs and ML artifacts, once in the master process.
+# Workers are forked afterwards and share those pages copy-on-write.
+preload_app = True
+os.environ.setdefault('PRELOAD_RESOURCES', '1')
@@ -0,0 +1,133 @@
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from flaskr.services.omdb_client import OmdbClient
+
+
+class StubOmdb:
+    """
+    State of the stub OMDB server: requests received per IMDb ID, and the failures and delay to apply.
+    """
+
+    def __init__(self):
+        self.requests = Counter()
+        # IMDb ID -> number of 503 answers before a successful one
+        self.failures = {}
+        self.delay = 0.0
+        self.lock = threading.Lock()
+
+
+def _handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            imdb_id = parse_qs(urlparse(self.path).query)['i'][0]
+            with stub.lock:
+                stub.requests[imdb_id] += 1
+                failing = stub.failures.get(imdb_id, 0) >= stub.requests[imdb_id]
+            time.sleep(stub.delay)
+
+            if failing:
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if imdb_id.startswith('tt'):
+                body = {'Response': 'True', 'imdbID': imdb_id, 'Title': f'Movie {imdb_id}'}
+            else:
+                body = {'Response': 'False', 'Error': 'Incorrect IMDb ID.'}
+            payload = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+@pytest.fixture
+def stub_omdb():
+    stub = StubOmdb()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _handler(stub))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    stub.url = f'http://127.0.0.1:{server.server_address[1]}/'
+    yield stub
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_client(stub_omdb):
+    clients = []
+
+    def make(**kwargs):
+        kwargs.setdefault('backoff_factor', 0)
+        client = OmdbClient(api_key='test', base_url=stub_omdb.url, timeout=5, **kwargs)
+        clients.append(client)
+        return client
+
+    yield make
+    for client in clients:
+        client.close()
+
+
+def test_fetch_many_requests_each_movie_once(stub_omdb, make_client):
+    client = make_client()
+
+    details = client.fetch_many(['tt0000001', 'tt0000002', 'tt0000001', 'missing'])
+
+    assert set(details) == {'tt0000001', 'tt0000002'}
+    assert details['tt0000001']['Title'] == 'Movie tt0000001'
+    assert stub_omdb.requests == Counter({'tt0000001': 1, 'tt0000002': 1, 'missing': 1})
+
+
+def test_concurrent_fetches_of_a_movie_share_one_request(stub_omdb, make_client):
+    stub_omdb.delay = 0.2
+    client = make_client()
+
+    first = client.submit('tt0000001')
+    second = client.submit('tt0000001')
+
+    assert first is second
+    assert first.result()['imdbID'] == 'tt0000001'
+    assert stub_omdb.requests['tt0000001'] == 1
+
+
+def test_server_errors_are_retried(stub_omdb, make_client):
+    stub_omdb.failures['tt0000001'] = 2
+    client = make_client(retries=3)
+
+    assert client.fetch('tt0000001')['imdbID'] == 'tt0000001'
+    assert stub_omdb.requests['tt0000001'] == 3
+
+
+def test_server_errors_past_the_retries_give_up(stub_omdb, make_client):
+    stub_omdb.failures['tt0000001'] = 10
+    client = make_client(retries=2)
+
+    assert client.fetch('tt0000001') is None
+    assert stub_omdb.requests['tt0000001'] == 3
+
+
+def test_rate_limit_spaces_requests(stub_omdb, make_client):
+    # A full bucket lets the first 20 requests through, the next 10 take 10 / 20 = 0.5s
+    client = make_client(rate_limit=20)
+    imdb_ids = [f'tt{number:07d}' for number in range(30)]
+
+    started = time.monotonic()
+    details = client.fetch_many(imdb_ids)
+    elapsed = time.monotonic() - started
+
+    assert len(details) == 30
+    assert elapsed >= 0.45